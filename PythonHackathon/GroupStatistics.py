@@ -1,6 +1,277 @@
 import numpy as np
 import nibabel as nib
 import pathlib as pl
+import time
+import warnings
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from functools import partial
+from .instrumentation import TRACER
+from .atomic_file import atomic_write
+
+
+class RunningStats():
+    """
+    Keeps the per voxel count, mean and M2 (sum of squared deviations from the mean) of a group of maps.
+    Maps are added one at a time (Welford's algorithm), so only a few volumes are held in memory.
+    The state can be saved, reloaded, updated subject by subject and merged with another partial state.
+    """
+
+    def __init__(self, shape=None):
+        self.count = 0
+        self.mean = None
+        self.m2 = None
+        self.subjects = []
+        if shape is not None:
+            self._allocate(shape)
+
+    def _allocate(self, shape):
+        self.mean = np.zeros(shape, dtype=np.float64)
+        self.m2 = np.zeros(shape, dtype=np.float64)
+
+    def _check_shape(self, shape):
+        if shape != self.mean.shape:
+            raise RuntimeError('one of the maps is invalid - its shape does not match the other maps')
+
+    def update(self, data, subject=None):
+        """
+        Adds one subject's map to the running statistics.
+        :param data: 3D array, same shape as all the previously added maps
+        :param subject: optional name to record, so the subject can be found (and removed) later
+        """
+        if self.mean is None:
+            self._allocate(data.shape)
+        else:
+            self._check_shape(data.shape)
+        if subject is not None:
+            if subject in self.subjects:
+                raise RuntimeError(f'{subject} is already part of the group statistics')
+            self.subjects.append(subject)
+        self.count += 1
+        delta = data - self.mean
+        self.mean += delta / self.count
+        # delta * (data - new mean), computed in place to avoid another full size temporary:
+        delta *= data - self.mean
+        self.m2 += delta
+
+    def remove(self, data, subject=None):
+        """
+        Takes one subject's map out of the running statistics (the inverse of update).
+        :param data: the same 3D array that was added for this subject
+        :param subject: name the subject was recorded with
+        """
+        if subject is not None:
+            if subject not in self.subjects:
+                raise RuntimeError(f'{subject} is not part of the group statistics')
+            self.subjects.remove(subject)
+        if self.count == 0:
+            raise RuntimeError('no maps were added to the group statistics')
+        self._check_shape(data.shape)
+        if self.count == 1:
+            self.count = 0
+            self.mean[...] = 0
+            self.m2[...] = 0
+            return
+        self.count -= 1
+        delta = data - self.mean
+        self.mean -= delta / self.count
+        # M2 loses (data - old mean) * (data - new mean):
+        delta *= data - self.mean
+        self.m2 -= delta
+
+    def merge(self, other):
+        """
+        Combines another partial state into this one (Chan et al. parallel algorithm).
+        :param other: RunningStats computed over a different set of subjects
+        """
+        if other.count == 0:
+            return self
+        shared = set(self.subjects) & set(other.subjects)
+        if shared:
+            raise RuntimeError(f'subjects appear in both partial statistics: {sorted(shared)}')
+        if self.count == 0:
+            self.count = other.count
+            self.mean = other.mean.copy()
+            self.m2 = other.m2.copy()
+            self.subjects = list(other.subjects)
+            return self
+        self._check_shape(other.mean.shape)
+        count = self.count + other.count
+        delta = other.mean - self.mean
+        self.mean += delta * (other.count / count)
+        delta *= delta
+        delta *= self.count * other.count / count
+        self.m2 += other.m2
+        self.m2 += delta
+        self.count = count
+        self.subjects.extend(other.subjects)
+        return self
+
+    def save(self, filename):
+        """
+        Saves the state (count, mean, M2 and subject names) to a .npz file. The file is replaced only once
+        it is complete, so a crash while saving keeps the previous state.
+        """
+        if self.mean is None:
+            raise RuntimeError('no maps were added to the group statistics')
+        with atomic_write(filename) as tmp_filename, open(tmp_filename, 'wb') as f:
+            np.savez(f, count=self.count, mean=self.mean, m2=self.m2, subjects=np.array(self.subjects, dtype=str))
+
+    @classmethod
+    def load(cls, filename):
+        """
+        Loads a state saved with save().
+        """
+        stats = cls()
+        with np.load(str(filename)) as saved:
+            stats.count = int(saved['count'])
+            stats.mean = saved['mean']
+            stats.m2 = saved['m2']
+            stats.subjects = saved['subjects'].tolist()
+        return stats
+
+    def variance(self):
+        """
+        :return: per voxel population variance (same as np.var with ddof=0)
+        """
+        if self.count == 0:
+            raise RuntimeError('no maps were added to the group statistics')
+        # removing subjects can leave tiny negative rounding errors:
+        return np.maximum(self.m2, 0) / self.count
+
+    def std(self):
+        """
+        :return: per voxel population std (same as np.std with ddof=0)
+        """
+        return np.sqrt(self.variance())
+
+
+class VoxelHistograms():
+    """
+    Per voxel histograms of a group of maps, from which approximate quantiles (median, percentiles) and the
+    median absolute deviation are read. Every voxel has bins equal bins over mean +- width_in_std * std
+    (from a first pass of RunningStats) plus an underflow and an overflow bin, so the memory is
+    voxels * (bins + 2) counters whatever the number of subjects. Quantiles are interpolated linearly
+    inside a bin, so their error is at most one bin (2 * width_in_std * std / bins).
+    """
+
+    def __init__(self, mean, std, bins=64, width_in_std=5):
+        self.shape = mean.shape
+        self.bins = bins
+        self.mean = mean.ravel()
+        self.constant = std.ravel() == 0 # voxels with the same value in every map
+        self.low = (mean - width_in_std * std).ravel()
+        # constant voxels (e.g. the background) get a tiny bin, so they still have a well defined quantile:
+        self.bin_width = np.maximum(2 * width_in_std * std.ravel() / bins, 1e-6 * (np.abs(mean.ravel()) + 1))
+        self.count = 0
+        self.counts = np.zeros((self.low.size, bins + 2), dtype=np.uint16)
+        self._offsets = np.arange(self.low.size) * (bins + 2)
+
+    def update(self, data):
+        """
+        Adds one subject's map to the histograms.
+        """
+        if data.shape != self.shape:
+            raise RuntimeError('one of the maps is invalid - its shape does not match the other maps')
+        if self.count == np.iinfo(self.counts.dtype).max:
+            self.counts = self.counts.astype(np.uint32)
+        # bin 0 is the underflow and bin bins + 1 the overflow, every voxel gets exactly one increment:
+        bin_index = np.floor((data.ravel() - self.low) / self.bin_width)
+        bin_index = np.clip(bin_index + 1, 0, self.bins + 1).astype(np.intp)
+        self.counts.ravel()[self._offsets + bin_index] += 1
+        self.count += 1
+
+    def _cdf(self, values, voxels):
+        """
+        Fraction of the maps below values (piecewise linear inside the bins) for the given voxels
+        """
+        counts = self.counts[voxels].astype(np.float64)
+        below = np.cumsum(counts, axis=1) - counts # maps in the lower bins
+        position = (values - self.low[voxels]) / self.bin_width[voxels] + 1
+        bin_index = np.clip(np.floor(position), 0, self.bins + 1).astype(np.intp)
+        fraction = np.clip(position - bin_index, 0, 1)
+        fraction[(bin_index == 0) | (bin_index == self.bins + 1)] = 0 # values outside the range are not spread
+        rows = np.arange(len(voxels))
+        return (below[rows, bin_index] + fraction * counts[rows, bin_index]) / self.count
+
+    def quantile(self, q, chunk_size=2 ** 16):
+        """
+        :param q: quantile, 0.5 for the median
+        :return: per voxel approximate quantile (values in the under / overflow bins are clamped to the range)
+        """
+        if self.count == 0:
+            raise RuntimeError('no maps were added to the group statistics')
+        result = np.empty(self.low.size)
+        for start in range(0, self.low.size, chunk_size):
+            voxels = np.arange(start, min(start + chunk_size, self.low.size))
+            counts = self.counts[voxels].astype(np.float64)
+            cumulative = np.cumsum(counts, axis=1)
+            target = q * self.count
+            # first bin that reaches the target, the range's ends for the under / overflow bins:
+            bin_index = np.minimum((cumulative < target).sum(axis=1), self.bins + 1)
+            rows = np.arange(len(voxels))
+            in_bin = counts[rows, bin_index]
+            with np.errstate(invalid='ignore', divide='ignore'):
+                fraction = np.where(in_bin > 0, (target - (cumulative[rows, bin_index] - in_bin)) / in_bin, 0)
+            position = np.clip(bin_index - 1 + np.clip(fraction, 0, 1), 0, self.bins)
+            result[voxels] = self.low[voxels] + position * self.bin_width[voxels]
+        result[self.constant] = self.mean[self.constant]
+        return result.reshape(self.shape)
+
+    def mad(self, median=None, chunk_size=2 ** 16, iterations=40):
+        """
+        Median absolute deviation from the median: the distance d at which F(median + d) - F(median - d)
+        reaches one half, found by bisection over the histograms
+        :return: per voxel approximate MAD
+        """
+        median = (self.quantile(0.5) if median is None else median).ravel()
+        result = np.empty(self.low.size)
+        for start in range(0, self.low.size, chunk_size):
+            voxels = np.arange(start, min(start + chunk_size, self.low.size))
+            low = np.zeros(len(voxels))
+            high = (self.bins + 2) * self.bin_width[voxels]
+            for _ in range(iterations):
+                middle = (low + high) / 2
+                inside = self._cdf(median[voxels] + middle, voxels) - self._cdf(median[voxels] - middle, voxels)
+                reached = inside >= 0.5
+                high = np.where(reached, middle, high)
+                low = np.where(reached, low, middle)
+            result[voxels] = high
+        result[self.constant] = 0
+        return result.reshape(self.shape)
+
+
+def partial_stats(files, stats_file=None, nifti_cache=None):
+    """
+    Computes the running statistics of one shard of subjects (run by a worker process or on another machine).
+    :param files: the shard's subjects' files
+    :param stats_file: where to save the partial statistics, if anywhere
+    :param nifti_cache: NiftiCache to read the subjects from uncompressed copies, if any
+    :return: RunningStats of the shard
+    """
+    stats = RunningStats()
+    for filename in files:
+        filename = pl.Path(filename)
+        stats.update(GroupStatistics.load_subject(filename, nifti_cache), subject=filename.name)
+    if stats_file is not None:
+        stats.save(stats_file)
+    return stats
+
+
+def merge_partial_stats(partials):
+    """
+    Merges partial statistics pairwise, as a balanced tree, so every merge combines groups of similar sizes
+    (the best case for the accuracy of the parallel formula).
+    :param partials: list of RunningStats
+    :return: RunningStats of all the subjects
+    """
+    partials = [x for x in partials if x.count > 0]
+    if not partials:
+        raise RuntimeError('no maps were added to the group statistics')
+    while len(partials) > 1:
+        partials = [partials[i].merge(partials[i + 1]) if i + 1 < len(partials) else partials[i]
+                    for i in range(0, len(partials), 2)]
+    return partials[0]
 
 
 class GroupStatistics():
@@ -8,66 +279,382 @@ class GroupStatistics():
     This class gets a folder that contains raw data files.
     It merges them into a large array and calculates mean and std per each voxel across all subjects.
     It returns two maps: mean and std maps.
+    With streaming=True the subjects are read one at a time and only running statistics are kept,
+    so memory use does not grow with the number of subjects.
+    The running statistics are saved as data_stats.npz next to the maps, so subjects can later be
+    added or removed with update() without reading the whole group again.
+    Files can be decoded by a pool of workers; at most max_in_flight decoded maps wait in memory.
+    With blockwise=True the subjects are converted once to uncompressed memory-mapped .npy files and
+    the statistics are computed over z-slabs of chunk_size slices, in parallel, within a fixed RAM budget.
+    With robust=True the median and MAD (median absolute deviation) maps are written too, and with
+    percentiles the given percentile maps; without the stacked data they come from per voxel histograms
+    (VoxelHistograms, a second pass over the subjects) and are approximate, within bounded memory.
+    With shards=n the subjects are split into n shards whose partial statistics are computed by worker
+    processes and merged; shards computed elsewhere (e.g. on the nodes that store them, with partial_stats)
+    are combined with merge().
     """
 
-    def __init__(self,data_folder):
+    stats_filename = 'data_stats.npz'
+
+    def __init__(self,data_folder,workers=1,max_in_flight=None,use_processes=False,nifti_cache=None,tracer=None,
+                 output_dir='.'):
+        """
+        :param data_folder: folder with the subjects' nifti files
+        :param workers: number of files decoded in parallel (1 decodes serially)
+        :param max_in_flight: maximum number of files being decoded or waiting to be used,
+                              2 * workers by default
+        :param use_processes: decode in a process pool instead of a thread pool
+        :param nifti_cache: NiftiCache to read the subjects from uncompressed copies, if any
+        :param tracer: Tracer of the time, I/O and memory of every stage of run(), the process default by default
+        :param output_dir: folder of the maps (data_mean.nii.gz...) and of the saved statistics (data_stats.npz)
+        """
+        self.output_dir = pl.Path(output_dir)
+        self.output_dir.mkdir(parents=True, exist_ok=True)
+        self.stats_path = self.output_dir / self.stats_filename
         self.data_foldername = data_folder
         if not pl.Path(data_folder).exists():
             raise TypeError(f'{data_folder} is not a valid path input')
+        if workers < 1:
+            raise ValueError('workers must be at least 1')
+        self.workers = workers
+        self.max_in_flight = max(max_in_flight or 2 * workers, workers)
+        self.use_processes = use_processes
+        self.nifti_cache = nifti_cache
+        self.tracer = tracer or TRACER
 
 
-    def run(self,mean=True,std=True):
+    def run(self,mean=True,std=True,streaming=False,blockwise=False,work_dir='blockwise_data',chunk_size=8,
+            shards=None,robust=False,percentiles=(),bins=64):
         """
         Runs the methods of this class.
         :param mean: False if you don't want a mean map as output
         :param std: False if you don't want a std map as output
+        :param streaming: True to accumulate the subjects one by one instead of stacking them all in memory
+        :param blockwise: True to compute the statistics slab by slab over memory-mapped copies of the subjects
+        :param work_dir: folder for the memory-mapped copies (blockwise mode only)
+        :param chunk_size: number of z slices per slab (blockwise mode only)
+        :param shards: number of shards computed by separate worker processes and then merged
+        :param robust: True to also write median and MAD maps
+        :param percentiles: percentiles (0-100) to write maps of
+        :param bins: number of histogram bins per voxel for the robust maps (streaming, blockwise and shards)
         :return: by default two maps of mean and std of each voxel.
         """
-        self.merge_subjects()
+        self.tracer.begin(self.data_foldername)
+        if shards:
+            with self.tracer.stage('accumulate'):
+                self.accumulate_shards(shards)
+        elif blockwise:
+            with self.tracer.stage('convert'):
+                converted = self.convert_subjects(work_dir)
+            with self.tracer.stage('accumulate'):
+                self.accumulate_blockwise(converted, chunk_size)
+        elif streaming:
+            with self.tracer.stage('accumulate'):
+                self.accumulate_subjects()
+        else:
+            with self.tracer.stage('stack'):
+                self.merge_subjects()
         if mean:
-            self.calculate_mean()
+            with self.tracer.stage('mean'):
+                self.calculate_mean()
         if std:
-            self.calculate_std()
+            with self.tracer.stage('std'):
+                self.calculate_std()
+        if robust or percentiles:
+            with self.tracer.stage('robust'):
+                self.calculate_robust(percentiles, bins)
+        if streaming or blockwise or shards:
+            with self.tracer.stage('save stats'):
+                self.save_stats()
+
+
+    def list_subjects(self):
+        """
+        Finds all the subjects' files in the data folder.
+        """
+        foldername = pl.Path(self.data_foldername)
+        self.files = sorted(x for x in foldername.glob('*.nii.gz') if x.is_file())
+        return self.files
+
+
+    @staticmethod
+    def load_subject(filename, nifti_cache=None):
+        """
+        Loads one subject's map and checks it is a 3D volume.
+        :param filename: path of a nifti file
+        :param nifti_cache: NiftiCache to read the map from, if any
+        :return: the subject's data array
+        """
+        img = nifti_cache.load(filename) if nifti_cache is not None else nib.load(str(filename))
+        data = np.asanyarray(img.dataobj)
+        if data.ndim < 3:
+            raise RuntimeError('one of the maps is invalid - contains less than 3 dimensions')
+        elif data.ndim > 3:
+            raise RuntimeError('one of the maps is invalid - contains more than 3 dimensions')
+        return data
+
+
+    def load_subjects(self, files):
+        """
+        Decodes the given files, in parallel when workers > 1, and yields them in the original order.
+        Also measures the decoding throughput (self.files_per_second).
+        :param files: subjects' files to load
+        :return: generator of (filename, data) pairs
+        """
+        files = list(files)
+        load_subject = partial(self.load_subject, nifti_cache=self.nifti_cache)
+        start = time.perf_counter()
+        if self.workers == 1:
+            for filename in files:
+                yield filename, load_subject(filename)
+        else:
+            pool_class = ProcessPoolExecutor if self.use_processes else ThreadPoolExecutor
+            with pool_class(max_workers=self.workers) as pool:
+                pending = deque()
+                files_to_submit = iter(files)
+                for filename in files_to_submit:
+                    pending.append((filename, pool.submit(load_subject, filename)))
+                    if len(pending) == self.max_in_flight:
+                        break
+                while pending:
+                    filename, future = pending.popleft()
+                    data = future.result()
+                    next_filename = next(files_to_submit, None)
+                    if next_filename is not None:
+                        pending.append((next_filename, pool.submit(load_subject, next_filename)))
+                    yield filename, data
+        self.load_seconds = time.perf_counter() - start
+        self.files_per_second = len(files) / self.load_seconds if self.load_seconds > 0 else float('inf')
 
 
     def merge_subjects(self):
         """
         Takes each subject's data and creates an array that contains all subjects.
         """
-        foldername = pl.Path(self.data_foldername)
-        self.files = [x for x in foldername.glob('*.nii.gz') if x.is_file()]
-        arrays_list_to_stack=[]
-        for i in range(len(self.files)):
-            img=nib.load(str(self.files[i]))
-            if len(img.get_data().shape) < 3:
-                raise RuntimeError('one of the maps is invalid - contains less than 3 dimensions')
-            elif len(img.get_data().shape) > 3:
-                raise RuntimeError('one of the maps is invalid - contains more than 3 dimensions')
-            arrays_list_to_stack.append(img.get_data())
+        self.running_stats = None
+        arrays_list_to_stack = [data for _, data in self.load_subjects(self.list_subjects())]
         self.group_data=np.stack(arrays_list_to_stack,axis=0)
 
 
+    def accumulate_subjects(self):
+        """
+        Reads each subject's data in turn and updates the running count, mean and M2 per voxel.
+        Only one subject is held in memory at a time.
+        """
+        self.group_data = None
+        self.running_stats = RunningStats()
+        for filename, data in self.load_subjects(self.list_subjects()):
+            self.running_stats.update(data, subject=filename.name)
+        if self.running_stats.count == 0:
+            raise RuntimeError(f'no subjects were found in {self.data_foldername}')
+
+
+    @staticmethod
+    def shard_subjects(files, shards):
+        """
+        Splits the subjects into contiguous shards of (almost) equal sizes
+        :return: list of lists of files, empty shards left out
+        """
+        files = list(files)
+        bounds = np.linspace(0, len(files), shards + 1).round().astype(int)
+        return [files[start:stop] for start, stop in zip(bounds[:-1], bounds[1:]) if stop > start]
+
+
+    def accumulate_shards(self, shards):
+        """
+        Computes the partial statistics of every shard in a pool of self.workers processes and merges them.
+        :param shards: number of shards
+        """
+        self.group_data = None
+        shard_files = self.shard_subjects(self.list_subjects(), shards)
+        if not shard_files:
+            raise RuntimeError(f'no subjects were found in {self.data_foldername}')
+        with ProcessPoolExecutor(max_workers=self.workers) as pool:
+            partials = list(pool.map(partial(partial_stats, nifti_cache=self.nifti_cache), shard_files))
+        self.running_stats = merge_partial_stats(partials)
+
+
+    def convert_subjects(self, work_dir):
+        """
+        Writes an uncompressed, memory-mappable copy (.npy, Fortran order so z-slabs are contiguous)
+        of each subject. Copies newer than their source file are reused.
+        :param work_dir: folder for the copies
+        :return: list of (subject name, .npy path) pairs
+        """
+        work_dir = pl.Path(work_dir)
+        work_dir.mkdir(parents=True, exist_ok=True)
+        converted = []
+        to_convert = []
+        for filename in self.list_subjects():
+            npy_filename = work_dir / (filename.name[:-len('.nii.gz')] + '.npy')
+            converted.append((filename.name, npy_filename))
+            if not npy_filename.exists() or npy_filename.stat().st_mtime < filename.stat().st_mtime:
+                to_convert.append(filename)
+        for filename, data in self.load_subjects(to_convert):
+            npy_filename = work_dir / (filename.name[:-len('.nii.gz')] + '.npy')
+            # written under a temporary name: an interrupted copy is never taken for a complete one
+            with atomic_write(npy_filename) as tmp_filename:
+                copy = np.lib.format.open_memmap(tmp_filename, mode='w+', dtype=data.dtype, shape=data.shape,
+                                                 fortran_order=True)
+                copy[...] = data
+                copy.flush()
+                del copy
+        return converted
+
+
+    def accumulate_blockwise(self, converted, chunk_size=8):
+        """
+        Calculates the count, mean and M2 per voxel slab by slab over the memory-mapped subjects.
+        Only chunk_size z slices of every subject are read at a time; slabs run in parallel on the workers.
+        :param converted: (subject name, .npy path) pairs returned by convert_subjects
+        :param chunk_size: number of z slices per slab
+        """
+        if not converted:
+            raise RuntimeError(f'no subjects were found in {self.data_foldername}')
+        self.group_data = None
+        subjects = [np.load(str(npy_filename), mmap_mode='r') for _, npy_filename in converted]
+        shape = subjects[0].shape
+        for data in subjects:
+            if data.shape != shape:
+                raise RuntimeError('one of the maps is invalid - its shape does not match the other maps')
+        self.running_stats = RunningStats(shape)
+
+        def slab_stats(z_start):
+            z_stop = min(z_start + chunk_size, shape[2])
+            slab = RunningStats()
+            for data in subjects:
+                slab.update(np.array(data[:, :, z_start:z_stop]))
+            self.running_stats.mean[:, :, z_start:z_stop] = slab.mean
+            self.running_stats.m2[:, :, z_start:z_stop] = slab.m2
+
+        with ThreadPoolExecutor(max_workers=self.workers) as pool:
+            list(pool.map(slab_stats, range(0, shape[2], chunk_size)))
+        self.running_stats.count = len(subjects)
+        self.running_stats.subjects = [name for name, _ in converted]
+
+
+    def save_stats(self):
+        """
+        Saves the running statistics so the maps can be updated later without a full recompute
+        :return: npz file - count, mean and M2 per voxel and the names of the subjects
+        """
+        self.running_stats.save(self.stats_path)
+
+
+    def update(self, added=None, removed=None, stats_file=None):
+        """
+        Updates previously saved statistics and rewrites the mean and std maps. The subjects of the statistics
+        that are no longer in the data folder (and not removed) cannot be taken out without their data: they
+        are warned about and listed in self.missing_subjects.
+        :param added: subjects' files to add. By default, every file in the data folder that is not
+                      part of the saved statistics yet
+        :param removed: subjects' files to take out of the statistics (their data is needed for that)
+        :param stats_file: saved statistics to start from, data_stats.npz of output_dir by default
+        """
+        self.group_data = None
+        self.running_stats = RunningStats.load(stats_file or self.stats_path)
+        files = self.list_subjects()
+        if added is None:
+            added = [x for x in files if x.name not in self.running_stats.subjects]
+        removed_names = {pl.Path(x).name for x in removed or []}
+        self.missing_subjects = [x for x in self._missing(self.running_stats.subjects, files)
+                                 if x not in removed_names]
+        if self.missing_subjects:
+            warnings.warn(f'{len(self.missing_subjects)} subjects of the statistics are no longer in '
+                          f'{self.data_foldername} and stay part of them ({", ".join(self.missing_subjects)}): '
+                          'pass their files as removed, or compute the statistics again')
+        for filename, data in self.load_subjects(pl.Path(x) for x in removed or []):
+            self.running_stats.remove(data, subject=filename.name)
+        for filename, data in self.load_subjects(pl.Path(x) for x in added):
+            self.running_stats.update(data, subject=filename.name)
+        self.calculate_mean()
+        self.calculate_std()
+        self.save_stats()
+
+
+    def missing_subjects_of(self, stats_file=None):
+        """
+        :param stats_file: saved statistics, data_stats.npz of output_dir by default
+        :return: names of the subjects of the saved statistics whose files are no longer in the data folder
+        """
+        with np.load(str(stats_file or self.stats_path)) as saved:
+            subjects = saved['subjects'].tolist()
+        return self._missing(subjects, self.list_subjects())
+
+
+    @staticmethod
+    def _missing(subjects, files):
+        names = {x.name for x in files}
+        return [x for x in subjects if x not in names]
+
+
+    def merge(self, *stats_files):
+        """
+        Merges partial statistics (e.g. computed over different folders or storage nodes) and writes the
+        combined maps.
+        :param stats_files: files saved by save_stats() or partial_stats()
+        """
+        self.group_data = None
+        self.running_stats = merge_partial_stats([RunningStats.load(stats_file) for stats_file in stats_files])
+        self.calculate_mean()
+        self.calculate_std()
+        self.save_stats()
+
+
     def calculate_mean(self):
         """
         Calculates mean per voxel across all subjects
         :return: nifiti file - mean map
         """
-        self.data_mean = np.mean(self.group_data,axis=0)
+        if self.group_data is None:
+            self.data_mean = self.running_stats.mean.copy()
+        else:
+            self.data_mean = np.mean(self.group_data,axis=0)
         self.data_mean_img = nib.Nifti1Image(self.data_mean, np.eye(4))
-        nib.save(self.data_mean_img, 'data_mean.nii.gz')
+        nib.save(self.data_mean_img, str(self.output_dir / 'data_mean.nii.gz'))
 
     def calculate_std(self):
         """
         Calculates std per voxel across all subjects
         :return: nifiti file - std map
         """
-        self.data_std = np.std(self.group_data,axis=0)
+        if self.group_data is None:
+            self.data_std = self.running_stats.std()
+        else:
+            self.data_std = np.std(self.group_data,axis=0)
         self.data_std_img = nib.Nifti1Image(self.data_std, np.eye(4))
-        nib.save(self.data_std_img, 'data_std.nii.gz')
+        nib.save(self.data_std_img, str(self.output_dir / 'data_std.nii.gz'))
 
 
-data_folder=r'/Users/ayam/Documents/PythonHackathon_Mos/Data/HealthyControls/RawData'
-a=GroupStatistics(data_folder)
-a.run()
+    def calculate_robust(self, percentiles=(), bins=64):
+        """
+        Calculates the median, MAD and percentile maps per voxel: exactly from the stacked data, or else from
+        per voxel histograms filled by another pass over the subjects
+        :param percentiles: percentiles (0-100) to calculate besides the median
+        :param bins: histogram bins per voxel
+        :return: nifti files - median map, MAD map and a data_p<percentile> map per percentile
+        """
+        if self.group_data is not None:
+            self.data_median = np.median(self.group_data, axis=0)
+            self.data_mad = np.median(np.abs(self.group_data - self.data_median), axis=0)
+            self.data_percentiles = {p: np.percentile(self.group_data, p, axis=0) for p in percentiles}
+        else:
+            histograms = VoxelHistograms(self.running_stats.mean, self.running_stats.std(), bins)
+            for _, data in self.load_subjects(self.list_subjects()):
+                histograms.update(data)
+            if histograms.count != self.running_stats.count:
+                raise RuntimeError('the subjects changed since the statistics were calculated')
+            self.data_median = histograms.quantile(0.5)
+            self.data_mad = histograms.mad(self.data_median)
+            self.data_percentiles = {p: histograms.quantile(p / 100) for p in percentiles}
+        nib.save(nib.Nifti1Image(self.data_median, np.eye(4)), str(self.output_dir / 'data_median.nii.gz'))
+        nib.save(nib.Nifti1Image(self.data_mad, np.eye(4)), str(self.output_dir / 'data_mad.nii.gz'))
+        for p, data in self.data_percentiles.items():
+            nib.save(nib.Nifti1Image(data, np.eye(4)), str(self.output_dir / f'data_p{p:g}.nii.gz'))
 
 
+if __name__ == '__main__':
+    data_folder=r'/Users/ayam/Documents/PythonHackathon_Mos/Data/HealthyControls/RawData'
+    a=GroupStatistics(data_folder,workers=4)
+    a.run(streaming=True)
+    print(f'decoded {len(a.files)} files in {a.load_seconds:.1f}s ({a.files_per_second:.1f} files/s)')
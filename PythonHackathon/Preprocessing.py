@@ -2,6 +2,7 @@ import numpy as np
 import nibabel as nib
 import matplotlib.pyplot as plt
 import os
+import pathlib as pl
 from dipy.segment.mask import median_otsu
 from dipy.core.histeq import histeq
 from nipype.workflows.dmri.fsl.artifacts import ecc_pipeline
@@ -9,33 +10,146 @@ import dipy.reconst.dti as dti
 from dipy.core.gradients import gradient_table
 from dipy.reconst.dti import fractional_anisotropy, color_fa
 from nipype.interfaces import fsl
+from nipype import config
+from .instrumentation import TRACER
+from .checkpoint import Checkpoints
+from .tensor_fit import fit_tensors
+from .nifti_cache import create_nifti_memmap
+from .workflow_profile import WorkflowProfiler
+
+
+def executed_node(graph, fullname):
+    """
+    A node of the execution graph returned by a workflow's run. nipype flattens the graph and drops its
+    IdentityInterface nodes (inputnode, outputnode), so a workflow's outputs are read from the nodes that feed them.
+    :param fullname: '<workflow>.<node>', the nodes of nested workflows are '<workflow>.<nested workflow>.<node>'
+    """
+    for node in graph.nodes():
+        if node.fullname == fullname:
+            return node
+    raise RuntimeError(f'the executed workflow has no node {fullname}')
 
 
 class Preprocessing():
+    """
+    Preprocessing of one subject's DTI series: brain segmentation, eddy currents correction and tensor fit.
+    Every output is written to work_dir, so several subjects can be processed at the same time.
+    With checkpoint, every stage records a checkpoint of its outputs keyed by the hash of its inputs and
+    parameters (work_dir/checkpoints.json); a rerun skips the stages whose outputs are still valid, and
+    self.checkpoints.report lists which stages were skipped and which were recomputed.
+    The series is never loaded up front: nibabel's proxy is kept (memory-mapped for an uncompressed .nii,
+    with one open gzip stream for a .nii.gz) and every stage reads only the volumes it needs with volumes().
+    """
 
-    def __init__(self,bvecs_file, bvals_file, dti4d_file, mni_template):
-        self.bvecs_file = bvecs_file
-        self.bvals_file = bvals_file
-        self.dti4d_file = dti4d_file
+    def __init__(self,bvecs_file, bvals_file, dti4d_file, mni_template, tracer=None, work_dir='.',
+                 n_procs=None, memory_gb=None, checkpoint=True, recompute=False, resource_monitor=False):
+        """
+        :param work_dir: folder of this subject's outputs and nipype working files
+        :param n_procs: processes of the nipype MultiProc plugin for the workflows (serial plugin if None)
+        :param memory_gb: memory the MultiProc plugin may schedule nodes into
+        :param checkpoint: False to neither use nor record checkpoints
+        :param recompute: True to run every stage again and record new checkpoints
+        :param resource_monitor: turn on nipype's resource monitor (psutil polling, for every later nipype run of
+                                 the process) so the profile of the eddy correction has each node's peak CPU and memory
+        """
+        self.bvecs_file = os.path.abspath(bvecs_file)
+        self.bvals_file = os.path.abspath(bvals_file)
+        self.dti4d_file = os.path.abspath(dti4d_file)
         self.mni_template = mni_template
-        self.img = nib.load(self.dti4d_file)
-        self.data = self.img.get_data()
+        self.work_dir = pl.Path(work_dir).absolute()
+        self.work_dir.mkdir(parents=True, exist_ok=True)
+        self.mask_file = str(self.work_dir / '_binary_mask.nii.gz') # written by brain_segmentation
+        self.b0_mask_file = str(self.work_dir / '_mask.nii') # uncompressed, written volume by volume
+        self.n_procs = n_procs
+        self.resource_monitor = resource_monitor
+        self.memory_gb = memory_gb
+        self.checkpoints = Checkpoints(self.work_dir, recompute) if checkpoint else None
+        self.tracer = tracer or TRACER # times every step, the process default (PYHACK_TRACE) by default
+        self.tracer.begin(dti4d_file)
+        with self.tracer.stage('load'):
+            # header only, the data stays on disk. keep_file_open keeps a single gzip stream, so volumes read
+            # in increasing order are decompressed in one pass instead of from the start of the file every time:
+            self.img = nib.load(self.dti4d_file, mmap=True, keep_file_open=True)
+        self._data = None
+
+
+    @property
+    def data(self):
+        """
+        The whole series, read on first use (a memory map for an uncompressed series without scaling)
+        """
+        if self._data is None:
+            self._data = np.asanyarray(self.img.dataobj)
+        return self._data
+
+
+    def volumes(self, idx):
+        """
+        Reads only some volumes of the series (read a .nii.gz series in increasing volume order: going back
+        restarts its decompression)
+        :param idx: volume index or slice of volumes
+        :return: 3D array for an index, 4D array for a slice
+        """
+        if self._data is not None:
+            return self._data[..., idx]
+        return np.asanyarray(self.img.dataobj[..., idx])
+
+
+    def plugin(self):
+        """
+        :return: nipype plugin name and arguments: MultiProc limited to n_procs / memory_gb, or Linear
+        """
+        if self.n_procs is None:
+            return 'Linear', {}
+        plugin_args = {'n_procs': self.n_procs}
+        if self.memory_gb is not None:
+            plugin_args['memory_gb'] = self.memory_gb
+        return 'MultiProc', plugin_args
+
+
+    def run_stage(self, stage, inputs, params, compute):
+        """
+        Runs compute() (which returns the stage's output files as a {name: path} dict) under the tracer,
+        unless the stage has a valid checkpoint
+        """
+        with self.tracer.stage(stage):
+            if self.checkpoints is None:
+                return compute()
+            return self.checkpoints.run(stage, inputs, params, compute)
 
 
     def brain_segmentation(self):
         """
         This function does brain segmentation using Dipy - median_otsu
+        The outputs are not cropped to the brain (autocrop=False, the first version cropped them): the mask is
+        given to the eddy currents correction and the tensor fit with the whole series, so both must keep the
+        series' grid, and the cropped volumes were saved with the affine of the uncropped series.
         :return:
-        Two nifti files - binary mask and the brain mask
+        Two nifti files in work_dir - binary mask and the brain mask
         """
-        #self.data=self.data[:,:,:,4]
-        self.b0_mask, self.mask = median_otsu(self.data, 3, 1, True,
-                             vol_idx=range(5, 15), dilate=2)
-        self.mask_img = nib.Nifti1Image(self.mask.astype(np.float32), self.img.affine)
-        self.b0_img = nib.Nifti1Image(self.b0_mask.astype(np.float32), self.img.affine)
-        fname = ''
-        nib.save(self.mask_img, fname + '_binary_mask.nii.gz')
-        nib.save(self.b0_img, fname + '_mask.nii.gz')
+        params = {'median_radius': 3, 'numpass': 1, 'vol_idx': [5, 15], 'dilate': 2, 'autocrop': False}
+        outputs = self.run_stage('segmentation', [self.dti4d_file], params, self._brain_segmentation)
+        self.mask_file, self.b0_mask_file = outputs['mask'], outputs['b0_mask']
+
+
+    def _brain_segmentation(self):
+        with self.tracer.stage('median otsu'):
+            # mean of volumes 5-14, read one at a time (what median_otsu's vol_idx=range(5, 15) computes)
+            mean_volume = np.zeros(self.img.shape[:3])
+            for idx in range(5, 15):
+                mean_volume += self.volumes(idx)
+            mean_volume /= 10
+            _, self.mask = median_otsu(mean_volume, median_radius=3, numpass=1, autocrop=False, dilate=2)
+        with self.tracer.stage('save masks'):
+            self.mask_img = nib.Nifti1Image(self.mask.astype(np.float32), self.img.affine)
+            nib.save(self.mask_img, self.mask_file)
+            # the masked series is streamed to its memory-mapped output, one volume in memory at a time
+            masked = create_nifti_memmap(self.b0_mask_file, self.img.shape, self.img.affine)
+            for idx in range(self.img.shape[3]):
+                masked[..., idx] = self.volumes(idx) * self.mask
+            masked.flush()
+            del masked
+        return {'mask': self.mask_file, 'b0_mask': self.b0_mask_file}
 
         '''sli = self.data.shape[2] // 2
         plt.figure('Brain segmentation')
@@ -49,61 +163,111 @@ class Preprocessing():
         plt.show()'''
 
 
-    def eddy_currnets_correction(self,diffustion_nii, difusion_bval, mask_nii):
-        self.ecc = ecc_pipeline()
-        self.ecc.inputs.inputnode.in_file = diffustion_nii
-        self.ecc.inputs.inputnode.in_bval = difusion_bval
-        self.ecc.inputs.inputnode.in_mask = mask_nii
-        self.ecc.run()  # doctest: +SKIP
+    def eddy_currnets_correction(self,diffustion_nii=None, difusion_bval=None, mask_nii=None):
+        """
+        Runs nipype's eddy currents correction workflow in work_dir, on the subject's series and brain mask by default.
+        The runtime of every node and the critical path are written into the workflow's graph
+        (work_dir/eddy_correct/graph.json, displayed by the index.html there); see workflow_profile
+        :return: the corrected series (self.corrected_file)
+        """
+        inputs = [diffustion_nii or self.dti4d_file, difusion_bval or self.bvals_file, mask_nii or self.mask_file]
+        outputs = self.run_stage('eddy', inputs, {}, lambda: self._eddy_currnets_correction(*inputs))
+        self.corrected_file = outputs['corrected']
+        return self.corrected_file
 
 
-    def eddy_currnets_correction(self,diffustion_nii, difusion_bval, mask_nii):
+    def eddy_corrected_file(self):
+        """
+        :return: the series corrected by eddy_currnets_correction in this process or, in a resumed run, the one
+                 recorded by its valid checkpoint (on the subject's series and brain mask)
+        """
+        if getattr(self, 'corrected_file', None) is not None:
+            return self.corrected_file
+        if self.checkpoints is not None:
+            outputs = self.checkpoints.outputs('eddy', [self.dti4d_file, self.bvals_file, self.mask_file], {})
+            if outputs is not None:
+                self.corrected_file = outputs['corrected']
+                return self.corrected_file
+        raise RuntimeError(f'{self.dti4d_file} has no valid eddy currents correction in {self.work_dir}: run '
+                           'eddy_currnets_correction first, or pass the series to fit')
+
+
+    def _eddy_currnets_correction(self, diffustion_nii, difusion_bval, mask_nii):
         self.ecc = ecc_pipeline()
+        self.ecc.base_dir = str(self.work_dir)
         self.ecc.inputs.inputnode.in_file = diffustion_nii
         self.ecc.inputs.inputnode.in_bval = difusion_bval
         self.ecc.inputs.inputnode.in_mask = mask_nii
-        self.ecc.run()  # doctest: +SKIP
+        plugin, plugin_args = self.plugin()
+        if self.resource_monitor:
+            config.enable_resource_monitor() # peak CPU and memory of every node, for the profile
+        self.ecc_profile = WorkflowProfiler()
+        plugin_args['status_callback'] = self.ecc_profile
+        graph = self.ecc.run(plugin=plugin, plugin_args=plugin_args)  # doctest: +SKIP
+        graph_file = self.work_dir / self.ecc.name / 'graph.json' # written by nipype with the workflow's report
+        if graph_file.exists():
+            self.ecc_critical_path, _ = self.ecc_profile.annotate(graph_file, graph)
+        # the workflow's outputnode.out_file is the out_file of its (top level) MergeDWIs node:
+        merge = executed_node(graph, f'{self.ecc.name}.MergeDWIs')
+        return {'corrected': merge.result.outputs.out_file}
 
 
-    def DTI_fit(self):
+    def DTI_fit(self, dwi=None, mask=None, base_name='TP', engine='fsl', workers=None):
         """
-
-        gtab = gradient_table(bvals_file, bvecs_file)
-        tenmodel = dti.TensorModel(gtab)
-        tenfit = tenmodel.fit(self.mask_img)
-        FA = fractional_anisotropy(tenfit.evals)
-        :return:
+        Fits the tensors in work_dir (the working directory of the process is not changed), with FSL's DTIFit
+        or, with engine='dipy', in process with dipy's TensorModel over the in-mask voxels, in chunks spread
+        over worker processes (see tensor_fit.fit_tensors)
+        :param dwi: series to fit, the eddy corrected one by default (see eddy_corrected_file)
+        :param mask: brain mask, the one of brain_segmentation by default
+        :param engine: 'fsl' or 'dipy'
+        :param workers: worker processes of the dipy engine, the subject's n_procs budget by default (1 if None,
+                        like the serial workflows), so batch workers do not each use every CPU
+        :return: {output name: file} of <base_name>_FA.nii, <base_name>_MD.nii... in work_dir
         """
-        os.chdir(r'/Users/ayam/Documents/PythonHackathon_Mos/Data/Stroke/files')
-        dti = fsl.DTIFit()
-        dti.inputs.dwi = 'DTI4D.nii'
-        dti.inputs.bvecs = 'bvecs'
-        dti.inputs.bvals = 'bvals'
-        dti.inputs.base_name = 'TP'
-        dti.inputs.mask = 'nodif_brain_mask.nii'
-        dti.inputs.output_type = 'NIFTI'
-        dti.run()
+        dwi = dwi or self.eddy_corrected_file()
+        mask = mask or self.mask_file
+        inputs = [dwi, self.bvecs_file, self.bvals_file, mask]
+        if engine == 'dipy':
+            compute = lambda: fit_tensors(dwi, self.bvals_file, self.bvecs_file, mask, self.work_dir, base_name,
+                                          workers=workers or self.n_procs or 1)
+        elif engine == 'fsl':
+            compute = lambda: self._fsl_dti_fit(dwi, mask, base_name)
+        else:
+            raise ValueError(f'unknown tensor fitting engine {engine}')
+        self.tensor_files = self.run_stage('tensor', inputs, {'base_name': base_name, 'engine': engine}, compute)
+        return self.tensor_files
 
 
+    def _fsl_dti_fit(self, dwi, mask, base_name):
+        dti = fsl.DTIFit()
+        dti.inputs.dwi = dwi
+        dti.inputs.bvecs = self.bvecs_file
+        dti.inputs.bvals = self.bvals_file
+        dti.inputs.base_name = base_name
+        dti.inputs.mask = mask
+        dti.inputs.output_type = 'NIFTI'
+        result = dti.run(cwd=str(self.work_dir))
+        return {name: filename for name, filename in result.outputs.get().items() if isinstance(filename, str)}
 
 
-bvecs_file='/Users/ayam/Documents/PythonHackathon_Mos/Data/Stroke/files/bvecs'
-bvals_file='/Users/ayam/Documents/PythonHackathon_Mos/Data/Stroke/files/bvals'
-dti4d_file='/Users/ayam/Documents/PythonHackathon_Mos/Data/Stroke/files/DTI4D.nii.gz'
-mni_template='/Users/ayam/Documents/PythonHackathon_Mos/Data/mni151_2mm.nii'
+if __name__ == '__main__':
+    bvecs_file='/Users/ayam/Documents/PythonHackathon_Mos/Data/Stroke/files/bvecs'
+    bvals_file='/Users/ayam/Documents/PythonHackathon_Mos/Data/Stroke/files/bvals'
+    dti4d_file='/Users/ayam/Documents/PythonHackathon_Mos/Data/Stroke/files/DTI4D.nii.gz'
+    mni_template='/Users/ayam/Documents/PythonHackathon_Mos/Data/mni151_2mm.nii'
 
 
-file=Preprocessing(bvecs_file,bvals_file,dti4d_file,mni_template)
-file.brain_segmentation()
+    file=Preprocessing(bvecs_file,bvals_file,dti4d_file,mni_template)
+    file.brain_segmentation()
 
-file.DTI_fit()
-#diffustion_nii='/Users/ayam/Documents/PythonHackathon_Mos/Data/Stroke/files/DTI4D.nii'
-#difusion_bval='/Users/ayam/Documents/PythonHackathon_Mos/Data/Stroke/files/bvals'
-#mask_nii='/Users/ayam/Documents/PythonHackathon_Mos/PythonHackathon_Mos/PythonHackathon_Mos/_mask.nii.gz'
-#file.eddy_currnets_correction(diffustion_nii,difusion_bval,mask_nii)
+    file.DTI_fit(dwi=dti4d_file) # before the eddy currents correction
+    #diffustion_nii='/Users/ayam/Documents/PythonHackathon_Mos/Data/Stroke/files/DTI4D.nii'
+    #difusion_bval='/Users/ayam/Documents/PythonHackathon_Mos/Data/Stroke/files/bvals'
+    #mask_nii='/Users/ayam/Documents/PythonHackathon_Mos/PythonHackathon_Mos/PythonHackathon_Mos/_mask.nii.gz'
+    #file.eddy_currnets_correction(diffustion_nii,difusion_bval,mask_nii)
 
-diffustion_nii='/Users/ayam/Documents/PythonHackathon_Mos/Data/Stroke/files/DTI4D.nii'
-difusion_bval='/Users/ayam/Documents/PythonHackathon_Mos/Data/Stroke/files/bvals'
-mask_nii='/Users/ayam/Documents/PythonHackathon_Mos/PythonHackathon_Mos/PythonHackathon_Mos/_mask.nii.gz'
-file.eddy_currnets_correction(diffustion_nii,difusion_bval,mask_nii)
+    diffustion_nii='/Users/ayam/Documents/PythonHackathon_Mos/Data/Stroke/files/DTI4D.nii'
+    difusion_bval='/Users/ayam/Documents/PythonHackathon_Mos/Data/Stroke/files/bvals'
+    mask_nii='/Users/ayam/Documents/PythonHackathon_Mos/PythonHackathon_Mos/PythonHackathon_Mos/_mask.nii.gz'
+    file.eddy_currnets_correction(diffustion_nii,difusion_bval,mask_nii)
 
@@ -0,0 +1,128 @@
+import hashlib
+import os
+import pathlib as pl
+import threading
+
+import numpy as np
+import nibabel as nib
+
+from .atomic_file import atomic_write
+
+
+def file_digest(filename, block_size=1 << 20):
+    '''
+    sha256 of a file's content
+    '''
+    digest = hashlib.sha256()
+    with open(filename, 'rb') as f:
+        for block in iter(lambda: f.read(block_size), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+class AtlasIndex:
+    '''
+    Precomputed voxel index of an atlas: the flat indices of the voxels of every area, grouped by label.
+    Built once per atlas file and cached on disk by the sha256 of the file, so the areas of every subject
+    are extracted with one gather over the brain voxels instead of one full-volume mask per label.
+    '''
+
+    version = 1 # bump when the cached format changes
+    default_cache_dir = pl.Path.home() / '.cache' / 'PythonHackathon' / 'atlas_index'
+    _memory_cache = {} # (path, mtime, size) -> AtlasIndex, shared by all the analyzers of the process
+    _lock = threading.Lock()
+
+    def __init__(self, shape, labels, voxels, offsets):
+        '''
+        :param shape: shape of the atlas volume
+        :param labels: sorted labels (>0) present in the atlas, row i of the index belongs to labels[i]
+        :param voxels: flat (C order) indices of the atlas voxels, sorted by label
+        :param offsets: voxels[offsets[i]:offsets[i+1]] are the voxels of labels[i]
+        '''
+        self.shape = tuple(int(x) for x in shape)
+        self.labels = labels
+        self.voxels = voxels
+        self.offsets = offsets
+        self.counts = np.diff(offsets) # number of voxels in each area
+        self.n_regions = int(labels[-1]) if len(labels) else 0 # areas are reported for 1..n_regions
+        self.label_to_row = np.full(self.n_regions + 1, -1, dtype=np.intp) # -1 for labels not in the atlas
+        self.label_to_row[labels] = np.arange(len(labels))
+
+    @classmethod
+    def from_data(cls, atlas_data):
+        '''
+        Builds the index from an atlas array (0 is background)
+        '''
+        flat_labels = np.asarray(atlas_data).ravel().astype(np.intp)
+        in_atlas = np.flatnonzero(flat_labels > 0)
+        order = np.argsort(flat_labels[in_atlas], kind='stable')
+        voxels = in_atlas[order]
+        sorted_labels = flat_labels[voxels]
+        labels, starts = np.unique(sorted_labels, return_index=True)
+        offsets = np.append(starts, len(voxels)).astype(np.intp)
+        return cls(np.shape(atlas_data), labels, voxels, offsets)
+
+    @classmethod
+    def from_file(cls, atlas_nii_path, cache_dir=None):
+        '''
+        Loads the index of an atlas nifti file, building and caching it the first time the atlas is seen.
+        :param atlas_nii_path: path of the atlas
+        :param cache_dir: folder of the cached indices, default_cache_dir by default
+        '''
+        stat = os.stat(atlas_nii_path)
+        memory_key = (os.path.abspath(atlas_nii_path), stat.st_mtime_ns, stat.st_size)
+        with cls._lock:
+            index = cls._memory_cache.get(memory_key)
+        if index is not None:
+            return index
+
+        cache_dir = pl.Path(cache_dir or cls.default_cache_dir)
+        cached_filename = cache_dir / f'{file_digest(atlas_nii_path)}-v{cls.version}.npz'
+        if cached_filename.exists():
+            index = cls.load(cached_filename)
+        else:
+            index = cls.from_data(np.asanyarray(nib.load(str(atlas_nii_path)).dataobj))
+            try:
+                cache_dir.mkdir(parents=True, exist_ok=True)
+                index.save(cached_filename)
+            except OSError: # the cache is an optimization only
+                pass
+        with cls._lock:
+            cls._memory_cache[memory_key] = index
+        return index
+
+    def save(self, filename):
+        with atomic_write(filename) as tmp_filename, open(tmp_filename, 'wb') as f:
+            np.savez(f, shape=self.shape, labels=self.labels, voxels=self.voxels, offsets=self.offsets)
+
+    @classmethod
+    def load(cls, filename):
+        with np.load(str(filename)) as saved:
+            return cls(saved['shape'], saved['labels'], saved['voxels'], saved['offsets'])
+
+    def region_nanmeans(self, values):
+        '''
+        NaN-aware mean of values in every area 1..n_regions (nan for areas with no valid voxel)
+        :param values: array with the shape of the atlas, or a stack of such arrays (subjects x atlas shape),
+                       or a 2D (subjects x flattened voxels) array
+        :return: n_regions means, or a (subjects x n_regions) array for a stack
+        '''
+        values = np.asarray(values)
+        n_voxels = int(np.prod(self.shape))
+        if values.shape == self.shape:
+            return self.region_nanmeans(values.reshape(1, n_voxels))[0]
+        if values.shape[-len(self.shape):] == self.shape:
+            values = values.reshape(-1, n_voxels)
+        elif values.ndim != 2 or values.shape[1] != n_voxels:
+            raise ValueError(f'values of shape {values.shape} do not match the atlas shape {self.shape}')
+        means = np.full((values.shape[0], self.n_regions), np.nan)
+        if not len(self.labels):
+            return means
+        area_values = np.take(values, self.voxels, axis=1) # only the atlas voxels, grouped by area
+        is_valid = ~np.isnan(area_values)
+        area_values[~is_valid] = 0
+        sums = np.add.reduceat(area_values, self.offsets[:-1], axis=1, dtype=np.float64)
+        counts = np.add.reduceat(is_valid.astype(np.intp), self.offsets[:-1], axis=1)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            means[:, self.labels - 1] = sums / counts
+        return means
@@ -0,0 +1,30 @@
+import contextlib
+import os
+import tempfile
+
+
+@contextlib.contextmanager
+def atomic_write(filename):
+    '''
+    Writes a file through a temporary file in the same folder that replaces filename when the block ends
+    without error, so other threads and processes never see a half written file:
+
+        with atomic_write(filename) as tmp_filename:
+            with open(tmp_filename, 'w') as f:
+                ...
+
+    The temporary name is unique (tempfile.mkstemp), so threads of one process writing the same file do not
+    share it. It ends with '.tmp'; write numpy files through an open file, which numpy does not rename.
+    :return: the temporary file's name
+    '''
+    filename = os.fspath(filename)
+    folder, name = os.path.split(os.path.abspath(filename))
+    fd, tmp_filename = tempfile.mkstemp(prefix=f'.{name}.', suffix='.tmp', dir=folder)
+    os.close(fd)
+    try:
+        yield tmp_filename
+        os.replace(tmp_filename, filename)
+    except BaseException:
+        with contextlib.suppress(OSError):
+            os.remove(tmp_filename)
+        raise
@@ -0,0 +1,285 @@
+'''
+Headless batch runs, for backfills of many scans:
+
+    pyhack-batch zscore --mean data_mean.nii.gz --sd data_std.nii.gz --atlas atlas.nii.gz \
+        --subjects scans/ --output-dir results/ --workers 8
+    pyhack-batch group controls/ --output-dir reference/ --workers 8 --shards 8
+
+Controls stored on several machines are reduced where they are, and the partial statistics merged:
+
+    node1$ pyhack-batch partial /data/controls --output node1_stats.npz
+    node2$ pyhack-batch partial --manifest controls.txt --output node2_stats.npz
+    pyhack-batch merge node1_stats.npz node2_stats.npz --output-dir reference/
+
+DTI preprocessing of a manifest (CSV with subject, dwi, bvals and bvecs columns), 4 subjects at a time with
+2 nipype processes and 8 GB each:
+
+    pyhack-batch preprocess subjects.csv --output-dir preprocessed/ --workers 4 --n-procs 2 --memory-gb 8
+
+zscore writes <subject>_zs.nii.gz and <subject>_regions.csv per subject; subjects whose outputs are newer
+than their scan are skipped, so an interrupted run can be started again. group computes the mean and std
+maps of a folder of controls, and only adds the new controls when the folder was processed before.
+'''
+import argparse
+import os
+import sys
+import time
+import pathlib as pl
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import pandas as pd
+
+from .zscores import BatchSubjectAnalyzer
+from .atomic_file import atomic_write
+from .GroupStatistics import GroupStatistics, partial_stats
+from . import preprocess_batch
+
+
+def read_manifest(manifest):
+    '''
+    :param manifest: text file with one subject's nifti file per line ('#' starts a comment), relative
+                     paths are relative to the manifest's folder
+    :return: list of paths
+    '''
+    manifest = pl.Path(manifest)
+    subjects = []
+    with open(manifest) as f:
+        for line in f:
+            line = line.split('#', 1)[0].strip()
+            if line:
+                subjects.append(manifest.parent / line)
+    check_subject_names(subjects, manifest)
+    return subjects
+
+
+def check_subject_names(subjects, source):
+    '''
+    raises ValueError if subjects share a name (their file name without the extension, e.g. a/sub.nii.gz and
+    b/sub.nii.gz): the outputs of a subject are named after it, so they would overwrite each other
+    '''
+    seen = {}
+    for subject in subjects:
+        name = BatchSubjectAnalyzer.subject_name(subject)
+        if name in seen:
+            raise ValueError(f'{source} has two subjects named {name}: {seen[name]} and {subject}')
+        seen[name] = subject
+
+
+def find_subjects(folder):
+    return sorted(x for x in pl.Path(folder).iterdir() if x.name.endswith(('.nii', '.nii.gz')))
+
+
+def output_paths(output_dir, subject_nii_path):
+    name = BatchSubjectAnalyzer.subject_name(subject_nii_path)
+    return output_dir / f'{name}_zs.nii.gz', output_dir / f'{name}_regions.csv'
+
+
+def is_complete(output_dir, subject_nii_path):
+    '''
+    a subject is done when both its outputs exist and are newer than its scan (the region table is
+    written last, so it is only there when the z-map is complete)
+    '''
+    source_mtime = os.stat(subject_nii_path).st_mtime
+    return all(x.exists() and x.stat().st_mtime >= source_mtime for x in output_paths(output_dir, subject_nii_path))
+
+
+# reference maps of a worker process, loaded once by _init_worker
+_analyzer = None
+
+
+def _init_worker(mean_nii_path, sd_nii_path, atlas_nii_path, batch_size, output_dir, atlas_cache_dir, robust,
+                 resample):
+    global _analyzer
+    _analyzer = BatchSubjectAnalyzer(mean_nii_path, sd_nii_path, atlas_nii_path, batch_size=batch_size,
+                                     output_dir=output_dir, atlas_cache_dir=atlas_cache_dir, robust=robust,
+                                     resample=resample)
+
+
+def _analyze_chunk(subject_paths):
+    '''
+    z-scores a chunk of subjects in a worker and writes their region tables
+    :return: (number of analyzed subjects, {subject name: error message})
+    '''
+    table = _analyzer.run(subject_paths)
+    for name in table.index:
+        regions = pd.DataFrame({'Values': table['Values'].loc[name], 'Z-scores': table['Z-scores'].loc[name]})
+        regions.index.name = 'Area'
+        csv_filename = _analyzer.output_dir / f'{name}_regions.csv'
+        with atomic_write(csv_filename) as tmp_filename:
+            regions.to_csv(tmp_filename)
+    return len(table), dict(_analyzer.errors)
+
+
+def run_zscores(subjects, mean_nii_path, sd_nii_path, atlas_nii_path, output_dir, workers=None, batch_size=32,
+                atlas_cache_dir=None, force=False, robust=False, resample=False, log=print):
+    '''
+    Analyzes subjects on a pool of worker processes, batch_size subjects per task
+    :param subjects: list of subjects' nifti files
+    :param force: analyze the subjects again even when their outputs are complete
+    :param robust: the reference maps are the median and MAD maps of the controls
+    :param resample: interpolate subjects on other grids onto the mean map's grid
+    :return: dict with the counts of analyzed, skipped and failed subjects, the errors and the elapsed time
+    '''
+    check_subject_names(subjects, 'the subjects')
+    output_dir = pl.Path(output_dir)
+    output_dir.mkdir(parents=True, exist_ok=True)
+    start = time.perf_counter()
+    summary = {'subjects': len(subjects), 'analyzed': 0, 'errors': {}}
+    to_run = []
+    for subject in subjects:
+        try:
+            if force or not is_complete(output_dir, subject):
+                to_run.append(subject)
+        except OSError as error: # a missing scan fails alone, not the run
+            summary['errors'][BatchSubjectAnalyzer.subject_name(subject)] = str(error)
+    summary['skipped'] = len(subjects) - len(to_run) - len(summary['errors'])
+    to_do = len(to_run) + len(summary['errors'])
+    chunks = [to_run[i:i + batch_size] for i in range(0, len(to_run), batch_size)]
+    if chunks:
+        with ProcessPoolExecutor(max_workers=workers, initializer=_init_worker,
+                                 initargs=(str(mean_nii_path), str(sd_nii_path), str(atlas_nii_path), batch_size,
+                                           str(output_dir), atlas_cache_dir, robust, resample)) as pool:
+            futures = {pool.submit(_analyze_chunk, [str(x) for x in chunk]): chunk for chunk in chunks}
+            for future in as_completed(futures):
+                try:
+                    analyzed, errors = future.result()
+                except Exception as error: # a crashed worker fails its whole chunk, not the run
+                    analyzed = 0
+                    errors = {BatchSubjectAnalyzer.subject_name(x): str(error) for x in futures[future]}
+                summary['analyzed'] += analyzed
+                summary['errors'].update(errors)
+                done = summary['analyzed'] + len(summary['errors'])
+                log(f'{done}/{to_do} subjects done')
+    summary['failed'] = len(summary['errors'])
+    summary['seconds'] = time.perf_counter() - start
+    return summary
+
+
+def run_group(data_folder, output_dir, workers=1, shards=None, robust=False):
+    '''
+    Writes the mean and std maps (and the running statistics) of a folder of controls to output_dir.
+    When output_dir already has statistics, only the controls that are not part of them are added; when
+    controls of the statistics were deleted from the folder, the statistics are computed again.
+    :param shards: number of shards whose partial statistics are computed by separate processes
+    :param robust: also write the median and MAD maps (not when controls are added to saved statistics)
+    :return: dict with the number of controls and the elapsed time
+    '''
+    start = time.perf_counter()
+    group = GroupStatistics(data_folder, workers=workers, use_processes=workers > 1, output_dir=output_dir)
+    if group.stats_path.exists() and not group.missing_subjects_of():
+        group.update()
+    elif shards:
+        group.run(shards=shards, robust=robust)
+    else:
+        group.run(streaming=True, robust=robust)
+    return {'subjects': group.running_stats.count, 'seconds': time.perf_counter() - start}
+
+
+def run_merge(stats_files, output_dir):
+    '''
+    Writes the mean and std maps of the subjects of several partial statistics files to output_dir
+    :return: dict with the number of controls and the elapsed time
+    '''
+    start = time.perf_counter()
+    group = GroupStatistics(output_dir, output_dir=output_dir) # merges saved statistics, reads no subjects
+    group.merge(*stats_files)
+    return {'subjects': group.running_stats.count, 'seconds': time.perf_counter() - start}
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(prog='pyhack-batch', description='Batch z-score analyses and group statistics')
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    zscore = commands.add_parser('zscore', help='z-score maps and region tables of many subjects')
+    subjects = zscore.add_mutually_exclusive_group(required=True)
+    subjects.add_argument('--subjects', help='folder of the subjects\' nifti files')
+    subjects.add_argument('--manifest', help='text file with one subject\'s nifti file per line')
+    zscore.add_argument('--mean', required=True, help='mean map of the controls')
+    zscore.add_argument('--sd', required=True, help='std map of the controls')
+    zscore.add_argument('--atlas', required=True)
+    zscore.add_argument('--output-dir', required=True)
+    zscore.add_argument('--workers', type=int, default=None, help='worker processes, the number of CPUs by default')
+    zscore.add_argument('--batch-size', type=int, default=32, help='subjects per task')
+    zscore.add_argument('--atlas-cache-dir', default=None)
+    zscore.add_argument('--force', action='store_true', help='analyze again subjects that are already done')
+    zscore.add_argument('--robust', action='store_true',
+                        help='--mean and --sd are median and MAD maps: robust z-scores')
+    zscore.add_argument('--resample', action='store_true',
+                        help='interpolate subjects on other grids onto the grid of --mean')
+
+    group = commands.add_parser('group', help='mean and std maps of a folder of controls')
+    group.add_argument('data_folder')
+    group.add_argument('--output-dir', default='.')
+    group.add_argument('--workers', type=int, default=1, help='processes that decode the controls')
+    group.add_argument('--shards', type=int, default=None,
+                       help='split the controls into shards reduced by --workers processes and merged')
+    group.add_argument('--robust', action='store_true', help='also write median and MAD maps')
+
+    partial = commands.add_parser('partial', help='partial statistics of the controls stored on this machine')
+    controls = partial.add_mutually_exclusive_group(required=True)
+    controls.add_argument('data_folder', nargs='?')
+    controls.add_argument('--manifest', help='text file with one control\'s nifti file per line')
+    partial.add_argument('--output', required=True, help='.npz file of the partial statistics')
+
+    merge = commands.add_parser('merge', help='mean and std maps from partial statistics')
+    merge.add_argument('stats_files', nargs='+')
+    merge.add_argument('--output-dir', default='.')
+
+    preprocess = commands.add_parser('preprocess', help='DTI preprocessing of the subjects of a manifest')
+    preprocess.add_argument('manifest', help='CSV file with subject, dwi, bvals and bvecs columns')
+    preprocess.add_argument('--output-dir', required=True, help='a working directory per subject is made here')
+    preprocess.add_argument('--workers', type=int, default=1, help='subjects processed at the same time')
+    preprocess.add_argument('--n-procs', type=int, default=None,
+                            help='nipype MultiProc processes per subject (serial workflows by default)')
+    preprocess.add_argument('--memory-gb', type=float, default=None, help='memory of the MultiProc plugin per subject')
+    preprocess.add_argument('--mni-template', default=None)
+    preprocess.add_argument('--stages', nargs='+', default=preprocess_batch.STAGES, choices=preprocess_batch.STAGES)
+    preprocess.add_argument('--force', action='store_true', help='recompute stages that have valid checkpoints')
+    preprocess.add_argument('--tensor-engine', default='fsl', choices=['fsl', 'dipy'],
+                            help='dipy fits the tensors in process, on --n-procs processes')
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    if args.command in ('group', 'merge'):
+        if args.command == 'group':
+            summary = run_group(args.data_folder, args.output_dir, args.workers, args.shards, args.robust)
+        else:
+            summary = run_merge(args.stats_files, args.output_dir)
+        print(f'{summary["subjects"]} controls in {summary["seconds"]:.1f}s '
+              f'({summary["subjects"] / max(summary["seconds"], 1e-9):.1f} subjects/s)')
+        return 0
+    if args.command == 'preprocess':
+        summary = preprocess_batch.run_preprocessing(preprocess_batch.read_manifest(args.manifest), args.output_dir,
+                                                     workers=args.workers, n_procs=args.n_procs,
+                                                     memory_gb=args.memory_gb, mni_template=args.mni_template,
+                                                     stages=args.stages, recompute=args.force,
+                                                     tensor_engine=args.tensor_engine)
+        for name, error in sorted(summary['errors'].items()):
+            print(f'{name}: {error}', file=sys.stderr)
+        reports = [x for report in summary['checkpoints'].values() for x in report]
+        print(f'{summary["done"]} preprocessed, {summary["failed"]} failed in {summary["seconds"]:.1f}s; '
+              f'{sum(x["status"] == "hit" for x in reports)} stages skipped, '
+              f'{sum(x["status"] == "recomputed" for x in reports)} recomputed')
+        return 1 if summary['failed'] else 0
+    if args.command == 'partial':
+        controls = read_manifest(args.manifest) if args.manifest else \
+            [x for x in find_subjects(args.data_folder) if x.name.endswith('.nii.gz')]
+        stats = partial_stats(controls, args.output)
+        print(f'{stats.count} controls saved to {args.output}')
+        return 0
+
+    subjects = read_manifest(args.manifest) if args.manifest else find_subjects(args.subjects)
+    summary = run_zscores(subjects, args.mean, args.sd, args.atlas, args.output_dir, workers=args.workers,
+                          batch_size=args.batch_size, atlas_cache_dir=args.atlas_cache_dir, force=args.force,
+                          robust=args.robust, resample=args.resample)
+    for name, error in sorted(summary['errors'].items()):
+        print(f'{name}: {error}', file=sys.stderr)
+    print(f'{summary["analyzed"]} analyzed, {summary["skipped"]} skipped, {summary["failed"]} failed '
+          f'in {summary["seconds"]:.1f}s ({summary["analyzed"] / max(summary["seconds"], 1e-9):.1f} subjects/s)')
+    return 1 if summary['failed'] else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,134 @@
+import os
+import threading
+
+import numpy as np
+import nibabel as nib
+
+
+class BrainMask:
+    '''
+    The in-brain voxels of a volume, as a cached flat (C order) index.
+    Volumes are compressed to 1D arrays of their in-brain voxels for the computations, and expanded back
+    to dense volumes only when they are written out.
+    '''
+
+    _memory_cache = {} # (path, mtime, size) -> BrainMask, shared by all the analyzers of the process
+    _atlas_masks = {} # id(AtlasIndex) -> (index, BrainMask)
+    _lock = threading.Lock()
+
+    def __init__(self, shape, voxels):
+        '''
+        :param shape: shape of the volume
+        :param voxels: sorted flat indices of the in-brain voxels
+        '''
+        self.shape = tuple(int(x) for x in shape)
+        self.voxels = voxels
+        self._labels = {} # id(AtlasIndex) -> (index, labels of the in-brain voxels)
+        self._slab_cache = None # see _slab_order
+
+    @classmethod
+    def from_data(cls, mask_data):
+        '''
+        Builds the mask from a volume, every voxel > 0 is in the brain
+        '''
+        return cls(np.shape(mask_data), np.flatnonzero(np.asanyarray(mask_data) > 0))
+
+    @classmethod
+    def from_atlas_index(cls, atlas_index):
+        '''
+        Uses the voxels of all the atlas areas as the brain (cached per atlas)
+        '''
+        with cls._lock:
+            cached = cls._atlas_masks.get(id(atlas_index))
+        if cached is not None and cached[0] is atlas_index:
+            return cached[1]
+        mask = cls(atlas_index.shape, np.sort(atlas_index.voxels))
+        with cls._lock:
+            cls._atlas_masks[id(atlas_index)] = (atlas_index, mask)
+        return mask
+
+    @classmethod
+    def from_file(cls, mask_nii_path):
+        stat = os.stat(mask_nii_path)
+        key = (os.path.abspath(mask_nii_path), stat.st_mtime_ns, stat.st_size)
+        with cls._lock:
+            mask = cls._memory_cache.get(key)
+        if mask is None:
+            mask = cls.from_data(np.asanyarray(nib.load(str(mask_nii_path)).dataobj))
+            with cls._lock:
+                cls._memory_cache[key] = mask
+        return mask
+
+    @property
+    def n_voxels(self):
+        return len(self.voxels)
+
+    def compress(self, volume):
+        '''
+        :param volume: array with the shape of the mask
+        :return: 1D array of the in-brain voxels of the volume
+        '''
+        if np.shape(volume) != self.shape:
+            raise ValueError(f'volume of shape {np.shape(volume)} does not match the mask shape {self.shape}')
+        return np.take(volume, self.voxels)
+
+    def compress_image(self, img, dtype=np.float32, slab_bytes=2 ** 22):
+        '''
+        Reads the in-brain voxels of an image through its dataobj, slab by slab along the last axis (contiguous
+        in a NIfTI file), so the dense volume is never held in memory
+        :param slab_bytes: about the size of a slab of the volume in dtype
+        :return: 1D array of the in-brain voxels, as compress(volume) would return
+        '''
+        if tuple(img.shape) != self.shape:
+            raise ValueError(f'image of shape {tuple(img.shape)} does not match the mask shape {self.shape}')
+        values = np.empty(self.n_voxels, dtype=dtype)
+        if len(self.shape) != 3 or self.n_voxels == 0:
+            values[:] = self.compress(np.asanyarray(img.dataobj))
+            return values
+        order, slices, rows = self._slab_order()
+        slab_size = max(1, slab_bytes // max(1, rows * np.dtype(dtype).itemsize))
+        for start in range(0, self.shape[2], slab_size):
+            stop = min(start + slab_size, self.shape[2])
+            lo, hi = np.searchsorted(slices, [start, stop])
+            positions = order[lo:hi] # the slab's voxels, by their position in the 1D array
+            slab = np.asanyarray(img.dataobj[..., start:stop])
+            # flat index of each voxel in the slab's own (C order) array:
+            values[positions] = np.take(slab, self.voxels[positions] // self.shape[2] * (stop - start) +
+                                        slices[lo:hi] - start)
+        return values
+
+    def _slab_order(self):
+        '''
+        :return: (voxel positions sorted by their last axis index, the sorted last axis indices,
+                  voxels in one slice of the last axis)
+        '''
+        if self._slab_cache is None:
+            last = self.voxels % self.shape[2]
+            order = np.argsort(last, kind='stable')
+            self._slab_cache = (order, last[order], self.shape[0] * self.shape[1])
+        return self._slab_cache
+
+    def expand(self, values, fill=np.nan):
+        '''
+        :param values: 1D array of in-brain values (as returned by compress)
+        :param fill: value of the voxels outside the brain
+        :return: dense volume
+        '''
+        volume = np.full(int(np.prod(self.shape)), fill, dtype=np.result_type(values, np.min_scalar_type(fill)))
+        volume[self.voxels] = values
+        return volume.reshape(self.shape)
+
+    def atlas_labels(self, atlas_index):
+        '''
+        Atlas label of every in-brain voxel (0 for in-brain voxels outside the atlas), cached per atlas
+        '''
+        cached = self._labels.get(id(atlas_index))
+        if cached is not None and cached[0] is atlas_index:
+            return cached[1]
+        labels = np.zeros(self.n_voxels, dtype=np.intp)
+        if self.n_voxels:
+            positions = np.minimum(np.searchsorted(self.voxels, atlas_index.voxels), self.n_voxels - 1)
+            in_mask = self.voxels[positions] == atlas_index.voxels # atlas voxels outside the mask are left out
+            labels[positions[in_mask]] = np.repeat(atlas_index.labels, atlas_index.counts)[in_mask]
+        self._labels[id(atlas_index)] = (atlas_index, labels)
+        return labels
@@ -0,0 +1,114 @@
+import hashlib
+import json
+import os
+import time
+import pathlib as pl
+
+from .atlas_index import file_digest
+from .atomic_file import atomic_write
+
+
+class Checkpoints:
+    '''
+    Checkpoints of the stages run in one working directory, kept in work_dir/checkpoints.json.
+    A stage's checkpoint is keyed by the sha256 of its name, its parameters and the content of its input
+    files; when a stage is run again with the same key and its recorded outputs are unchanged (same size and
+    mtime), it is skipped and its recorded outputs are returned. Digests of the inputs are remembered by
+    path, mtime and size, so unchanged large inputs are not hashed again.
+    '''
+
+    filename = 'checkpoints.json'
+
+    def __init__(self, work_dir, recompute=False):
+        '''
+        :param recompute: run every stage again (and record new checkpoints), even when they are valid
+        '''
+        self.recompute = recompute
+        self.path = pl.Path(work_dir) / self.filename
+        self.state = {'stages': {}, 'digests': {}}
+        if self.path.exists():
+            with open(self.path) as f:
+                self.state = json.load(f)
+        self.report = [] # {'stage', 'status' ('hit' or 'recomputed'), 'seconds'} of this run
+
+    def _save(self):
+        with atomic_write(self.path) as tmp_filename, open(tmp_filename, 'w') as f:
+            json.dump(self.state, f, indent=1)
+
+    def digest(self, filename):
+        '''
+        sha256 of a file's content, reused while the file's mtime and size do not change
+        '''
+        filename = os.path.abspath(filename)
+        stat = os.stat(filename)
+        cached = self.state['digests'].get(filename)
+        if cached is not None and cached[:2] == [stat.st_mtime_ns, stat.st_size]:
+            return cached[2]
+        digest = file_digest(filename)
+        self.state['digests'][filename] = [stat.st_mtime_ns, stat.st_size, digest]
+        return digest
+
+    def key(self, stage, inputs, params):
+        key = hashlib.sha256(json.dumps([stage, params], sort_keys=True, default=str).encode())
+        for filename in inputs:
+            key.update(self.digest(filename).encode())
+        return key.hexdigest()
+
+    @staticmethod
+    def _signature(outputs):
+        signature = {}
+        for name, filename in outputs.items():
+            stat = os.stat(filename)
+            signature[name] = [stat.st_mtime_ns, stat.st_size]
+        return signature
+
+    def is_valid(self, stage, key):
+        '''
+        :return: True if the stage has a checkpoint with this key and its outputs are unchanged
+        '''
+        checkpoint = self.state['stages'].get(stage)
+        if checkpoint is None or checkpoint['key'] != key:
+            return False
+        try:
+            return self._signature(checkpoint['outputs']) == checkpoint['signature']
+        except FileNotFoundError:
+            return False
+
+    def outputs(self, stage, inputs, params):
+        '''
+        :return: the recorded output files of a stage if its checkpoint is valid for these inputs and
+                 parameters, else None
+        '''
+        try:
+            key = self.key(stage, inputs, params)
+        except FileNotFoundError: # an input is missing, so the stage cannot have run on it
+            return None
+        if not self.is_valid(stage, key):
+            return None
+        return dict(self.state['stages'][stage]['outputs'])
+
+    def run(self, stage, inputs, params, compute):
+        '''
+        Runs a stage unless it has a valid checkpoint
+        :param inputs: input files of the stage
+        :param params: parameters of the stage (JSON serializable)
+        :param compute: function() that runs the stage and returns its output files as a {name: path} dict
+        :return: the stage's output files
+        '''
+        start = time.perf_counter()
+        key = self.key(stage, inputs, params)
+        if not self.recompute and self.is_valid(stage, key):
+            self.report.append({'stage': stage, 'status': 'hit', 'seconds': time.perf_counter() - start})
+            self._save() # keeps new input digests
+            return dict(self.state['stages'][stage]['outputs'])
+        outputs = {name: os.path.abspath(filename) for name, filename in compute().items()}
+        self.state['stages'][stage] = {'key': key, 'outputs': outputs, 'signature': self._signature(outputs)}
+        self._save()
+        self.report.append({'stage': stage, 'status': 'recomputed', 'seconds': time.perf_counter() - start})
+        return dict(outputs)
+
+    def summary(self):
+        '''
+        :return: one line per stage run, e.g. 'segmentation: hit (0.1s)'
+        '''
+        return [f'{x["stage"]}: {x["status"]} ({x["seconds"]:.1f}s)' for x in self.report]
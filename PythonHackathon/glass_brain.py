@@ -0,0 +1,147 @@
+import hashlib
+import os
+import pathlib as pl
+import shutil
+import struct
+import zlib
+
+import numpy as np
+
+from .atomic_file import atomic_write
+
+
+version = 1 # part of the cache key, bump when the rendering changes
+default_cache_dir = pl.Path.home() / '.cache' / 'PythonHackathon' / 'glass_brain'
+# size of the cached images, set in MB by PYHACK_GLASS_BRAIN_CACHE_MB; the least recently used are deleted
+max_cache_bytes = int(os.environ.get('PYHACK_GLASS_BRAIN_CACHE_MB', 256)) * 2 ** 20
+
+
+def signed_maximum_projections(zmap):
+    '''
+    Maximum intensity projections of a 3D z-map along the x, y and z axes.
+    Each projected pixel keeps the sign of the voxel with the largest absolute z-score; nan counts as 0.
+    :return: sagittal (y, z), coronal (x, z) and axial (x, y) projections
+    '''
+    zmap = np.nan_to_num(np.asarray(zmap, dtype=np.float64))
+    projections = []
+    for axis in range(3):
+        largest = np.argmax(np.abs(zmap), axis=axis)
+        projections.append(np.squeeze(np.take_along_axis(zmap, np.expand_dims(largest, axis), axis=axis), axis))
+    return projections
+
+
+def colorize(projection, threshold, vmax, silhouette=None):
+    '''
+    Maps a projection to RGB: white background, light gray silhouette, positive z-scores from red to yellow
+    and negative ones from blue to cyan. Values with |z| <= threshold are not colored.
+    :return: (rows, columns, 3) uint8 image, superior / anterior side up
+    '''
+    rgb = np.full(projection.shape + (3,), 255, dtype=np.uint8)
+    if silhouette is not None:
+        rgb[silhouette] = 215
+    strength = np.clip((np.abs(projection) - threshold) / max(vmax - threshold, 1e-9), 0, 1)
+    positive = projection > threshold
+    negative = projection < -threshold
+    rgb[positive] = np.stack([np.full(positive.sum(), 255), 255 * strength[positive],
+                              np.zeros(positive.sum())], axis=1).astype(np.uint8)
+    rgb[negative] = np.stack([np.zeros(negative.sum()), 255 * strength[negative],
+                              np.full(negative.sum(), 255)], axis=1).astype(np.uint8)
+    return np.transpose(rgb, (1, 0, 2))[::-1] # second axis goes up the image
+
+
+def write_png(filename, rgb):
+    '''
+    Writes an (rows, columns, 3) uint8 image as an 8 bit RGB PNG
+    '''
+    def chunk(kind, data):
+        return struct.pack('>I', len(data)) + kind + data + struct.pack('>I', zlib.crc32(kind + data) & 0xffffffff)
+
+    rows, columns = rgb.shape[:2]
+    raw = np.hstack([np.zeros((rows, 1), dtype=np.uint8), rgb.reshape(rows, columns * 3)]) # filter type 0
+    with open(filename, 'wb') as f:
+        f.write(b'\x89PNG\r\n\x1a\n')
+        f.write(chunk(b'IHDR', struct.pack('>IIBBBBB', columns, rows, 8, 2, 0, 0, 0)))
+        f.write(chunk(b'IDAT', zlib.compress(raw.tobytes(), 6)))
+        f.write(chunk(b'IEND', b''))
+
+
+def render(zmap, threshold=1.96, vmax=5, silhouette=None, scale=3, gap=4):
+    '''
+    Renders the sagittal, coronal and axial projections of a z-map side by side
+    :param zmap: 3D z-scores (nan where not significant)
+    :param silhouette: optional 3D boolean brain mask drawn in gray under the z-scores
+    :param scale: every voxel becomes a scale x scale block of pixels
+    :return: (rows, columns, 3) uint8 image
+    '''
+    silhouettes = [None] * 3
+    if silhouette is not None:
+        silhouettes = [np.any(silhouette, axis=axis) for axis in range(3)]
+    tiles = [colorize(projection, threshold, vmax, mask)
+             for projection, mask in zip(signed_maximum_projections(zmap), silhouettes)]
+    rows = max(tile.shape[0] for tile in tiles)
+    padded = []
+    for tile in tiles:
+        top = np.full((rows - tile.shape[0], tile.shape[1], 3), 255, dtype=np.uint8)
+        padded += [np.vstack([top, tile]), np.full((rows, gap, 3), 255, dtype=np.uint8)]
+    image = np.hstack(padded[:-1])
+    return np.repeat(np.repeat(image, scale, axis=0), scale, axis=1)
+
+
+def cache_key(zmap, threshold, vmax, silhouette=None):
+    digest = hashlib.sha256()
+    zmap = np.ascontiguousarray(zmap, dtype=np.float64)
+    digest.update(repr((version, zmap.shape, float(threshold), float(vmax))).encode())
+    digest.update(zmap.tobytes())
+    if silhouette is not None:
+        digest.update(np.packbits(np.ascontiguousarray(silhouette, dtype=bool)).tobytes())
+    return digest.hexdigest()
+
+
+def plot_glass_brain(zmap, output_file, threshold=1.96, vmax=5, silhouette=None, cache_dir=None):
+    '''
+    Fast glass brain of a z-map, saved as a PNG. Rendered images are cached by the hash of the map,
+    threshold and vmax, so plotting the same map again only copies the cached file.
+    :param cache_dir: folder of the cached images, default_cache_dir by default
+    :return: True if the image came from the cache
+    '''
+    cache_dir = pl.Path(cache_dir or default_cache_dir)
+    cached_filename = cache_dir / (cache_key(zmap, threshold, vmax, silhouette) + '.png')
+    try:
+        os.utime(cached_filename) # mark as recently used
+        is_cached = True
+    except FileNotFoundError:
+        is_cached = False
+    if not is_cached:
+        cache_dir.mkdir(parents=True, exist_ok=True)
+        with atomic_write(cached_filename) as tmp_filename:
+            write_png(tmp_filename, render(zmap, threshold, vmax, silhouette))
+        evict(cache_dir, keep=cached_filename)
+    shutil.copyfile(str(cached_filename), str(output_file))
+    return is_cached
+
+
+def evict(cache_dir, max_bytes=None, keep=None):
+    '''
+    Deletes the least recently used cached images until the cache is under max_bytes
+    :param max_bytes: max_cache_bytes by default
+    :param keep: image that should not be deleted (the one just written)
+    '''
+    max_bytes = max_cache_bytes if max_bytes is None else max_bytes
+    entries = []
+    for filename in pl.Path(cache_dir).glob('*.png'):
+        try:
+            stat = filename.stat()
+        except FileNotFoundError: # deleted by another process
+            continue
+        entries.append((stat.st_mtime, stat.st_size, filename))
+    total = sum(size for _, size, _ in entries)
+    for _, size, filename in sorted(entries, key=lambda entry: entry[0]):
+        if total <= max_bytes:
+            break
+        if filename == keep:
+            continue
+        try:
+            filename.unlink()
+        except FileNotFoundError:
+            pass
+        total -= size
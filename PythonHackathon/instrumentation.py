@@ -0,0 +1,185 @@
+import json
+import os
+import sys
+import threading
+import time
+from collections import OrderedDict
+
+try:
+    import resource # not available on Windows
+except ImportError:
+    resource = None
+
+
+def io_counters():
+    '''
+    Bytes read and written by the process so far (rchar / wchar of /proc/self/io, which count every read
+    and write, page cache hits included), None where /proc is not available
+    '''
+    try:
+        with open('/proc/self/io') as f:
+            counters = dict(line.split(':', 1) for line in f)
+        return int(counters['rchar']), int(counters['wchar'])
+    except (OSError, KeyError, ValueError):
+        return None
+
+
+def peak_rss():
+    '''
+    Peak resident memory of the process so far (ru_maxrss: the maximum over the process' lifetime, not of a
+    stage), in bytes (None where it is not available)
+    '''
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak if sys.platform == 'darwin' else peak * 1024 # kilobytes on Linux
+
+
+class Stage:
+    '''
+    Context manager that measures one stage and adds its record to the tracer
+    '''
+
+    __slots__ = ('tracer', 'name', 'run_id', 'parent', 'start', 'wall', 'cpu', 'io')
+
+    def __init__(self, tracer, name):
+        self.tracer = tracer
+        self.name = name
+
+    def __enter__(self):
+        stack = self.tracer._stack()
+        self.parent = stack[-1].name if stack else None
+        self.run_id = getattr(self.tracer._local, 'run_id', None) # run begun by this thread
+        stack.append(self)
+        self.start = time.time()
+        self.io = io_counters()
+        self.cpu = time.process_time()
+        self.wall = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        wall = time.perf_counter() - self.wall
+        cpu = time.process_time() - self.cpu
+        io = io_counters()
+        self.tracer._stack().pop()
+        record = {'run': self.tracer.run_name(self.run_id), 'stage': self.name, 'parent': self.parent,
+                  'start': self.start, 'wall_seconds': wall, 'cpu_seconds': cpu,
+                  'read_bytes': io[0] - self.io[0] if io and self.io else None,
+                  'written_bytes': io[1] - self.io[1] if io and self.io else None,
+                  'process_max_rss_bytes': peak_rss(), 'failed': exc_info[0] is not None}
+        self.tracer.add(record, self.run_id)
+        return False
+
+
+class NullStage:
+    ''' Stage of a disabled tracer, measures nothing '''
+
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        return False
+
+
+NULL_STAGE = NullStage()
+
+
+class Tracer:
+    '''
+    Records the wall time, CPU time, bytes read / written and peak RSS of the stages of an analysis:
+
+        with tracer.stage('z-score'):
+            ...
+
+    Every thread records its stages under the run it began, so analyses running at the same time in
+    several threads (e.g. sharing the process default TRACER) keep separate records. The records of the
+    last max_runs runs are kept in memory (self.records is the calling thread's run) and, with log_file,
+    appended to it as JSON lines. CPU time, I/O and RSS are process-wide, so stages running at the same
+    time in other threads are counted too, and the max RSS is the process' maximum so far, not the
+    stage's. A disabled tracer hands out a shared do-nothing stage, so leaving the
+    instrumentation in the code costs one method call per stage.
+    '''
+
+    max_runs = 16 # runs whose records are kept in memory, the oldest ones are dropped
+
+    def __init__(self, enabled=True, log_file=None):
+        self.enabled = enabled
+        self.log_file = log_file
+        self.runs = OrderedDict() # run id -> {'name', 'records'}
+        self._run_count = 0
+        self._lock = threading.Lock()
+        self._local = threading.local() # stack of the open stages of every thread
+
+    def _stack(self):
+        if not hasattr(self._local, 'stack'):
+            self._local.stack = []
+        return self._local.stack
+
+    def begin(self, run):
+        '''
+        Starts a new run in the calling thread: the stages it measures from now on are recorded under it
+        :param run: name of the run (e.g. the subject's file), written with every record
+        :return: id of the run, for breakdown()
+        '''
+        if not self.enabled:
+            return None
+        with self._lock:
+            self._run_count += 1
+            run_id = self._run_count
+            self.runs[run_id] = {'name': str(run), 'records': []}
+            while len(self.runs) > self.max_runs:
+                self.runs.popitem(last=False)
+        self._local.run_id = run_id
+        return run_id
+
+    def run_name(self, run_id):
+        run = self.runs.get(run_id)
+        return run['name'] if run is not None else None
+
+    @property
+    def records(self):
+        '''
+        records of the run begun by the calling thread
+        '''
+        return self.run_records(getattr(self._local, 'run_id', None))
+
+    def run_records(self, run_id):
+        run = self.runs.get(run_id)
+        return list(run['records']) if run is not None else []
+
+    def stage(self, name):
+        if not self.enabled:
+            return NULL_STAGE
+        return Stage(self, name)
+
+    def add(self, record, run_id=None):
+        with self._lock:
+            self.runs.setdefault(run_id, {'name': None, 'records': []})['records'].append(record)
+            if self.log_file is not None:
+                with open(self.log_file, 'a') as f:
+                    f.write(json.dumps(record) + '\n')
+
+    def breakdown(self, run_id=None):
+        '''
+        :param run_id: run returned by begin(), the one begun by the calling thread by default
+        :return: list of rows (stage, wall time, CPU time, MB read, MB written, process max RSS in MB) of the
+                 run, nested stages indented, for display
+        '''
+        def megabytes(n_bytes):
+            return '' if n_bytes is None else f'{n_bytes / 2 ** 20:.1f}'
+
+        depth = {}
+        rows = [['Stage', 'Wall (s)', 'CPU (s)', 'Read (MB)', 'Written (MB)', 'Process max RSS (MB)']]
+        records = self.records if run_id is None else self.run_records(run_id)
+        for record in sorted(records, key=lambda record: record['start']):
+            depth[record['stage']] = depth.get(record['parent'], -1) + 1 if record['parent'] else 0
+            rows.append(['  ' * depth[record['stage']] + record['stage'], f'{record["wall_seconds"]:.3f}',
+                         f'{record["cpu_seconds"]:.3f}', megabytes(record['read_bytes']),
+                         megabytes(record['written_bytes']), megabytes(record['process_max_rss_bytes'])])
+        return rows
+
+
+# default tracer of the process, enabled by setting PYHACK_TRACE to the JSON lines file to write
+TRACER = Tracer(enabled=bool(os.environ.get('PYHACK_TRACE')), log_file=os.environ.get('PYHACK_TRACE') or None)
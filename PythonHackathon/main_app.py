@@ -1,9 +1,59 @@
 import remi.gui as gui
-from remi import start, App
+from remi import App
+import base64
+import os
 import pathlib
-from xhtml2pdf import pisa
-import urllib.request as urllib2
-from zscores import *
+import tempfile
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from .zscores import *
+from .report import write_report, report_filename
+from .reference_cache import REFERENCE_CACHE
+from .instrumentation import Tracer
+
+# analyses of all the sessions run here, off the remi request thread
+ANALYSIS_EXECUTOR = ThreadPoolExecutor(max_workers=2)
+# every analysis writes its z-map and image to its own folder under this one
+RESULTS_DIR = pathlib.Path('results')
+
+
+class AnalysisCancelled(Exception):
+    """ Raised inside a running analysis when the user cancels it """
+
+
+class AnalysisJob:
+    """ Runs a SubjectAnalyzer in the background and keeps track of the stage it is in """
+
+    stages = ['load', 'z-score', 'atlas', 'render']
+
+    def __init__(self, *args, **kwargs):
+        self.stage = 'queued'
+        self.stage_number = 0 # number of stages started so far
+        self._cancel_event = threading.Event()
+        self.tracer = Tracer(log_file=os.environ.get('PYHACK_TRACE') or None) # time and memory of every stage
+        RESULTS_DIR.mkdir(parents=True, exist_ok=True)
+        self.output_dir = tempfile.mkdtemp(prefix='analysis_', dir=str(RESULTS_DIR))
+        self.future = ANALYSIS_EXECUTOR.submit(self._run, *args, **kwargs)
+
+    def _run(self, *args, **kwargs):
+        return SubjectAnalyzer(*args, progress=self._on_stage, tracer=self.tracer, output_dir=self.output_dir,
+                               **kwargs)
+
+    def _on_stage(self, stage):
+        if self._cancel_event.is_set(): # stop between stages
+            raise AnalysisCancelled()
+        self.stage = stage
+        self.stage_number = self.stages.index(stage) + 1
+
+    def cancel(self):
+        self._cancel_event.set()
+        self.future.cancel() # only succeeds if the job did not start yet
+
+    def done(self):
+        return self.future.done()
+
+    def cancelled(self):
+        return self.future.cancelled() or isinstance(self.future.exception(), AnalysisCancelled)
 
 
 class MyApp(App):
@@ -83,10 +133,20 @@ class MyApp(App):
         self.bt_analyze = gui.Button("Analyze", width=350, height=30, margin='16px')
         self.bt_analyze.onclick.connect(self.on_analyze_pressed)
 
+        """ Progress of the running analysis: """
+        self.job = None
+        self.results = None # SubjectAnalyzer of the last analysis, used for the report
+        self.progress_label = gui.Label('', width=350, height=20, margin='0px')
+        self.progress_bar = gui.Progress(0, len(AnalysisJob.stages), width=250, height=20, margin='5px')
+        self.bt_cancel = gui.Button("Cancel", width=80, height=25, margin='5px')
+        self.bt_cancel.onclick.connect(self.on_cancel_pressed)
+        self.bt_cancel.set_enabled(False)
+
         """ Figure which be replace to visualized results: """
         self.figure_analyzed = gui.Image(r'/res/es.jpg', width=350, height=300, margin='10px')
 
-        sub_container_right.append([sagol_logo, self.bt_analyze])
+        sub_container_right.append([sagol_logo, self.bt_analyze, self.progress_label, self.progress_bar,
+                                    self.bt_cancel])
         sub_container_right.append(self.figure_analyzed, key='image')
 
         self.sub_container_left = sub_container_left
@@ -125,15 +185,65 @@ class MyApp(App):
         return vertical_container
 
     def on_analyze_pressed(self, widget):
-        subject_class = SubjectAnalyzer(self.map_file, self.mean_file, self.sd_file, self.mask_file)
+        """ Starts the analysis in the background, idle() shows its progress and results """
+        if self.job is not None and not self.job.done():
+            return
+        # the mean and sd maps are decoded once and shared by all the sessions of the app, and subjects
+        # from scanners with other matrix sizes are resampled onto their grid:
+        self.job = AnalysisJob(self.map_file, self.mean_file, self.sd_file, self.mask_file,
+                               reference_cache=REFERENCE_CACHE, resample=True)
+        self.bt_analyze.set_enabled(False)
+        self.bt_cancel.set_enabled(True)
+        self.progress_label.set_text('Waiting for a free worker...')
+        self.progress_bar.set_value(0)
+
+    def on_cancel_pressed(self, widget):
+        if self.job is not None:
+            self.job.cancel()
+            self.progress_label.set_text('Cancelling...')
+
+    def idle(self):
+        """ Called periodically by remi: updates the progress and shows the results when the job is done """
+        job = self.job
+        if job is None:
+            return
+        if not job.done():
+            self.progress_label.set_text('Running: {} ({}/{})'.format(job.stage, job.stage_number,
+                                                                     len(AnalysisJob.stages)))
+            self.progress_bar.set_value(job.stage_number)
+            return
+        self.job = None
+        self.bt_analyze.set_enabled(True)
+        self.bt_cancel.set_enabled(False)
+        if job.cancelled():
+            self.progress_label.set_text('Analysis cancelled')
+            return
+        if job.future.exception() is not None:
+            self.progress_label.set_text('Analysis failed: {}'.format(job.future.exception()))
+            return
+        self.show_results(job.future.result())
+
+    def show_results(self, subject_class):
+        if not subject_class.is_data_proper:
+            self.progress_label.set_text(subject_class.error_message)
+            return
+        self.progress_label.set_text('Analysis done')
+        self.progress_bar.set_value(len(AnalysisJob.stages))
+        self.results = subject_class
         table_content = subject_class.table
 
         self.table = gui.Table.new_from_list(table_content, width=250, height=500, margin='10px')
-        print([['Region', 'value', 'Z-score'], table_content])
         self.sub_container_left.append(self.table, key='table')
-        self.figure_analyzed = gui.Image(r'/res/Z_map.png',width=350, height=150, margin='10px')
+        # the image of this analysis, inlined so that no other session's file can be shown:
+        with open(subject_class.image_path, 'rb') as f:
+            image_url = 'data:image/png;base64,' + base64.b64encode(f.read()).decode('ascii')
+        self.figure_analyzed = gui.Image(image_url, width=350, height=150, margin='10px')
 
         self.sub_container_right.append(self.figure_analyzed, key='image')
+        # time, I/O and memory of every stage of the analysis:
+        self.timing_table = gui.Table.new_from_list(subject_class.tracer.breakdown(subject_class.trace_run), width=350, height=150,
+                                                    margin='10px')
+        self.sub_container_right.append(self.timing_table, key='timing')
 
     def menu_subject_clicked(self, widget):
         self.fileselectionDialog = gui.FileSelectionDialog('File Selection Dialog', "Select subject's map file", False,
@@ -192,19 +302,23 @@ class MyApp(App):
 
 
     def menu_pdf_clicked(self, widget):
-        """ returns PDF file but doesn't keep the layout"""
-        url = urllib2.urlopen('http://127.0.0.1:8081')
-        sourceHtml = url.read()
-        pisa.showLogging()
-        outputFilename = "test555.pdf"
-        resultFile = open(outputFilename, "w+b")
-        pisaStatus = pisa.CreatePDF(sourceHtml, resultFile)
-        resultFile.close()
+        """ Writes a PDF report of the last analysis, built from its results table and z-map image, into
+            the analysis' folder"""
+        if self.results is None:
+            self.progress_label.set_text('Analyze a subject before exporting a report')
+            return
+        subject = self.txt_subject.get_text()
+        pdf_filename = os.path.join(str(self.results.output_dir), report_filename(subject))
+        output_filename = write_report(pdf_filename, self.results.table, image_path=self.results.image_path,
+                                       subject=subject, date=self.date.get_value(), remarks=self.txt.get_text())
+        self.progress_label.set_text('Report saved as {}'.format(output_filename))
 
 if __name__ == "__main__":
-    """ starts the webserver"""
+    """ starts the webserver: the package's modules import each other relatively, so run it as
+    python -m PythonHackathon.main_app (the same as PythonHackathon.run_gui)"""
+    from .PythonHackathon import run_gui
 
-    start(MyApp, address='127.0.0.1', start_browser=True, multiple_instance=True)
+    run_gui()
 
 
 
@@ -0,0 +1,119 @@
+import hashlib
+import json
+import os
+import pathlib as pl
+
+import numpy as np
+import nibabel as nib
+
+from .atomic_file import atomic_write
+
+
+class NiftiCache:
+    '''
+    Uncompressed, memory-mappable copies of gzipped nifti files.
+    The first load of a .nii.gz file decodes it once and writes its data as an aligned .npy file (plus its
+    header); later loads memory-map that copy, so no gzip decoding is done. A copy is rebuilt when the
+    source file's mtime or size changes, and the least recently used copies are deleted when the cache
+    grows over max_bytes.
+    '''
+
+    default_cache_dir = pl.Path.home() / '.cache' / 'PythonHackathon' / 'nifti'
+
+    def __init__(self, cache_dir=None, max_bytes=10 * 2 ** 30):
+        self.cache_dir = pl.Path(cache_dir or self.default_cache_dir)
+        self.max_bytes = max_bytes
+
+    def _entry(self, path):
+        key = hashlib.sha256(os.path.abspath(path).encode()).hexdigest()
+        return self.cache_dir / f'{key}.npy', self.cache_dir / f'{key}.json'
+
+    def load(self, path):
+        '''
+        :param path: nifti file
+        :return: nibabel image; for .nii.gz files its data is a read-only memory map of the cached copy
+        '''
+        path = str(path)
+        if not path.endswith('.gz'): # uncompressed files are memory-mapped by nibabel already
+            return nib.load(path)
+        stat = os.stat(path)
+        npy_filename, meta_filename = self._entry(path)
+        meta = None
+        if meta_filename.exists() and npy_filename.exists():
+            with open(meta_filename) as f:
+                meta = json.load(f)
+            if (meta['mtime_ns'], meta['size']) != (stat.st_mtime_ns, stat.st_size):
+                meta = None # the source changed
+        if meta is None:
+            meta = self._write(path, stat, npy_filename, meta_filename)
+        else:
+            os.utime(meta_filename) # mark as recently used
+        data = np.load(str(npy_filename), mmap_mode='r')
+        header = nib.Nifti1Header(binaryblock=bytes.fromhex(meta['header']))
+        header.set_slope_inter(np.nan, np.nan) # the cached data is already scaled
+        return nib.Nifti1Image(data, header.get_best_affine(), header)
+
+    def _write(self, path, stat, npy_filename, meta_filename):
+        img = nib.load(path)
+        data = np.asanyarray(img.dataobj)
+        self.cache_dir.mkdir(parents=True, exist_ok=True)
+        with atomic_write(npy_filename) as tmp_filename, open(tmp_filename, 'wb') as f:
+            np.save(f, data) # keeps nibabel's Fortran order
+        header = nib.Nifti1Header.from_header(img.header)
+        meta = {'source': os.path.abspath(path), 'mtime_ns': stat.st_mtime_ns, 'size': stat.st_size,
+                'header': header.binaryblock.hex()}
+        with atomic_write(meta_filename) as tmp_filename, open(tmp_filename, 'w') as f:
+            json.dump(meta, f)
+        self.evict(keep=npy_filename)
+        return meta
+
+    def evict(self, keep=None):
+        '''
+        Deletes the least recently used copies until the cache is under max_bytes
+        :param keep: copy that should not be deleted (the one just written)
+        '''
+        entries = []
+        for npy_filename in self.cache_dir.glob('*.npy'):
+            meta_filename = npy_filename.with_suffix('.json')
+            try:
+                last_used = meta_filename.stat().st_mtime if meta_filename.exists() else 0
+                entries.append((last_used, npy_filename.stat().st_size, npy_filename, meta_filename))
+            except FileNotFoundError: # deleted by another process
+                continue
+        total = sum(size for _, size, _, _ in entries)
+        for _, size, npy_filename, meta_filename in sorted(entries, key=lambda entry: entry[0]):
+            if total <= self.max_bytes:
+                break
+            if npy_filename == keep:
+                continue
+            for filename in (meta_filename, npy_filename):
+                try:
+                    filename.unlink()
+                except FileNotFoundError:
+                    pass
+            total -= size
+
+    def clear(self):
+        for filename in list(self.cache_dir.glob('*.npy')) + list(self.cache_dir.glob('*.json')):
+            filename.unlink()
+
+
+def create_nifti_memmap(filename, shape, affine, dtype=np.float32):
+    '''
+    Creates an uncompressed .nii file filled with zeros, without building the volume in memory, and
+    memory-maps its data, so an output can be written slab by slab as it is computed
+    :return: writable memory map of the data (Fortran order, as nibabel reads it)
+    '''
+    header = nib.Nifti1Header()
+    header.set_data_shape(shape)
+    header.set_data_dtype(dtype)
+    header.set_sform(affine, code=1)
+    header.set_qform(affine, code=1)
+    offset = 352 # header + empty extension flag
+    header.set_data_offset(offset)
+    with open(filename, 'wb') as f:
+        f.write(header.binaryblock)
+        f.write(b'\x00' * (offset - len(header.binaryblock)))
+        f.truncate(offset + int(np.prod(shape)) * np.dtype(dtype).itemsize)
+    return np.memmap(filename, dtype=header.get_data_dtype(), mode='r+', offset=offset, shape=tuple(shape),
+                     order='F')
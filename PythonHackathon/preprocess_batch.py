@@ -0,0 +1,110 @@
+'''
+Preprocessing of many subjects: every subject of a manifest gets its own working directory under output_dir,
+and the subjects run on a pool of worker processes. Each worker runs the nipype workflows of its subject
+with the MultiProc plugin limited to n_procs processes and memory_gb of memory, so a host runs at most
+workers * n_procs processes. Stages finished by an earlier (e.g. crashed) run are skipped through the
+checkpoints of every subject's working directory.
+'''
+import csv
+import os
+import time
+import pathlib as pl
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+from .instrumentation import Tracer
+
+try:
+    from threadpoolctl import threadpool_limits # optional, caps the BLAS / OpenMP pools already started
+except ImportError:
+    threadpool_limits = None
+
+
+STAGES = ['segmentation', 'eddy', 'tensor']
+
+
+def read_manifest(manifest):
+    '''
+    :param manifest: CSV file with the columns subject, dwi, bvals and bvecs (paths relative to the manifest's
+                     folder), one row per subject
+    :return: list of dicts with the subject's name and absolute paths
+    '''
+    manifest = pl.Path(manifest)
+    subjects = []
+    with open(manifest, newline='') as f:
+        for row in csv.DictReader(f):
+            subject = {'subject': row['subject'].strip()}
+            for column in ('dwi', 'bvals', 'bvecs'):
+                subject[column] = str((manifest.parent / row[column].strip()).absolute())
+            subjects.append(subject)
+    names = [subject['subject'] for subject in subjects]
+    if len(set(names)) != len(names):
+        raise ValueError(f'{manifest} has subjects with the same name')
+    return subjects
+
+
+def _limit_threads(threads):
+    # threads of a worker, so that workers * threads does not oversubscribe the host. The variables only
+    # reach the programs the worker starts (FSL, nipype's processes): a forked worker inherits the BLAS
+    # pool numpy already started in the parent, which only threadpoolctl can resize.
+    for variable in ('OMP_NUM_THREADS', 'OPENBLAS_NUM_THREADS', 'MKL_NUM_THREADS'):
+        os.environ[variable] = str(threads)
+    if threadpool_limits is not None:
+        threadpool_limits(limits=threads)
+
+
+def preprocess_subject(subject, output_dir, mni_template=None, n_procs=None, memory_gb=None, stages=STAGES,
+                       recompute=False, tensor_engine='fsl'):
+    '''
+    Runs the given stages of one subject in output_dir/<subject>; the stage timings go to trace.jsonl there
+    :param recompute: True to recompute the stages that have valid checkpoints
+    :param tensor_engine: 'fsl' (DTIFit) or 'dipy' (in process, on n_procs worker processes)
+    :return: (subject name, seconds, checkpoint report: list of {'stage', 'status', 'seconds'})
+    '''
+    from .Preprocessing import Preprocessing # dipy and nipype are only needed here
+
+    start = time.perf_counter()
+    work_dir = pl.Path(output_dir) / subject['subject']
+    work_dir.mkdir(parents=True, exist_ok=True)
+    preprocessing = Preprocessing(subject['bvecs'], subject['bvals'], subject['dwi'], mni_template,
+                                  tracer=Tracer(log_file=str(work_dir / 'trace.jsonl')), work_dir=work_dir,
+                                  n_procs=n_procs, memory_gb=memory_gb, recompute=recompute)
+    if 'segmentation' in stages:
+        preprocessing.brain_segmentation()
+    if 'eddy' in stages:
+        preprocessing.eddy_currnets_correction()
+    if 'tensor' in stages:
+        preprocessing.DTI_fit(engine=tensor_engine)
+    return subject['subject'], time.perf_counter() - start, preprocessing.checkpoints.report
+
+
+def run_preprocessing(subjects, output_dir, workers=1, n_procs=None, memory_gb=None, mni_template=None,
+                      stages=STAGES, recompute=False, tensor_engine='fsl', log=print):
+    '''
+    Preprocesses subjects on a pool of worker processes
+    :param subjects: list of dicts as returned by read_manifest
+    :param workers: subjects processed at the same time
+    :param n_procs: MultiProc processes (and numpy threads) of every subject, serial workflows if None
+    :param memory_gb: memory the MultiProc plugin of every subject may schedule nodes into
+    :param recompute: True to recompute the stages that have valid checkpoints
+    :param tensor_engine: 'fsl' or 'dipy', see Preprocessing.DTI_fit
+    :return: dict with the number of done and failed subjects, the errors, the checkpoint report of every
+             subject and the elapsed time
+    '''
+    start = time.perf_counter()
+    summary = {'subjects': len(subjects), 'done': 0, 'errors': {}, 'checkpoints': {}}
+    with ProcessPoolExecutor(max_workers=workers, initializer=_limit_threads, initargs=(n_procs or 1,)) as pool:
+        futures = {pool.submit(preprocess_subject, subject, str(output_dir), mni_template, n_procs, memory_gb,
+                               stages, recompute, tensor_engine): subject['subject'] for subject in subjects}
+        for future in as_completed(futures):
+            try:
+                name, seconds, report = future.result()
+                summary['done'] += 1
+                summary['checkpoints'][name] = report
+                stages_status = ', '.join(f'{x["stage"]} {x["status"]}' for x in report)
+                log(f'{name} done in {seconds:.0f}s ({summary["done"]}/{len(subjects)}) {stages_status}')
+            except Exception as error: # one failed subject does not stop the others
+                summary['errors'][futures[future]] = str(error)
+                log(f'{futures[future]} failed: {error}')
+    summary['failed'] = len(summary['errors'])
+    summary['seconds'] = time.perf_counter() - start
+    return summary
@@ -0,0 +1,94 @@
+import os
+import threading
+from collections import OrderedDict
+
+import numpy as np
+import nibabel as nib
+
+
+class ReferenceCache:
+    '''
+    Process-wide LRU cache of decoded reference volumes (mean, sd...).
+    Entries are keyed by the file's path, mtime and size, so a changed file is decoded again.
+    The cached arrays are read-only and are shared by every session of the app; the least recently
+    used volumes are evicted when the total size goes over max_bytes.
+    '''
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self._volumes = OrderedDict() # key -> (image, data)
+        self._nbytes = 0
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def key(path):
+        stat = os.stat(path)
+        return os.path.abspath(path), stat.st_mtime_ns, stat.st_size
+
+    def get(self, path, loader, tag=None):
+        '''
+        :param path: nifti file of the volume
+        :param loader: function(path) -> (image, data) that decodes the volume on a cache miss
+        :param tag: tells apart different decodings of the same file (e.g. the dtype)
+        :return: (image, read-only data)
+        '''
+        key = self.key(path) + (tag,)
+        with self._lock:
+            if key in self._volumes:
+                self._volumes.move_to_end(key)
+                self.hits += 1
+                return self._volumes[key]
+            self.misses += 1
+
+        img, data = loader(path) # decoded outside the lock, so other sessions are not blocked
+        data.setflags(write=False)
+        with self._lock:
+            for stale_key in [k for k in self._volumes if k[0] == key[0] and k[1:3] != key[1:3]]:
+                self._remove(stale_key)
+            if key not in self._volumes and data.nbytes <= self.max_bytes:
+                self._volumes[key] = (img, data)
+                self._nbytes += data.nbytes
+                self._evict()
+        return img, data
+
+    def _remove(self, key):
+        _, data = self._volumes.pop(key)
+        self._nbytes -= data.nbytes
+
+    def _evict(self):
+        while self._nbytes > self.max_bytes and self._volumes:
+            self._remove(next(iter(self._volumes)))
+
+    def resize(self, max_bytes):
+        with self._lock:
+            self.max_bytes = max_bytes
+            self._evict()
+
+    def clear(self):
+        with self._lock:
+            self._volumes.clear()
+            self._nbytes = 0
+
+    @property
+    def nbytes(self):
+        return self._nbytes
+
+    def __len__(self):
+        return len(self._volumes)
+
+
+def load_reference_volume(path, dtype=np.float32, nifti_cache=None):
+    '''
+    Decodes a mean / sd map as float with zeros replaced by nan (the values SubjectAnalyzer works with)
+    :param nifti_cache: NiftiCache to read the map from, if any
+    '''
+    img = nifti_cache.load(path) if nifti_cache is not None else nib.load(str(path))
+    data = np.asanyarray(img.dataobj).astype(dtype)
+    data[data == 0] = np.nan
+    return img, data
+
+
+# shared by all the SubjectAnalyzers of the process, size in MB set by PYHACK_REFERENCE_CACHE_MB
+REFERENCE_CACHE = ReferenceCache(int(os.environ.get('PYHACK_REFERENCE_CACHE_MB', 1024)) * 2 ** 20)
@@ -0,0 +1,89 @@
+import html
+import os
+import re
+import string
+from concurrent.futures import ProcessPoolExecutor
+
+from xhtml2pdf import pisa
+
+
+# compiled once per process and filled in for every report
+REPORT_TEMPLATE = string.Template('''<html>
+<head>
+<style>
+    @page { size: a4 portrait; margin: 1.5cm; }
+    body { font-family: Helvetica; font-size: 10pt; }
+    h1 { font-size: 16pt; }
+    table.results { width: 100%; }
+    table.results th { background-color: #d3d3d3; text-align: left; padding: 2px; }
+    table.results td { border-bottom: 1px solid #d3d3d3; padding: 2px; }
+    .remarks { margin-top: 10px; margin-bottom: 10px; }
+</style>
+</head>
+<body>
+<h1>Z-score report: subject $subject</h1>
+<p>Acquisition date: $date</p>
+<p class="remarks">$remarks</p>
+$image
+<table class="results">
+<tr>$header</tr>
+$rows
+</table>
+</body>
+</html>''')
+
+
+def report_filename(subject):
+    '''
+    :param subject: free text subject name, as typed in the app
+    :return: '<subject>_report.pdf', with every character but letters, digits, '.', '-' and '_' replaced by '_'
+             (no path separators)
+    '''
+    return '{}_report.pdf'.format(re.sub(r'[^\w.-]', '_', str(subject)))
+
+
+def report_html(table, image_path=None, subject='', date='', remarks=''):
+    '''
+    Fills in the report template
+    :param table: list of rows, the first one is the header (SubjectAnalyzer.table)
+    :param image_path: glass brain image to show above the table, if any
+    :return: the report as html
+    '''
+    def cells(row, tag):
+        return ''.join(f'<{tag}>{html.escape(str(value))}</{tag}>' for value in row)
+
+    image = ''
+    if image_path is not None:
+        image = f'<img src="{html.escape(os.path.abspath(image_path))}" width="500"/>'
+    return REPORT_TEMPLATE.substitute(subject=html.escape(str(subject)), date=html.escape(str(date)),
+                                      remarks=html.escape(str(remarks)), image=image,
+                                      header=cells(table[0], 'th'),
+                                      rows='\n'.join(f'<tr>{cells(row, "td")}</tr>' for row in table[1:]))
+
+
+def write_report(pdf_filename, table, image_path=None, subject='', date='', remarks=''):
+    '''
+    Writes a PDF report straight from the results table and the z-map image
+    :return: the name of the PDF file
+    '''
+    source_html = report_html(table, image_path, subject, date, remarks)
+    with open(pdf_filename, 'w+b') as result_file:
+        pisa_status = pisa.CreatePDF(source_html, dest=result_file)
+    if pisa_status.err:
+        raise RuntimeError(f'could not create the report {pdf_filename}')
+    return pdf_filename
+
+
+def _write_report(kwargs):
+    return write_report(**kwargs)
+
+
+def write_reports(reports, workers=None):
+    '''
+    Writes many reports in parallel worker processes
+    :param reports: list of dicts with the arguments of write_report (pdf_filename, table, image_path, ...)
+    :param workers: number of processes, the number of CPUs by default
+    :return: the names of the PDF files, in the same order
+    '''
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        return list(pool.map(_write_report, reports))
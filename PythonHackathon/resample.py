@@ -0,0 +1,117 @@
+import os
+import threading
+from collections import OrderedDict
+
+import numpy as np
+
+
+class ResamplingMap:
+    '''
+    Precomputed interpolation of volumes from a source grid onto a target grid (both given by their affine
+    and shape): for every target voxel, the flat indices of the source voxels it is interpolated from and
+    their weights. Built once per pair of grids and cached, so every later volume is resampled with a
+    single gather and a weighted sum.
+    '''
+
+    # memory of the cached maps (a trilinear map takes 64 bytes per target voxel, ~460 MB at 1 mm MNI), set in
+    # MB by PYHACK_RESAMPLING_CACHE_MB; the least recently used maps are dropped
+    max_bytes = int(os.environ.get('PYHACK_RESAMPLING_CACHE_MB', 512)) * 2 ** 20
+    _memory_cache = OrderedDict() # (source grid, target grid, order) -> ResamplingMap
+    _cached_bytes = 0
+    _lock = threading.Lock()
+
+    def __init__(self, source_shape, target_shape, indices, weights):
+        '''
+        :param indices: (target voxels, corners) flat (C order) indices into the source volume
+        :param weights: (target voxels, corners) interpolation weights, all 0 outside the source volume
+        '''
+        self.source_shape = tuple(int(x) for x in source_shape)
+        self.target_shape = tuple(int(x) for x in target_shape)
+        self.indices = indices
+        self.weights = weights
+        self.inside = weights.sum(axis=1) > 0 # target voxels that fall inside the source volume
+
+    @property
+    def nbytes(self):
+        return self.indices.nbytes + self.weights.nbytes + self.inside.nbytes
+
+    @classmethod
+    def build(cls, source_affine, source_shape, target_affine, target_shape, order=1):
+        '''
+        :param order: 1 for trilinear interpolation, 0 for nearest neighbour (labels, masks)
+        '''
+        source_shape = np.array(source_shape[:3])
+        # target voxel -> world -> source voxel coordinates:
+        target_to_source = np.linalg.inv(source_affine) @ target_affine
+        target_voxels = np.indices(target_shape[:3]).reshape(3, -1).astype(np.float64)
+        coords = target_to_source[:3, :3] @ target_voxels + target_to_source[:3, 3:]
+        index_dtype = np.int32 if np.prod(source_shape) < 2 ** 31 else np.intp
+        strides = np.array([source_shape[1] * source_shape[2], source_shape[2], 1])
+        inside = np.all((coords > -1e-6) & (coords < source_shape[:, None] - 1 + 1e-6), axis=0)
+
+        if order == 0:
+            nearest = np.clip(np.rint(coords), 0, source_shape[:, None] - 1).astype(np.intp)
+            indices = (strides @ nearest)[:, None].astype(index_dtype)
+            weights = inside[:, None].astype(np.float32)
+            return cls(source_shape, target_shape, indices, weights)
+
+        base = np.floor(coords)
+        fraction = coords - base
+        base = base.astype(np.intp)
+        indices = np.empty((coords.shape[1], 8), dtype=index_dtype)
+        weights = np.empty((coords.shape[1], 8), dtype=np.float32)
+        for corner, offset in enumerate(np.ndindex(2, 2, 2)):
+            offset = np.array(offset)[:, None]
+            corner_voxels = np.clip(base + offset, 0, source_shape[:, None] - 1)
+            indices[:, corner] = strides @ corner_voxels
+            weights[:, corner] = np.prod(np.where(offset == 1, fraction, 1 - fraction), axis=0)
+        weights[~inside] = 0
+        return cls(source_shape, target_shape, indices, weights)
+
+    @classmethod
+    def get(cls, source_affine, source_shape, target_affine, target_shape, order=1):
+        '''
+        Returns the cached map between two grids, building it the first time the pair is seen
+        '''
+        key = (np.round(source_affine, 6).tobytes(), tuple(source_shape[:3]),
+               np.round(target_affine, 6).tobytes(), tuple(target_shape[:3]), order)
+        with cls._lock:
+            resampling_map = cls._memory_cache.get(key)
+            if resampling_map is not None:
+                cls._memory_cache.move_to_end(key)
+                return resampling_map
+        resampling_map = cls.build(source_affine, source_shape, target_affine, target_shape, order)
+        with cls._lock:
+            if key not in cls._memory_cache and resampling_map.nbytes <= cls.max_bytes:
+                cls._memory_cache[key] = resampling_map
+                cls._cached_bytes += resampling_map.nbytes
+                while cls._cached_bytes > cls.max_bytes:
+                    _, dropped = cls._memory_cache.popitem(last=False)
+                    cls._cached_bytes -= dropped.nbytes
+        return resampling_map
+
+    def apply(self, data, fill=0, dtype=np.float32, missing=None):
+        '''
+        :param data: volume on the source grid
+        :param fill: value of the target voxels outside the source volume
+        :param missing: value of the source voxels without data (e.g. 0, the background of the maps): they are
+                        left out of the interpolation, whose weights are renormalized over the other corners,
+                        so brain edge voxels are not blended with the background. Target voxels with no
+                        corner with data get this value.
+        :return: volume on the target grid
+        '''
+        if np.shape(data)[:3] != self.source_shape or np.ndim(data) != 3:
+            raise ValueError(f'volume of shape {np.shape(data)} does not match the source grid {self.source_shape}')
+        values = np.take(np.asarray(data, dtype=dtype).ravel(), self.indices) # one gather, (voxels, corners)
+        weights = self.weights.astype(dtype, copy=False)
+        if missing is None:
+            resampled = np.einsum('ij,ij->i', values, weights)
+        else:
+            weights = np.where(values != missing, weights, 0)
+            resampled = np.einsum('ij,ij->i', values, weights)
+            total = weights.sum(axis=1)
+            has_data = total > 0
+            resampled[has_data] /= total[has_data]
+            resampled[~has_data] = missing
+        resampled[~self.inside] = fill
+        return resampled.reshape(self.target_shape)
@@ -0,0 +1,77 @@
+import os
+import pathlib as pl
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import nibabel as nib
+import dipy.reconst.dti as dti
+from dipy.core.gradients import gradient_table
+from dipy.io import read_bvals_bvecs
+
+from .nifti_cache import NiftiCache, create_nifti_memmap
+
+
+def _load_series(dwi_file, cache_dir):
+    # .nii files are memory-mapped by nibabel, .nii.gz files through their uncompressed cached copy
+    return NiftiCache(cache_dir).load(dwi_file) if cache_dir is not None else nib.load(dwi_file)
+
+
+def _fit_slab(dwi_file, mask_file, bvals_file, bvecs_file, z_start, z_stop, fit_method, cache_dir):
+    '''
+    Fits the tensors of the in-mask voxels of slices z_start:z_stop (run in a worker process)
+    :return: (z_start, z_stop, slab mask, eigenvalues (voxels x 3), principal eigenvectors (voxels x 3))
+    '''
+    bvals, bvecs = read_bvals_bvecs(bvals_file, bvecs_file)
+    model = dti.TensorModel(gradient_table(bvals, bvecs), fit_method=fit_method)
+    mask = np.asanyarray(nib.load(mask_file).dataobj[:, :, z_start:z_stop]) > 0
+    if not mask.any():
+        return z_start, z_stop, mask, np.empty((0, 3), np.float32), np.empty((0, 3), np.float32)
+    series = _load_series(dwi_file, cache_dir)
+    signal = np.asanyarray(series.dataobj[:, :, z_start:z_stop])[mask] # only the in-mask voxels are fitted
+    fit = model.fit(signal)
+    return (z_start, z_stop, mask, fit.evals.astype(np.float32), fit.evecs[..., 0].astype(np.float32))
+
+
+def fit_tensors(dwi_file, bvals_file, bvecs_file, mask_file, output_dir, base_name='TP', workers=None,
+                slices_per_chunk=4, fit_method='WLS', cache_dir=None):
+    '''
+    Fits a diffusion tensor in every voxel of the brain mask with dipy, in chunks of slices spread over a
+    pool of worker processes. Every chunk is written to the outputs as soon as it is done: the outputs are
+    uncompressed nifti files created up front and memory-mapped, so no full output volume is held in memory.
+    :param workers: worker processes, the number of CPUs by default
+    :param slices_per_chunk: number of z slices fitted by a worker at a time
+    :param fit_method: dipy fit method ('WLS', 'OLS', 'NLLS'...)
+    :param cache_dir: NiftiCache folder for an uncompressed copy of a .nii.gz series, which the workers
+                      memory-map instead of each decompressing it (NiftiCache's default folder by default)
+    :return: {'FA', 'MD', 'L1', 'L2', 'L3', 'V1': file}, named <base_name>_FA.nii... like FSL's DTIFit outputs
+    '''
+    dwi_file, mask_file = os.path.abspath(dwi_file), os.path.abspath(mask_file)
+    if dwi_file.endswith('.gz'):
+        cache_dir = str(cache_dir or NiftiCache.default_cache_dir)
+        _load_series(dwi_file, cache_dir) # decompressed once, here, for all the workers
+    else:
+        cache_dir = None
+    series = nib.load(dwi_file)
+    shape, affine = series.shape[:3], series.affine
+    if nib.load(mask_file).shape[:3] != shape:
+        raise RuntimeError('the brain mask has a dimension mismatch with the DTI series')
+
+    output_dir = pl.Path(output_dir)
+    outputs = {name: str(output_dir / f'{base_name}_{name}.nii') for name in ('FA', 'MD', 'L1', 'L2', 'L3', 'V1')}
+    maps = {name: create_nifti_memmap(filename, shape + ((3,) if name == 'V1' else ()), affine)
+            for name, filename in outputs.items()}
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        futures = [pool.submit(_fit_slab, dwi_file, mask_file, str(bvals_file), str(bvecs_file), z_start,
+                               min(z_start + slices_per_chunk, shape[2]), fit_method, cache_dir)
+                   for z_start in range(0, shape[2], slices_per_chunk)]
+        for future in futures:
+            z_start, z_stop, mask, evals, principal = future.result()
+            slab = np.s_[:, :, z_start:z_stop]
+            maps['FA'][slab][mask] = np.nan_to_num(dti.fractional_anisotropy(evals))
+            maps['MD'][slab][mask] = dti.mean_diffusivity(evals)
+            for i in range(3):
+                maps[f'L{i + 1}'][slab][mask] = evals[:, i]
+            maps['V1'][slab][mask] = principal
+    for data in maps.values():
+        data.flush()
+    return outputs
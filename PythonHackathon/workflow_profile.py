@@ -0,0 +1,182 @@
+'''
+Per-node profile of a nipype workflow run, overlaid on the workflow's d3 graph (the graph.json that nipype
+writes next to its index.html in the workflow's folder, see eddy_correct/): every node gets its start and
+end times, runtime, peak CPU use and peak memory, and the nodes of the critical path (the chain of dependent
+nodes with the longest total runtime, which bounds the run time however many processes are used) are marked.
+'''
+import json
+import math
+import shutil
+import threading
+import time
+import pathlib as pl
+
+from .atomic_file import atomic_write
+
+
+VIEWER = pl.Path(__file__).parent / 'eddy_correct' / 'index.html' # colors the nodes by runtime
+
+
+class WorkflowProfiler:
+    '''
+    status_callback of the nipype plugins (plugin_args={'status_callback': profiler}), called with every
+    node when it starts, ends or fails. The node's runtime is taken from its result, with its peak CPU use
+    and peak memory when nipype's resource monitor is enabled (sampled peaks, not averages). Nodes are keyed
+    by their itername (e.g. 'eddy_correct.DWICoregistration.MergeDWIs'), as nested workflows reuse node names.
+    '''
+
+    def __init__(self):
+        # node itername -> {'start', 'end', 'runtime', 'cpu_peak_percent', 'mem_peak_gb', 'failed'}:
+        self.records = {}
+        self._lock = threading.Lock()
+
+    def __call__(self, node, status):
+        now = time.time()
+        runtime = _runtime(node) if status == 'end' else None
+        with self._lock:
+            record = self.records.setdefault(node.itername, {'start': now, 'end': None, 'runtime': None,
+                                                         'cpu_peak_percent': None, 'mem_peak_gb': None,
+                                                         'failed': False})
+            if status == 'start':
+                record['start'] = now
+                return
+            record['end'] = now
+            record['runtime'] = now - record['start']
+            record['failed'] = status == 'exception'
+            if getattr(runtime, 'duration', None) is not None:
+                record['runtime'] = float(runtime.duration)
+            if getattr(runtime, 'cpu_percent', None) is not None: # the highest sampled CPU percent
+                record['cpu_peak_percent'] = float(runtime.cpu_percent)
+            if getattr(runtime, 'mem_peak_gb', None) is not None:
+                record['mem_peak_gb'] = float(runtime.mem_peak_gb)
+
+    def annotate(self, graph_file, graph=None, viewer=True):
+        '''
+        Adds the profile to a workflow's graph.json, see annotate_graph
+        :param graph: the execution graph returned by the workflow's run, to match the nodes of graph.json
+                      to the records (see graph_node_keys)
+        '''
+        keys = graph_node_keys(graph) if graph is not None else None
+        return annotate_graph(graph_file, self.records, viewer, keys)
+
+
+def _runtime(node):
+    # the runtime of a finished node, None if its result cannot be read
+    try:
+        return node.result.runtime
+    except Exception: # nipype raises various errors for missing or unreadable result files
+        return None
+
+
+def graph_node_key(name):
+    '''
+    :param name: name of a node in graph.json, '<topological index>_<node name>' (e.g. '06_Bias')
+    :return: the node name
+    '''
+    prefix, _, key = name.partition('_')
+    return key if prefix.isdigit() and key else name
+
+
+def graph_node_keys(graph):
+    '''
+    Names of the nodes of an execution graph in its graph.json: '<topological index>_<node name>', numbered
+    in the depth first topological order of nipype's report (Workflow._write_report_info)
+    :param graph: the execution graph returned by the workflow's run
+    :return: {graph.json name: node itername}
+    '''
+    from nipype.pipeline.engine.utils import topological_sort # only needed with a nipype graph
+    nodes, _ = topological_sort(graph, depth_first=True)
+    width = math.ceil(math.log10(len(nodes))) if nodes else 0
+    return {'%0*d_%s' % (width, i, node.name): node.itername for i, node in enumerate(nodes)}
+
+
+def _match_records(nodes, records):
+    # {graph.json name: record key} by node name, for the names of a single record only: the nodes of
+    # nested workflows can share a name, and which graph.json node is which is then unknown
+    by_name = {}
+    for key in records:
+        by_name.setdefault(key.rpartition('.')[2], []).append(key)
+    names = {node['name']: by_name.get(graph_node_key(node['name']), []) for node in nodes}
+    return {name: keys[0] for name, keys in names.items() if len(keys) == 1}
+
+
+def critical_path(nodes):
+    '''
+    Longest path through the dependencies of the graph, weighted by the nodes' runtimes
+    :param nodes: graph.json nodes: dicts with a 'name', the 'imports' (names of the nodes they depend on)
+                  and a 'runtime' in seconds (0 if missing)
+    :return: (names of the path's nodes, first to last, total runtime of the path)
+    '''
+    by_name = {node['name']: node for node in nodes}
+    dependents = {name: [] for name in by_name}
+    waiting = {}
+    for node in nodes:
+        imports = [name for name in node.get('imports', []) if name in by_name]
+        waiting[node['name']] = len(imports)
+        for name in imports:
+            dependents[name].append(node['name'])
+
+    finish = {} # name -> longest runtime of a path ending with the node
+    previous = {}
+    ready = [name for name, count in waiting.items() if count == 0]
+    while ready:
+        name = ready.pop()
+        node = by_name[name]
+        imports = [x for x in node.get('imports', []) if x in by_name]
+        before = max(imports, key=lambda x: finish[x]) if imports else None
+        finish[name] = (finish[before] if before else 0) + (node.get('runtime') or 0)
+        previous[name] = before
+        for dependent in dependents[name]:
+            waiting[dependent] -= 1
+            if waiting[dependent] == 0:
+                ready.append(dependent)
+    if len(finish) != len(by_name):
+        raise ValueError('the workflow graph has a cycle')
+    if not finish:
+        return [], 0
+
+    name = max(finish, key=finish.get)
+    total = finish[name]
+    path = []
+    while name is not None:
+        path.append(name)
+        name = previous[name]
+    return path[::-1], total
+
+
+def annotate_graph(graph_file, records, viewer=True, keys=None):
+    '''
+    Writes a profile into graph.json: every node gets 'start' and 'end' (seconds since the first node
+    started), 'runtime', 'cpu_peak_percent', 'mem_peak_gb', 'failed', 'critical' (True on the critical path) and
+    'critical_import' (the node before it on the critical path, None if there is none)
+    :param records: {node itername: record} as collected by WorkflowProfiler
+    :param viewer: copy the index.html that displays the profile next to graph.json
+    :param keys: {graph.json name: node itername} (see graph_node_keys). By default the nodes are matched by
+                 name, and the nodes whose name is shared by several records are left without a profile
+    :return: (critical path, its total runtime)
+    '''
+    graph_file = pl.Path(graph_file)
+    with open(graph_file) as f:
+        nodes = json.load(f)
+    starts = [record['start'] for record in records.values()]
+    origin = min(starts) if starts else 0
+    if keys is None:
+        keys = _match_records(nodes, records)
+    for node in nodes:
+        record = records.get(keys.get(node['name']))
+        if record is None:
+            continue
+        node.update(record)
+        node['start'] = record['start'] - origin
+        node['end'] = record['end'] - origin if record['end'] is not None else None
+    path, total = critical_path(nodes)
+    for node in nodes:
+        node['critical'] = node['name'] in path
+        position = path.index(node['name']) if node['critical'] else 0
+        node['critical_import'] = path[position - 1] if position > 0 else None
+
+    with atomic_write(graph_file) as tmp_filename, open(tmp_filename, 'w') as f:
+        json.dump(nodes, f, indent=4, sort_keys=True)
+    if viewer and graph_file.parent != VIEWER.parent:
+        shutil.copy(VIEWER, graph_file.parent / VIEWER.name)
+    return path, total
@@ -1,87 +1,293 @@
 import numpy as np
 import pandas as pd
 import nibabel as nib
-from nilearn import plotting
+import pathlib as pl
+import threading
+import tracemalloc
+import zlib
+from functools import partial
+from .atlas_index import AtlasIndex
+from .brain_mask import BrainMask
+from . import glass_brain
+from .reference_cache import load_reference_volume
+from .instrumentation import TRACER
+from .resample import ResamplingMap
+
+# MAD of a normal distribution times this is its standard deviation
+MAD_TO_SD = 1.4826
+
+# errors of unreadable, truncated or corrupt nifti files
+READ_ERRORS = (OSError, EOFError, ValueError, zlib.error, nib.filebasedimages.ImageFileError)
+
+# held by the one analysis that measures its memory with tracemalloc
+_MEMORY_MEASURE_LOCK = threading.Lock()
+
+# nilearn draws with matplotlib's global state, so publication figures are rendered one at a time
+_PUBLICATION_PLOT_LOCK = threading.Lock()
+
+
+def region_nanmeans(labels, values, n_regions):
+    '''
+    NaN-aware mean of values in every atlas area 1..n_regions, computed in a single pass with np.bincount
+    (the same result as np.nanmean(values[labels == i]) for every i, nan for empty areas)
+    :param labels: integer atlas labels, 0 is background
+    :param values: array of the same shape as labels
+    :param n_regions: number of areas (usually labels.max())
+    :return: array of n_regions means
+    '''
+    labels = np.asarray(labels).ravel()
+    values = np.asarray(values).ravel()
+    valid = (labels > 0) & (labels <= n_regions) & ~np.isnan(values)
+    valid_labels = labels[valid].astype(np.intp)
+    sums = np.bincount(valid_labels, weights=values[valid], minlength=n_regions + 1)[1:]
+    counts = np.bincount(valid_labels, minlength=n_regions + 1)[1:]
+    with np.errstate(invalid='ignore', divide='ignore'):
+        return sums / counts
+
 
 class SubjectAnalyzer:
 
-    def __init__(self,subject_nii_path,mean_nii_path,sd_nii_path,atlas_nii_path):
+    def __init__(self,subject_nii_path,mean_nii_path,sd_nii_path,atlas_nii_path,atlas_cache_dir=None,
+                 reference_cache=None,progress=None,render_mode='fast',image_cache_dir=None,
+                 dtype=np.float32,measure_memory=False,masked=False,brain_mask_path=None,nifti_cache=None,
+                 tracer=None,robust=False,resample=False,output_dir='.'):
 
         '''Get paths for files'''
         self.subject_nii_path = subject_nii_path
         self.mean_nii_path = mean_nii_path
         self.sd_nii_path = sd_nii_path
         self.atlas_nii_path = atlas_nii_path
+        self.atlas_cache_dir = atlas_cache_dir # where atlas indices are cached (AtlasIndex default if None)
+        self.reference_cache = reference_cache # ReferenceCache for the decoded mean and sd maps, if any
+        # progress(stage) is called when each stage ('load', 'z-score', 'atlas', 'render') starts:
+        self.progress = progress or (lambda stage: None)
+        # 'fast' draws the glass brain with numpy projections, 'publication' with nilearn:
+        self.render_mode = render_mode
+        self.image_cache_dir = image_cache_dir # where fast glass brain images are cached (default if None)
+        self.dtype = np.dtype(dtype) # float type of all the maps, from loading to the saved z-map
+        # with masked, the maps are kept as 1D arrays of their in-brain voxels (self.brain_mask), taken from
+        # brain_mask_path or, by default, from the atlas areas. Dense volumes are only built for the outputs.
+        self.masked = masked
+        self.brain_mask_path = brain_mask_path
+        self.nifti_cache = nifti_cache # NiftiCache of uncompressed copies of the mean and sd maps, if any
+        # Tracer of the time, I/O and memory of every stage (the process default, off unless PYHACK_TRACE is set):
+        self.tracer = tracer or TRACER
+        # with robust, mean_nii_path and sd_nii_path are the median and MAD maps (GroupStatistics robust=True),
+        # and the z-scores are (value - median) / (1.4826 * MAD):
+        self.robust = robust
+        # with resample, a subject on another grid (shape or affine) than the mean map is interpolated onto
+        # the mean map's grid instead of being rejected:
+        self.resample = resample
+        # the z-map (zs.nii.gz) and its glass brain (Z_map.png) are written here, one folder per analysis
+        # when several analyses run at the same time:
+        self.output_dir = pl.Path(output_dir)
+        self.output_dir.mkdir(parents=True, exist_ok=True)
+        self.zscores_path = str(self.output_dir / 'zs.nii.gz')
+        self.image_path = str(self.output_dir / 'Z_map.png')
+        self.trace_run = self.tracer.begin(subject_nii_path) # id of this analysis' records in the tracer
+        # with measure_memory, the peak memory allocated during the analysis is kept in self.peak_memory
+        # (tracemalloc is process-wide, so only one analysis at a time can measure it, see start_memory_measure):
+        self.measure_memory = measure_memory
+        if measure_memory:
+            self.start_memory_measure()
+        try:
+            self.analyze()
+        finally:
+            if measure_memory:
+                self.stop_memory_measure()
 
+    def analyze(self):
         # Read nii images:
-        self.load_data()
+        with self.stage('load'):
+            self.load_data()
         # If data is OK, continue to analysis:
         if self.is_data_proper:
-            self.calculate_zscore() # Calculate voxel z-scores
-            self.calculate_atlas_results() # Calculate atlas areas mean values and z-scores
+            with self.stage('z-score'):
+                self.calculate_zscore() # Calculate voxel z-scores
+            with self.stage('atlas'):
+                self.calculate_atlas_results() # Calculate atlas areas mean values and z-scores
+            with self.stage('render'):
+                self.plot_zscores() # Save a glass brain image of the significant z-scores
         else: # If data dimensions do not fit, output an error message detailing the error
             self.error_message = \
-                "The following inputs: {}{}{}have an inconsistent have a dimension mismatch with the subject".format(
+                "The following inputs: {}{}{}{}have an inconsistent have a dimension mismatch with the subject".format(
                     'mean map, ' if not self.is_mean_proper else '',
                     'st. dev. map, ' if not self.is_sd_proper else '',
-                    'atlas, ' if not self.is_atlas_proper else '')
+                    'atlas, ' if not self.is_atlas_proper else '',
+                    'brain mask, ' if not self.is_mask_proper else '')
+
+    def stage(self, name):
+        '''
+        announces a stage to the progress callback and returns the tracer's context manager that measures it
+        '''
+        self.progress(name)
+        return self.tracer.stage(name)
+
+    def start_memory_measure(self):
+        '''
+        Starts tracemalloc for this analysis. tracemalloc's start, peak and stop are process-wide, so a
+        measure is refused (RuntimeError) while another analysis measures or anything else is tracing.
+        '''
+        if not _MEMORY_MEASURE_LOCK.acquire(blocking=False):
+            raise RuntimeError('the memory of another analysis is being measured')
+        if tracemalloc.is_tracing():
+            _MEMORY_MEASURE_LOCK.release()
+            raise RuntimeError('tracemalloc is already tracing, the memory of the analysis cannot be measured')
+        tracemalloc.start()
+        self._memory_at_start = tracemalloc.get_traced_memory()[0]
+
+    def stop_memory_measure(self):
+        '''
+        Keeps the peak memory of the analysis (bytes allocated above what was allocated at its start,
+        numpy arrays included) and the size of the arrays the analyzer holds, to size worker counts
+        '''
+        self.peak_memory = tracemalloc.get_traced_memory()[1] - self._memory_at_start
+        tracemalloc.stop()
+        _MEMORY_MEASURE_LOCK.release()
+        self.array_memory = sum(x.nbytes for x in vars(self).values() if isinstance(x, np.ndarray))
+
+    def load_volume(self, img):
+        '''
+        reads an image's data as a new array of the analysis dtype, without keeping a cached copy in the image
+        '''
+        return np.asanyarray(img.dataobj).astype(self.dtype)
+
+    def resample_subject(self):
+        '''
+        interpolates the subject onto the mean map's grid (trilinear), with the interpolation tables of this
+        pair of grids built once and then cached. Zeros are missing values: the background is left out of the
+        interpolation, so the edge of the brain is not blended with it.
+        '''
+        self.native_subject_img = self.subject_img
+        resampling_map = ResamplingMap.get(self.subject_img.affine, self.subject_img.shape,
+                                           self.mean_img.affine, self.mean_img.shape)
+        resampled = resampling_map.apply(np.asanyarray(self.subject_img.dataobj), dtype=self.dtype, missing=0)
+        self.subject_img = nib.Nifti1Image(resampled, self.mean_img.affine)
+        self.is_resampled = True
 
     def load_data(self):
         # Load nifti data of subject, mean and sd of "population" and atlas:
-        self.subject_img = nib.load(self.subject_nii_path)
-        self.mean_img = nib.load(self.mean_nii_path)
-        self.sd_img = nib.load(self.sd_nii_path)
+        # masked maps are read slab by slab, one pass over a gzipped file needs it kept open between the slabs:
+        self.subject_img = nib.load(self.subject_nii_path, keep_file_open=self.masked)
+        if self.reference_cache is not None: # mean and sd come decoded (read-only, nan for zeros) from the cache
+            load_reference = partial(load_reference_volume, dtype=self.dtype, nifti_cache=self.nifti_cache)
+            self.mean_img, self.mean_data = self.reference_cache.get(self.mean_nii_path, load_reference,
+                                                                     tag=self.dtype.str)
+            self.sd_img, self.sd_data = self.reference_cache.get(self.sd_nii_path, load_reference,
+                                                                 tag=self.dtype.str)
+        elif self.nifti_cache is not None: # memory-mapped, no gzip decoding after the first time
+            self.mean_img = self.nifti_cache.load(self.mean_nii_path)
+            self.sd_img = self.nifti_cache.load(self.sd_nii_path)
+        else:
+            self.mean_img = nib.load(self.mean_nii_path, keep_file_open=self.masked)
+            self.sd_img = nib.load(self.sd_nii_path, keep_file_open=self.masked)
         self.atlas_img = nib.load(self.atlas_nii_path)
+        self.is_resampled = False
+        if self.resample and len(self.subject_img.shape) == 3 and \
+                (self.subject_img.shape != self.mean_img.shape or
+                 not np.allclose(self.subject_img.affine, self.mean_img.affine)):
+            with self.tracer.stage('resample'):
+                self.resample_subject()
 
         self.shape = self.subject_img.shape # get dimensions of subject's data
         self.is_mean_proper = self.mean_img.shape == self.shape # test that the mean data is the same shape
         self.is_sd_proper = self.sd_img.shape == self.shape # test that the sd data is the same shape
         self.is_atlas_proper = self.atlas_img.shape == self.shape  # test that the atlas data is the same shape
+        self.is_mask_proper = True
+        if self.masked and self.brain_mask_path is not None:
+            self.brain_mask = BrainMask.from_file(self.brain_mask_path)
+            self.is_mask_proper = self.brain_mask.shape == self.shape # test that the mask is the same shape
 
         # set is_data_proper to false if one of the inputs is not in the same dimensions as the subject
-        self.is_data_proper = self.is_mean_proper and self.is_sd_proper and self.is_atlas_proper
+        self.is_data_proper = self.is_mean_proper and self.is_sd_proper and self.is_atlas_proper and \
+            self.is_mask_proper
+
+        if self.is_atlas_proper: # get the atlas areas' voxels, built once per atlas and then cached
+            self.atlas_index = AtlasIndex.from_file(self.atlas_nii_path, cache_dir=self.atlas_cache_dir)
+        if self.masked and self.brain_mask_path is None and self.is_atlas_proper:
+            self.brain_mask = BrainMask.from_atlas_index(self.atlas_index)
+        # only keep the in-brain voxels when the inputs fit the mask. They are read slab by slab, so the dense
+        # volumes are never loaded, except the mean and sd maps of reference_cache, which are kept dense:
+        if self.masked and self.is_data_proper:
+            compress = self.brain_mask.compress
+            load_volume = partial(self.brain_mask.compress_image, dtype=self.dtype)
+        else:
+            compress = (lambda data: data)
+            load_volume = self.load_volume
 
-        self.subject_data = self.subject_img.get_data() # get subject data from image
-        self.mean_data = self.mean_img.get_data() # get mean data from image
-        self.sd_data = self.sd_img.get_data() # get SD data from image
-        self.atlas_data = self.atlas_img.get_data() # get atlas data from image
+        self.subject_data = load_volume(self.subject_img) # get subject data from image
+        if self.reference_cache is None:
+            self.mean_data = load_volume(self.mean_img) # get mean data from image
+            self.sd_data = load_volume(self.sd_img) # get SD data from image
+            # set zeros values to nan for mean and sd data
+            self.mean_data[self.mean_data == 0] = np.nan
+            self.sd_data[self.sd_data == 0] = np.nan
+        else:
+            self.mean_data = compress(self.mean_data)
+            self.sd_data = compress(self.sd_data)
 
-        # set zeros values to nan for subject, mean and sd data
+        # set zeros values to nan for subject data
         self.subject_data[self.subject_data==0] = np.nan
-        self.mean_data[self.mean_data == 0] = np.nan
-        self.sd_data[self.sd_data == 0] = np.nan
 
 
     def calculate_zscore(self):
         '''
         calculates the zscore for each subject voxel based on the control mean and sd
-        finds only significant voxels and saves them as "zs.nii.gz"
+        finds only significant voxels and saves them as "zs.nii.gz" in output_dir
         '''
-        self.zscores = (self.subject_data - self.mean_data) / self.sd_data # calculate zscores
-        zscores = self.zscores
-        zscores[np.isnan(zscores)] = 0 # replace nans with z scores temporarily
-        # finds non significant values and replaces them with zeros for new variable:
-        self.significant_zscores = np.where(np.abs(zscores)<=1.96,np.nan,zscores)
+        # calculate zscores in place, in one buffer of the analysis dtype:
+        self.zscores = np.empty(self.subject_data.shape, dtype=self.dtype) # 1D in masked mode
+        np.subtract(self.subject_data, self.mean_data, out=self.zscores)
+        np.divide(self.zscores, self.sd_data, out=self.zscores)
+        if self.robust: # the MAD map is shared (reference cache), so it is scaled here
+            self.zscores /= self.dtype.type(MAD_TO_SD)
+        np.copyto(self.zscores, 0, where=np.isnan(self.zscores)) # replace nans with z scores temporarily
+        # finds non significant values and replaces them with nans for new variable:
+        self.significant_zscores = self.zscores.copy()
+        not_significant = self.zscores <= 1.96
+        not_significant &= self.zscores >= -1.96
+        self.significant_zscores[not_significant] = np.nan
+        if self.masked:
+            self.significant_zscores = self.brain_mask.expand(self.significant_zscores)
         # creates nifti template:
         self.significant_zscores_nii = nib.Nifti1Image(self.significant_zscores,self.subject_img.affine)
-        nib.save(self.significant_zscores_nii, 'zs.nii.gz') # save nifti template
-        zs_nii_path = self.significant_zscores_nii
-        plotting.plot_glass_brain(zs_nii_path, threshold=1.96, colorbar=True, plot_abs=False,
-                                  output_file='Z_map.png',vmax=5)
+        with self.tracer.stage('save'):
+            nib.save(self.significant_zscores_nii, self.zscores_path) # save nifti template
+
+
+    def plot_zscores(self):
+        '''
+        plots the significant z-scores on a glass brain and saves it as "Z_map.png" in output_dir
+        '''
+        if self.render_mode == 'publication':
+            from nilearn import plotting # heavy import, only needed for publication quality figures
+            zs_nii_path = self.significant_zscores_nii
+            with _PUBLICATION_PLOT_LOCK:
+                plotting.plot_glass_brain(zs_nii_path, threshold=1.96, colorbar=True, plot_abs=False,
+                                          output_file=self.image_path,vmax=5)
+        else:
+            silhouette = ~np.isnan(self.subject_data)
+            if self.masked:
+                silhouette = self.brain_mask.expand(silhouette, fill=False)
+            glass_brain.plot_glass_brain(self.significant_zscores, self.image_path, threshold=1.96, vmax=5,
+                                         silhouette=silhouette, cache_dir=self.image_cache_dir)
 
 
     def calculate_atlas_results(self):
         '''
         for each area in the atlas supplied, calculate the average value and z-score
         '''
-        vals = np.zeros(self.atlas_data.max()) # initialize values array
-        zs = np.zeros(self.atlas_data.max()) # initialize zscores array
-        for i in range(1,self.atlas_data.max()+1): # for every area
-            vals[i-1] = np.nanmean(self.subject_data[self.atlas_data == i]) # calculate mean value in area
-            zs[i-1] = np.nanmean(self.zscores[self.atlas_data == i]) # calculate mean z-score in area
+        n_regions = self.atlas_index.n_regions # number of areas in the atlas
+        if self.masked: # the labels of the in-brain voxels, in the same order as the 1D maps
+            labels = self.brain_mask.atlas_labels(self.atlas_index)
+            vals = region_nanmeans(labels, self.subject_data, n_regions) # mean value of every area
+            zs = region_nanmeans(labels, self.zscores, n_regions) # mean z-score of every area
+        else:
+            vals = self.atlas_index.region_nanmeans(self.subject_data) # mean value of every area
+            zs = self.atlas_index.region_nanmeans(self.zscores) # mean z-score of every area
 
-        vals = pd.Series(vals,index = np.arange(1,self.atlas_data.max()+1)) # create values series
-        zs_s = pd.Series(zs,index = np.arange(1,self.atlas_data.max()+1)) # create zscore series
+        vals = pd.Series(vals,index = np.arange(1,n_regions+1)) # create values series
+        zs_s = pd.Series(zs,index = np.arange(1,n_regions+1)) # create zscore series
         self.area_data = pd.DataFrame({'Values': vals, 'Z-scores': zs_s}) # create dataframe from both
         self.area_data.index.name = 'Area' # change index name to area
 
@@ -93,3 +299,121 @@ class SubjectAnalyzer:
             index, data = row
             temp.append([index] + data.tolist())
         self.table = temp
+
+
+class BatchSubjectAnalyzer:
+    '''
+    Analyzes many subjects against one reference (mean, sd and atlas).
+    The reference maps are loaded once; subjects are z-scored as a (subjects x voxels) block,
+    batch_size subjects at a time, and their atlas results are gathered into one subjects-by-areas table.
+    '''
+
+    def __init__(self,mean_nii_path,sd_nii_path,atlas_nii_path,batch_size=32,output_dir='.',atlas_cache_dir=None,
+                 dtype=np.float32,robust=False,resample=False):
+        self.dtype = np.dtype(dtype) # float type of the (subjects x voxels) blocks
+        self.robust = robust # the reference maps are the median and MAD, see SubjectAnalyzer
+        self.resample = resample # interpolate subjects on other grids onto the mean map's grid
+        self.mean_nii_path = mean_nii_path
+        self.sd_nii_path = sd_nii_path
+        self.atlas_nii_path = atlas_nii_path
+        self.batch_size = batch_size
+        self.output_dir = pl.Path(output_dir)
+        self.load_reference(atlas_cache_dir)
+
+    def load_reference(self, atlas_cache_dir=None):
+        # Load the mean and sd of the "population" once, as flat arrays with nan instead of zeros:
+        self.mean_img = nib.load(self.mean_nii_path)
+        self.sd_img = nib.load(self.sd_nii_path)
+        self.shape = self.mean_img.shape
+        if self.sd_img.shape != self.shape:
+            raise RuntimeError('the st. dev. map has a dimension mismatch with the mean map')
+        self.mean_data = np.asanyarray(self.mean_img.dataobj).astype(self.dtype).reshape(-1)
+        self.sd_data = np.asanyarray(self.sd_img.dataobj).astype(self.dtype).reshape(-1)
+        self.mean_data[self.mean_data == 0] = np.nan
+        self.sd_data[self.sd_data == 0] = np.nan
+        self.atlas_index = AtlasIndex.from_file(self.atlas_nii_path, cache_dir=atlas_cache_dir)
+        if self.atlas_index.shape != self.shape:
+            raise RuntimeError('the atlas has a dimension mismatch with the mean map')
+
+    @staticmethod
+    def subject_name(subject_nii_path):
+        name = pl.Path(subject_nii_path).name
+        for extension in ('.nii.gz', '.nii'):
+            if name.endswith(extension):
+                return name[:-len(extension)]
+        return name
+
+    def run(self, subjects):
+        '''
+        :param subjects: list of subjects' nifti files, or a folder that contains them
+        :return: subjects-by-areas table, with a 'Values' and a 'Z-scores' column per area
+        '''
+        if isinstance(subjects, (str, pl.Path)) and pl.Path(subjects).is_dir():
+            subjects = sorted(x for x in pl.Path(subjects).iterdir() if x.name.endswith(('.nii', '.nii.gz')))
+        subjects = list(subjects)
+        self.output_dir.mkdir(parents=True, exist_ok=True)
+        self.errors = {} # subject name -> error message, for subjects that could not be analyzed
+        names, values, zscores = [], [], []
+        for start in range(0, len(subjects), self.batch_size):
+            batch_names, batch_values, batch_zscores = self.analyze_batch(subjects[start:start + self.batch_size])
+            names += batch_names
+            values.append(batch_values)
+            zscores.append(batch_zscores)
+
+        areas = pd.Index(np.arange(1, self.atlas_index.n_regions + 1), name='Area')
+        subjects_index = pd.Index(names, name='Subject')
+        empty = np.empty((0, len(areas)))
+        self.region_values = pd.DataFrame(np.concatenate(values) if values else empty,
+                                          index=subjects_index, columns=areas)
+        self.region_zscores = pd.DataFrame(np.concatenate(zscores) if zscores else empty,
+                                           index=subjects_index, columns=areas)
+        self.table = pd.concat({'Values': self.region_values, 'Z-scores': self.region_zscores}, axis=1)
+        return self.table
+
+    def analyze_batch(self, subject_paths):
+        '''
+        z-scores a batch of subjects as one (subjects x voxels) block and saves their significant z-maps.
+        Subjects that cannot be read are left out and recorded in self.errors, like mismatched ones.
+        :return: the names of the analyzed subjects and their (subjects x areas) mean values and z-scores
+        '''
+        loaded = []
+        for subject_nii_path in subject_paths:
+            name = self.subject_name(subject_nii_path)
+            try:
+                img = nib.load(str(subject_nii_path))
+                if self.resample and len(img.shape) == 3 and \
+                        (img.shape != self.shape or not np.allclose(img.affine, self.mean_img.affine)):
+                    resampling_map = ResamplingMap.get(img.affine, img.shape, self.mean_img.affine, self.shape)
+                    img = nib.Nifti1Image(resampling_map.apply(np.asanyarray(img.dataobj), dtype=self.dtype,
+                                                               missing=0), self.mean_img.affine)
+            except READ_ERRORS as error:
+                self.errors[name] = f'the subject could not be read: {error}'
+                continue
+            if img.shape != self.shape:
+                self.errors[name] = 'the subject has a dimension mismatch with the mean map'
+                continue
+            loaded.append((name, img))
+
+        block = np.empty((len(loaded), self.mean_data.size), dtype=self.dtype) # subjects x voxels
+        names, images = [], []
+        for name, img in loaded:
+            try: # the data of a truncated file only fails here
+                block[len(names)] = np.asanyarray(img.dataobj).reshape(-1)
+            except READ_ERRORS as error:
+                self.errors[name] = f'the subject could not be read: {error}'
+                continue
+            names.append(name)
+            images.append(img)
+        block = block[:len(names)]
+        block[block == 0] = np.nan
+        zscores = block - self.mean_data
+        zscores /= self.sd_data
+        if self.robust:
+            zscores /= self.dtype.type(MAD_TO_SD)
+        zscores[np.isnan(zscores)] = 0
+
+        for name, img, subject_zscores in zip(names, images, zscores):
+            significant = np.where(np.abs(subject_zscores) <= 1.96, np.nan, subject_zscores)
+            nib.save(nib.Nifti1Image(significant.reshape(self.shape), img.affine),
+                     str(self.output_dir / f'{name}_zs.nii.gz'))
+        return names, self.atlas_index.region_nanmeans(block), self.atlas_index.region_nanmeans(zscores)
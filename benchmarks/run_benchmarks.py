@@ -0,0 +1,231 @@
+'''
+Times every analysis stage on synthetic data and writes the results to a JSON baseline.
+
+    python -m benchmarks.run_benchmarks --output bench_baseline.json
+    python -m benchmarks.run_benchmarks --compare bench_baseline.json
+
+Every benchmark is run --repeat times for its wall time (best and median are kept), and once more under
+tracemalloc for its peak memory. SubjectAnalyzer is timed cold (new atlas index and image caches every
+run) and warm (cache hits) as separate benchmarks. With --compare, the results are checked against an
+earlier baseline and the exit status is 1 if a benchmark got slower than --threshold times its baseline
+time.
+'''
+import argparse
+import json
+import os
+import platform
+import statistics
+import sys
+import tempfile
+import time
+import tracemalloc
+import pathlib as pl
+from datetime import datetime
+
+import numpy as np
+
+from PythonHackathon.GroupStatistics import GroupStatistics
+from PythonHackathon.zscores import SubjectAnalyzer
+from PythonHackathon.table_create import Table
+from PythonHackathon.atlas_index import AtlasIndex
+from benchmarks import synthetic
+
+
+class StageTimer:
+    '''
+    SubjectAnalyzer progress callback that times the stages: each stage ends when the next one starts
+    '''
+
+    def __init__(self, trace_memory=False):
+        self.trace_memory = trace_memory
+        self.wall = {}
+        self.peak_memory = {}
+        self._stage = None
+
+    def __call__(self, stage):
+        self._close()
+        self._stage = stage
+        if self.trace_memory:
+            tracemalloc.reset_peak()
+            self._memory_at_start = tracemalloc.get_traced_memory()[0]
+        self._start = time.perf_counter()
+
+    def _close(self):
+        if self._stage is None:
+            return
+        self.wall[self._stage] = time.perf_counter() - self._start
+        if self.trace_memory:
+            self.peak_memory[self._stage] = tracemalloc.get_traced_memory()[1] - self._memory_at_start
+        self._stage = None
+
+    def finish(self):
+        self._close()
+        return self
+
+
+def measure(function, trace_memory):
+    '''
+    :param function: function() -> {name: seconds} of its parts, or None to time the whole call
+    :return: ({name: wall seconds}, {name: peak bytes} or {})
+    '''
+    if trace_memory:
+        tracemalloc.start()
+        tracemalloc.reset_peak()
+    try:
+        start = time.perf_counter()
+        timer = function()
+        wall = time.perf_counter() - start
+        if timer is None:
+            return {'': wall}, ({'': tracemalloc.get_traced_memory()[1]} if trace_memory else {})
+        return timer.wall, timer.peak_memory
+    finally:
+        if trace_memory:
+            tracemalloc.stop()
+
+
+def run_benchmark(name, function, repeat, config):
+    '''
+    Runs a benchmark repeat times plus once for its memory
+    :return: list of result dicts, one per timed part
+    '''
+    walls = [measure(function, trace_memory=False)[0] for _ in range(repeat)]
+    _, peaks = measure(function, trace_memory=True)
+    results = []
+    for part in walls[0]:
+        times = [wall[part] for wall in walls]
+        results.append(dict(config, name=f'{name}.{part}' if part else name,
+                            wall_best=min(times), wall_median=statistics.median(times),
+                            peak_bytes=peaks.get(part)))
+    return results
+
+
+def group_statistics_benchmarks(work_dir, resolution, n_subjects, repeat, workers):
+    paths = synthetic.write_dataset(work_dir, resolution, n_labels=1, n_subjects=n_subjects)
+    config = {'resolution': resolution, 'subjects': n_subjects, 'workers': workers}
+    results = []
+    for mode in ['stacked', 'streaming']:
+        def run():
+            GroupStatistics(str(paths['subjects']), workers=workers).run(streaming=mode == 'streaming')
+        results += run_benchmark(f'group_statistics.run.{mode}', run, repeat, config)
+    return results
+
+
+def subject_analyzer_benchmarks(work_dir, resolution, n_labels, repeat, masked):
+    paths = synthetic.write_dataset(work_dir, resolution, n_labels=n_labels, n_subjects=1)
+    config = {'resolution': resolution, 'labels': n_labels, 'masked': masked}
+    outputs = {}
+
+    def analyze(cache_dir):
+        timer = StageTimer(trace_memory=tracemalloc.is_tracing())
+        analyzer = SubjectAnalyzer(paths['subject_paths'][0], paths['mean'], paths['sd'], paths['atlas'],
+                                   atlas_cache_dir=str(cache_dir / 'atlas_cache'), progress=timer,
+                                   image_cache_dir=str(cache_dir / 'image_cache'), masked=masked)
+        timer.finish()
+        outputs['area_data'] = analyzer.area_data
+        return timer
+
+    def cold():
+        # new atlas index and image caches every run: the atlas is indexed and the glass brain rendered
+        with AtlasIndex._lock:
+            AtlasIndex._memory_cache.clear() # indices already built in this process
+        return analyze(pl.Path(tempfile.mkdtemp(prefix='cache_', dir=str(work_dir))))
+
+    def warm():
+        # caches filled by an earlier run: the atlas index and the image are cache hits
+        return analyze(work_dir / 'warm_cache')
+
+    def frame_to_list():
+        Table(outputs['area_data']).frame_to_list()
+
+    results = run_benchmark('subject_analyzer.cold', cold, repeat, config)
+    warm() # fills the warm caches
+    results += run_benchmark('subject_analyzer.warm', warm, repeat, config)
+    results += run_benchmark('table.frame_to_list', frame_to_list, repeat, config)
+    return results
+
+
+def environment():
+    return {'date': datetime.now().isoformat(timespec='seconds'), 'python': platform.python_version(),
+            'numpy': np.__version__, 'platform': platform.platform(), 'cpus': os.cpu_count()}
+
+
+def result_key(result):
+    return tuple(sorted((k, str(v)) for k, v in result.items()
+                        if k not in ('wall_best', 'wall_median', 'peak_bytes')))
+
+
+def compare(results, baseline, threshold):
+    '''
+    Prints every benchmark's time and memory relative to the baseline
+    :return: the results that are slower than threshold times their baseline
+    '''
+    baseline_results = {result_key(result): result for result in baseline['results']}
+    regressions = []
+    for result in results:
+        old = baseline_results.get(result_key(result))
+        if old is None:
+            print(f'{result["name"]:45} new benchmark')
+            continue
+        ratio = result['wall_best'] / max(old['wall_best'], 1e-9)
+        memory = ''
+        if result['peak_bytes'] is not None and old.get('peak_bytes'):
+            memory = f'  memory x{result["peak_bytes"] / old["peak_bytes"]:.2f}'
+        flag = '  SLOWER' if ratio > threshold else ''
+        print(f'{result["name"]:45} {describe(result):28} time x{ratio:.2f}{memory}{flag}')
+        if ratio > threshold:
+            regressions.append(result)
+    return regressions
+
+
+def describe(result):
+    return ' '.join(f'{k}={result[k]}' for k in ('resolution', 'labels', 'subjects', 'masked') if k in result)
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description='Benchmarks of the analysis stages on synthetic data')
+    parser.add_argument('--resolutions', nargs='+', default=['4mm', '2mm'], choices=sorted(synthetic.RESOLUTIONS))
+    parser.add_argument('--labels', nargs='+', type=int, default=[100, 400], help='atlas sizes')
+    parser.add_argument('--subjects', type=int, default=20, help='subjects of the group statistics')
+    parser.add_argument('--workers', type=int, default=1, help='loader threads of the group statistics')
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--output', help='JSON file to write the results to')
+    parser.add_argument('--compare', help='JSON baseline to compare the results with')
+    parser.add_argument('--threshold', type=float, default=1.2, help='slowdown ratio reported as a regression')
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    results = []
+    cwd = os.getcwd()
+    with tempfile.TemporaryDirectory(prefix='pyhack_bench_') as tmp:
+        tmp = pl.Path(tmp)
+        os.chdir(tmp) # the analyses write their outputs to the working directory
+        try:
+            for resolution in args.resolutions:
+                results += group_statistics_benchmarks(tmp / f'group_{resolution}', resolution, args.subjects,
+                                                       args.repeat, args.workers)
+                for n_labels in args.labels:
+                    for masked in [False, True]:
+                        results += subject_analyzer_benchmarks(tmp / f'subject_{resolution}_{n_labels}_{masked}',
+                                                               resolution, n_labels, args.repeat, masked)
+        finally:
+            os.chdir(cwd)
+
+    for result in results:
+        memory = f'{result["peak_bytes"] / 2 ** 20:8.1f} MB' if result['peak_bytes'] is not None else ''
+        print(f'{result["name"]:45} {describe(result):28} {result["wall_best"] * 1000:9.1f} ms {memory}')
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump({'environment': environment(), 'results': results}, f, indent=1)
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        print(f'\ncompared with {args.compare} ({baseline["environment"]["date"]})')
+        if compare(results, baseline, args.threshold):
+            return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,89 @@
+import numpy as np
+import nibabel as nib
+
+
+# MNI grid shapes of the usual resolutions
+RESOLUTIONS = {
+    '4mm': (45, 54, 45),
+    '2mm': (91, 109, 91),
+    '1mm': (182, 218, 182),
+}
+
+
+def affine(resolution):
+    voxel_size = float(resolution.rstrip('m'))
+    return np.diag([voxel_size, voxel_size, voxel_size, 1.0])
+
+
+def brain_mask(shape):
+    '''
+    Ellipsoid "brain" that fills most of the grid, like a skull stripped MNI volume
+    '''
+    grid = np.ogrid[tuple(slice(0, n) for n in shape)]
+    distance = sum(((x - (n - 1) / 2) / (0.45 * n)) ** 2 for x, n in zip(grid, shape))
+    return distance <= 1
+
+
+def make_atlas(shape, n_labels):
+    '''
+    Atlas of n_labels compact areas: the brain is cut into a regular grid of blocks, and the blocks
+    inside the brain are numbered 1..n_labels (wrapping around when there are more blocks than labels)
+    '''
+    mask = brain_mask(shape)
+    cells = int(np.ceil(n_labels ** (1 / 3)))
+    while True:
+        ix, iy, iz = np.meshgrid(*[np.arange(n) * cells // n for n in shape], indexing='ij')
+        blocks = (ix * cells + iy) * cells + iz
+        _, block_numbers = np.unique(blocks[mask], return_inverse=True)
+        if block_numbers.max() + 1 >= n_labels or cells >= min(shape):
+            break
+        cells += 1 # some blocks are outside the brain, use smaller ones
+    atlas = np.zeros(shape, dtype=np.int16)
+    atlas[mask] = block_numbers % n_labels + 1
+    return atlas
+
+
+def make_reference(shape, seed=0):
+    '''
+    Mean and sd maps of a control group (0 outside the brain, like GroupStatistics output)
+    '''
+    rng = np.random.RandomState(seed)
+    mask = brain_mask(shape)
+    mean = np.where(mask, rng.normal(100, 10, size=shape), 0)
+    sd = np.where(mask, rng.uniform(5, 15, size=shape), 0)
+    return mean, sd
+
+
+def make_subject(shape, seed):
+    '''
+    One subject's map, with a lesion-like cluster of low values
+    '''
+    rng = np.random.RandomState(seed)
+    mask = brain_mask(shape)
+    data = np.where(mask, rng.normal(100, 12, size=shape), 0)
+    center = [n // 3 for n in shape]
+    lesion = tuple(slice(c, c + max(n // 10, 1)) for c, n in zip(center, shape))
+    data[lesion] *= 0.6
+    return data
+
+
+def write_dataset(folder, resolution='2mm', n_labels=100, n_subjects=1, seed=0):
+    '''
+    Writes a deterministic dataset: mean.nii.gz, sd.nii.gz, atlas.nii.gz and subjects/subject_XXX.nii.gz
+    :return: dict with the paths ('mean', 'sd', 'atlas', 'subjects' folder and 'subject_paths')
+    '''
+    shape = RESOLUTIONS[resolution]
+    folder.mkdir(parents=True, exist_ok=True)
+    subjects_folder = folder / 'subjects'
+    subjects_folder.mkdir(exist_ok=True)
+    mean, sd = make_reference(shape, seed)
+    paths = {'subjects': subjects_folder, 'subject_paths': []}
+    for name, data in [('mean', mean), ('sd', sd), ('atlas', make_atlas(shape, n_labels))]:
+        paths[name] = str(folder / f'{name}.nii.gz')
+        nib.save(nib.Nifti1Image(data.astype(np.float32) if name != 'atlas' else data, affine(resolution)),
+                 paths[name])
+    for i in range(n_subjects):
+        path = str(subjects_folder / f'subject_{i:03d}.nii.gz')
+        nib.save(nib.Nifti1Image(make_subject(shape, seed + 1 + i).astype(np.float32), affine(resolution)), path)
+        paths['subject_paths'].append(path)
+    return paths
@@ -39,7 +39,12 @@ setup(
     include_package_data=True,
     keywords='PythonHackathon_Mos',
     name='PythonHackathon_Mos',
-    packages=find_packages(include=['PythonHackathon_Mos']),
+    packages=find_packages(include=['PythonHackathon']),
+    entry_points={
+        'console_scripts': [
+            'pyhack-batch=PythonHackathon.batch_cli:main',
+        ],
+    },
     setup_requires=setup_requirements,
     test_suite='tests',
     tests_require=test_requirements,
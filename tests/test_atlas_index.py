@@ -0,0 +1,42 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Tests for the `atlas_index` module."""
+
+import numpy as np
+import nibabel as nib
+from Pyhack.PythonHackathon.atlas_index import AtlasIndex
+from Pyhack.PythonHackathon.zscores import region_nanmeans
+
+
+def make_atlas(shape=(6, 7, 5), n_labels=12, seed=0):
+    atlas = np.random.RandomState(seed).randint(0, n_labels, size=shape).astype(np.int16)
+    atlas[atlas == 4] = 0 # area 4 is missing from the atlas
+    return atlas
+
+
+class TestAtlasIndex:
+
+    def test_region_nanmeans_matches_bincount(self):
+        atlas = make_atlas()
+        values = np.random.RandomState(1).normal(size=atlas.shape)
+        values[::2, 1, :] = np.nan
+        index = AtlasIndex.from_data(atlas)
+        assert index.n_regions == atlas.max()
+        assert index.label_to_row[4] == -1
+        assert index.counts.sum() == np.count_nonzero(atlas)
+        expected = region_nanmeans(atlas, values, int(atlas.max()))
+        assert np.allclose(index.region_nanmeans(values), expected, equal_nan=True)
+
+    def test_from_file_is_cached_on_disk(self, tmp_path):
+        atlas = make_atlas()
+        atlas_path = str(tmp_path / 'atlas.nii.gz')
+        nib.save(nib.Nifti1Image(atlas, np.eye(4)), atlas_path)
+        cache_dir = tmp_path / 'cache'
+        index = AtlasIndex.from_file(atlas_path, cache_dir=cache_dir)
+        cached = list(cache_dir.glob('*.npz'))
+        assert len(cached) == 1
+        reloaded = AtlasIndex.load(cached[0])
+        assert np.array_equal(reloaded.voxels, index.voxels)
+        assert np.array_equal(reloaded.offsets, index.offsets)
+        assert AtlasIndex.from_file(atlas_path, cache_dir=cache_dir) is index
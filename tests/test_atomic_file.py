@@ -0,0 +1,42 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Tests for the `atomic_file` module."""
+
+import threading
+
+import pytest
+from Pyhack.PythonHackathon.atomic_file import atomic_write
+
+
+class TestAtomicWrite:
+
+    def test_threads_writing_one_file(self, tmp_path):
+        filename = tmp_path / 'out.txt'
+        barrier = threading.Barrier(8)
+
+        def write(i):
+            with atomic_write(filename) as tmp_filename:
+                barrier.wait() # every thread holds its temporary file at once
+                with open(tmp_filename, 'w') as f:
+                    f.write(str(i) * 1000)
+
+        threads = [threading.Thread(target=write, args=(i,)) for i in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        content = filename.read_text()
+        assert len(content) == 1000 and len(set(content)) == 1
+        assert [p.name for p in tmp_path.iterdir()] == ['out.txt']
+
+    def test_error_keeps_the_old_file(self, tmp_path):
+        filename = tmp_path / 'out.txt'
+        filename.write_text('old')
+        with pytest.raises(ValueError):
+            with atomic_write(filename) as tmp_filename:
+                with open(tmp_filename, 'w') as f:
+                    f.write('new')
+                raise ValueError
+        assert filename.read_text() == 'old'
+        assert [p.name for p in tmp_path.iterdir()] == ['out.txt']
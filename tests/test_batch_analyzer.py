@@ -0,0 +1,84 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Tests for `zscores.BatchSubjectAnalyzer`."""
+
+import numpy as np
+import nibabel as nib
+from Pyhack.PythonHackathon import zscores
+
+
+def make_reference(folder, shape=(5, 4, 3), n_labels=6, seed=0):
+    rng = np.random.RandomState(seed)
+    paths = {}
+    for name, data in [('mean', rng.normal(100, 5, size=shape)),
+                       ('sd', rng.uniform(5, 10, size=shape)),
+                       ('atlas', rng.randint(0, n_labels + 1, size=shape).astype(np.int16))]:
+        paths[name] = str(folder / f'{name}.nii.gz')
+        nib.save(nib.Nifti1Image(data, np.eye(4)), paths[name])
+    return paths
+
+
+class TestBatchSubjectAnalyzer:
+
+    def test_batch_matches_single_subject_math(self, tmp_path):
+        paths = make_reference(tmp_path)
+        mean = nib.load(paths['mean']).get_fdata()
+        sd = nib.load(paths['sd']).get_fdata()
+        atlas = np.asanyarray(nib.load(paths['atlas']).dataobj)
+        subjects_folder = tmp_path / 'subjects'
+        subjects_folder.mkdir()
+        rng = np.random.RandomState(1)
+        subjects = {}
+        for i in range(5):
+            data = rng.normal(100, 15, size=mean.shape)
+            data[0, 0, i % 3] = 0
+            subjects[f'sub{i}'] = data
+            nib.save(nib.Nifti1Image(data, np.eye(4)), str(subjects_folder / f'sub{i}.nii.gz'))
+        nib.save(nib.Nifti1Image(np.ones((2, 2, 2)), np.eye(4)), str(subjects_folder / 'wrong.nii.gz'))
+
+        batch = zscores.BatchSubjectAnalyzer(paths['mean'], paths['sd'], paths['atlas'], batch_size=2,
+                                             output_dir=str(tmp_path / 'out'), atlas_cache_dir=tmp_path / 'cache')
+        table = batch.run(str(subjects_folder))
+        assert list(table.index) == [f'sub{i}' for i in range(5)]
+        assert list(batch.errors) == ['wrong']
+
+        n_regions = int(atlas.max())
+        for name, data in subjects.items():
+            data = np.where(data == 0, np.nan, data)
+            z = np.nan_to_num((data - mean) / sd)
+            assert np.allclose(batch.region_values.loc[name], zscores.region_nanmeans(atlas, data, n_regions),
+                               atol=1e-4, equal_nan=True)
+            assert np.allclose(batch.region_zscores.loc[name], zscores.region_nanmeans(atlas, z, n_regions), atol=1e-4)
+            saved = nib.load(str(tmp_path / 'out' / f'{name}_zs.nii.gz')).get_fdata()
+            assert np.allclose(saved, np.where(np.abs(z) <= 1.96, np.nan, z), atol=1e-4, equal_nan=True)
+
+    def test_resampled_subject(self, tmp_path):
+        paths = make_reference(tmp_path, shape=(4, 4, 4))
+        nib.save(nib.Nifti1Image(np.full((8, 8, 8), 100.0), np.diag([0.5, 0.5, 0.5, 1.0])),
+                 str(tmp_path / 'fine.nii.gz'))
+        batch = zscores.BatchSubjectAnalyzer(paths['mean'], paths['sd'], paths['atlas'], output_dir=tmp_path / 'out',
+                                             atlas_cache_dir=tmp_path / 'cache', resample=True)
+        table = batch.run([tmp_path / 'fine.nii.gz'])
+        assert batch.errors == {} and list(table.index) == ['fine']
+        zs = nib.load(str(tmp_path / 'out' / 'fine_zs.nii.gz'))
+        assert zs.shape == (4, 4, 4) and np.allclose(zs.affine, np.eye(4))
+
+    def test_unreadable_subjects_do_not_fail_the_batch(self, tmp_path):
+        paths = make_reference(tmp_path)
+        subjects_folder = tmp_path / 'subjects'
+        subjects_folder.mkdir()
+        rng = np.random.RandomState(2)
+        for name in ('a', 'c', 'd'):
+            nib.save(nib.Nifti1Image(rng.normal(100, 15, size=(5, 4, 3)), np.eye(4)),
+                     str(subjects_folder / f'{name}.nii.gz'))
+        (subjects_folder / 'b.nii.gz').write_bytes(b'not a nifti file')
+        content = (subjects_folder / 'd.nii.gz').read_bytes()
+        (subjects_folder / 'd.nii.gz').write_bytes(content[:len(content) // 2]) # truncated
+
+        batch = zscores.BatchSubjectAnalyzer(paths['mean'], paths['sd'], paths['atlas'], batch_size=4,
+                                             output_dir=str(tmp_path / 'out'), atlas_cache_dir=tmp_path / 'cache')
+        table = batch.run(str(subjects_folder))
+        assert list(table.index) == ['a', 'c']
+        assert sorted(batch.errors) == ['b', 'd']
+        assert (tmp_path / 'out' / 'c_zs.nii.gz').exists()
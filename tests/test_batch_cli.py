@@ -0,0 +1,92 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Tests for the `batch_cli` module."""
+
+import numpy as np
+import pandas as pd
+import pytest
+import nibabel as nib
+from Pyhack.PythonHackathon import batch_cli
+
+
+def make_scans(folder, n, shape=(5, 4, 3), seed=1):
+    folder.mkdir()
+    rng = np.random.RandomState(seed)
+    for i in range(n):
+        nib.save(nib.Nifti1Image(rng.normal(100, 15, size=shape), np.eye(4)), str(folder / f'sub{i}.nii.gz'))
+    return sorted(folder.iterdir())
+
+
+class TestBatchCli:
+
+    def test_zscore_skips_complete_subjects(self, tmp_path, capsys):
+        controls = make_scans(tmp_path / 'controls', 4)
+        assert batch_cli.main(['group', str(controls[0].parent), '--output-dir', str(tmp_path / 'reference')]) == 0
+        atlas = str(tmp_path / 'atlas.nii.gz')
+        nib.save(nib.Nifti1Image(np.random.RandomState(0).randint(0, 4, size=(5, 4, 3)).astype(np.int16),
+                                 np.eye(4)), atlas)
+        scans = make_scans(tmp_path / 'scans', 3, seed=2)
+        manifest = tmp_path / 'manifest.txt'
+        manifest.write_text('# backfill\n' + '\n'.join(f'scans/{x.name}' for x in scans[:2]) + '\n')
+        args = ['zscore', '--mean', str(tmp_path / 'reference' / 'data_mean.nii.gz'),
+                '--sd', str(tmp_path / 'reference' / 'data_std.nii.gz'), '--atlas', atlas,
+                '--output-dir', str(tmp_path / 'out'), '--workers', '2', '--batch-size', '1']
+
+        assert batch_cli.main(args + ['--manifest', str(manifest)]) == 0
+        assert '2 analyzed, 0 skipped' in capsys.readouterr().out
+        regions = pd.read_csv(tmp_path / 'out' / 'sub0_regions.csv', index_col='Area')
+        assert list(regions.columns) == ['Values', 'Z-scores'] and list(regions.index) == [1, 2, 3]
+        assert (tmp_path / 'out' / 'sub1_zs.nii.gz').exists()
+
+        assert batch_cli.main(args + ['--subjects', str(tmp_path / 'scans')]) == 0
+        assert '1 analyzed, 2 skipped' in capsys.readouterr().out
+
+    def test_missing_and_same_name_subjects(self, tmp_path, capsys):
+        controls = make_scans(tmp_path / 'controls', 3)
+        assert batch_cli.main(['group', str(controls[0].parent), '--output-dir', str(tmp_path / 'reference')]) == 0
+        atlas = str(tmp_path / 'atlas.nii.gz')
+        nib.save(nib.Nifti1Image(np.ones((5, 4, 3), dtype=np.int16), np.eye(4)), atlas)
+        make_scans(tmp_path / 'a', 1)
+        make_scans(tmp_path / 'b', 1, seed=2)
+        args = ['zscore', '--mean', str(tmp_path / 'reference' / 'data_mean.nii.gz'),
+                '--sd', str(tmp_path / 'reference' / 'data_std.nii.gz'), '--atlas', atlas,
+                '--output-dir', str(tmp_path / 'out'), '--workers', '1']
+
+        manifest = tmp_path / 'manifest.txt'
+        manifest.write_text('a/sub0.nii.gz\nmissing.nii.gz\n')
+        assert batch_cli.main(args + ['--manifest', str(manifest)]) == 1 # the missing scan fails alone
+        out, err = capsys.readouterr()
+        assert '1 analyzed, 0 skipped, 1 failed' in out and 'missing:' in err
+        assert (tmp_path / 'out' / 'sub0_regions.csv').exists()
+
+        manifest.write_text('a/sub0.nii.gz\nb/sub0.nii.gz\n')
+        with pytest.raises(ValueError, match='sub0'):
+            batch_cli.main(args + ['--manifest', str(manifest)])
+
+    def test_group_adds_new_controls(self, tmp_path):
+        controls = make_scans(tmp_path / 'controls', 3)
+        output_dir = tmp_path / 'reference'
+        assert batch_cli.run_group(controls[0].parent, output_dir)['subjects'] == 3
+        nib.save(nib.Nifti1Image(np.ones((5, 4, 3)), np.eye(4)), str(controls[0].parent / 'sub9.nii.gz'))
+        assert batch_cli.run_group(controls[0].parent, output_dir)['subjects'] == 4
+        expected = np.mean([nib.load(str(x)).get_fdata() for x in controls[0].parent.iterdir()], axis=0)
+        assert np.allclose(nib.load(str(output_dir / 'data_mean.nii.gz')).get_fdata(), expected)
+        controls[1].unlink() # a deleted control makes the statistics be computed again
+        assert batch_cli.run_group(controls[0].parent, output_dir)['subjects'] == 3
+        expected = np.mean([nib.load(str(x)).get_fdata() for x in controls[0].parent.iterdir()], axis=0)
+        assert np.allclose(nib.load(str(output_dir / 'data_mean.nii.gz')).get_fdata(), expected)
+
+    def test_partial_and_merge(self, tmp_path):
+        node_a = make_scans(tmp_path / 'node_a', 2)
+        node_b = make_scans(tmp_path / 'node_b', 3, seed=2)
+        for i, x in enumerate(node_b):
+            node_b[i] = x.rename(x.with_name('b_' + x.name))
+        manifest = tmp_path / 'node_b.txt'
+        manifest.write_text('\n'.join(f'node_b/{x.name}' for x in node_b))
+        assert batch_cli.main(['partial', str(tmp_path / 'node_a'), '--output', str(tmp_path / 'a.npz')]) == 0
+        assert batch_cli.main(['partial', '--manifest', str(manifest), '--output', str(tmp_path / 'b.npz')]) == 0
+        assert batch_cli.main(['merge', str(tmp_path / 'a.npz'), str(tmp_path / 'b.npz'),
+                               '--output-dir', str(tmp_path / 'reference')]) == 0
+        expected = np.std([nib.load(str(x)).get_fdata() for x in node_a + node_b], axis=0)
+        assert np.allclose(nib.load(str(tmp_path / 'reference' / 'data_std.nii.gz')).get_fdata(), expected)
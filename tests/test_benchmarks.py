@@ -0,0 +1,47 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Tests for the benchmarks and their synthetic data."""
+
+import importlib
+import json
+import pathlib
+
+import numpy as np
+import nibabel as nib
+from Pyhack.benchmarks import synthetic
+
+
+class TestSynthetic:
+
+    def test_atlas_has_every_label(self):
+        atlas = synthetic.make_atlas(synthetic.RESOLUTIONS['4mm'], 100)
+        assert set(np.unique(atlas)) == set(range(101))
+        assert np.all(atlas[~synthetic.brain_mask(atlas.shape)] == 0)
+
+    def test_dataset_is_deterministic(self, tmp_path):
+        first = synthetic.write_dataset(tmp_path / 'a', '4mm', n_labels=10, n_subjects=2)
+        second = synthetic.write_dataset(tmp_path / 'b', '4mm', n_labels=10, n_subjects=2)
+        for a, b in zip([first['mean'], first['sd']] + first['subject_paths'],
+                        [second['mean'], second['sd']] + second['subject_paths']):
+            assert np.array_equal(nib.load(a).get_fdata(), nib.load(b).get_fdata())
+        subjects = [nib.load(path).get_fdata() for path in first['subject_paths']]
+        assert not np.array_equal(subjects[0], subjects[1])
+        assert nib.load(first['atlas']).shape == synthetic.RESOLUTIONS['4mm']
+
+
+class TestRunBenchmarks:
+
+    def test_tiny_run_and_compare(self, tmp_path, monkeypatch, capsys):
+        # run_benchmarks imports the package as the Makefile runs it, from the repository's root
+        monkeypatch.syspath_prepend(str(pathlib.Path(__file__).parents[1]))
+        run_benchmarks = importlib.import_module('benchmarks.run_benchmarks')
+        args = ['--resolutions', '4mm', '--labels', '10', '--subjects', '2', '--repeat', '2']
+        assert run_benchmarks.main(args + ['--output', str(tmp_path / 'baseline.json')]) == 0
+        with open(tmp_path / 'baseline.json') as f:
+            names = {result['name'] for result in json.load(f)['results']}
+        assert {'group_statistics.run.streaming', 'subject_analyzer.cold.render', 'subject_analyzer.warm.render',
+                'table.frame_to_list'} <= names
+        assert run_benchmarks.main(args + ['--compare', str(tmp_path / 'baseline.json'),
+                                           '--threshold', '1000']) == 0
+        assert 'compared with' in capsys.readouterr().out
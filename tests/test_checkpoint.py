@@ -0,0 +1,88 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Tests for the `checkpoint` module."""
+
+import os
+from Pyhack.PythonHackathon.checkpoint import Checkpoints
+
+
+def write(path, text):
+    path.write_text(text)
+    return str(path)
+
+
+class TestCheckpoints:
+
+    def test_rerun_skips_valid_stages(self, tmp_path):
+        source = write(tmp_path / 'dwi.nii', 'series')
+        calls = []
+
+        def stage(name):
+            def compute():
+                calls.append(name)
+                return {'out': write(tmp_path / f'{name}.nii', name + str(len(calls)))}
+            return compute
+
+        first = Checkpoints(tmp_path)
+        mask = first.run('segmentation', [source], {'dilate': 2}, stage('mask'))['out']
+        first.run('eddy', [source, mask], {}, stage('eddy'))
+        assert [x['status'] for x in first.report] == ['recomputed', 'recomputed']
+
+        second = Checkpoints(tmp_path) # a new run, after a crash
+        assert second.run('segmentation', [source], {'dilate': 2}, stage('mask'))['out'] == mask
+        second.run('eddy', [source, mask], {}, stage('eddy'))
+        assert calls == ['mask', 'eddy']
+        assert second.summary()[0].startswith('segmentation: hit')
+
+        third = Checkpoints(tmp_path) # a changed parameter invalidates the stage
+        third.run('segmentation', [source], {'dilate': 3}, stage('mask'))
+        assert calls == ['mask', 'eddy', 'mask']
+
+    def test_changed_input_or_output_is_recomputed(self, tmp_path):
+        source = write(tmp_path / 'dwi.nii', 'series')
+        output = tmp_path / 'mask.nii'
+        compute = lambda: {'out': write(output, 'mask')}
+        Checkpoints(tmp_path).run('segmentation', [source], {}, compute)
+
+        write(tmp_path / 'dwi.nii', 'other series')
+        checkpoints = Checkpoints(tmp_path)
+        checkpoints.run('segmentation', [source], {}, compute)
+        assert checkpoints.report[0]['status'] == 'recomputed'
+
+        os.remove(output)
+        checkpoints = Checkpoints(tmp_path)
+        checkpoints.run('segmentation', [source], {}, compute)
+        assert checkpoints.report[0]['status'] == 'recomputed'
+
+    def test_touched_input_with_same_content_is_a_hit(self, tmp_path):
+        source = write(tmp_path / 'dwi.nii', 'series')
+        compute = lambda: {'out': write(tmp_path / 'mask.nii', 'mask')}
+        Checkpoints(tmp_path).run('segmentation', [source], {}, compute)
+        os.utime(source, ns=(0, 0))
+        checkpoints = Checkpoints(tmp_path)
+        checkpoints.run('segmentation', [source], {}, compute)
+        assert checkpoints.report[0]['status'] == 'hit'
+
+    def test_recompute_records_new_checkpoints(self, tmp_path):
+        source = write(tmp_path / 'dwi.nii', 'series')
+        compute = lambda: {'out': write(tmp_path / 'mask.nii', 'mask')}
+        Checkpoints(tmp_path).run('segmentation', [source], {}, compute)
+        forced = Checkpoints(tmp_path, recompute=True)
+        forced.run('segmentation', [source], {}, compute)
+        assert forced.report[0]['status'] == 'recomputed'
+        checkpoints = Checkpoints(tmp_path)
+        checkpoints.run('segmentation', [source], {}, compute)
+        assert checkpoints.report[0]['status'] == 'hit'
+
+    def test_outputs_of_a_valid_checkpoint(self, tmp_path):
+        source = write(tmp_path / 'in.txt', 'a')
+        output = tmp_path / 'out.txt'
+        Checkpoints(tmp_path).run('eddy', [source], {}, lambda: {'corrected': write(output, 'b')})
+        checkpoints = Checkpoints(tmp_path) # a resumed run
+        assert checkpoints.outputs('eddy', [source], {}) == {'corrected': str(output)}
+        assert checkpoints.outputs('eddy', [source], {'other': 1}) is None
+        assert checkpoints.outputs('eddy', [str(tmp_path / 'missing.txt')], {}) is None
+        assert checkpoints.outputs('tensor', [source], {}) is None
+        write(output, 'changed')
+        assert checkpoints.outputs('eddy', [source], {}) is None
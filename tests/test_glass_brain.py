@@ -0,0 +1,57 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Tests for the `glass_brain` module."""
+
+import os
+import struct
+import zlib
+import numpy as np
+from Pyhack.PythonHackathon import glass_brain
+
+
+def read_png(filename):
+    with open(filename, 'rb') as f:
+        content = f.read()
+    assert content[:8] == b'\x89PNG\r\n\x1a\n'
+    columns, rows = struct.unpack('>II', content[16:24])
+    idat_length = struct.unpack('>I', content[33:37])[0]
+    raw = np.frombuffer(zlib.decompress(content[41:41 + idat_length]), dtype=np.uint8)
+    return raw.reshape(rows, columns * 3 + 1)[:, 1:].reshape(rows, columns, 3)
+
+
+class TestGlassBrain:
+
+    def test_projections_keep_the_sign_of_the_largest_value(self):
+        zmap = np.full((3, 4, 5), np.nan)
+        zmap[1, 2, 3] = -4
+        zmap[2, 2, 3] = 3
+        sagittal, coronal, axial = glass_brain.signed_maximum_projections(zmap)
+        assert sagittal.shape == (4, 5) and coronal.shape == (3, 5) and axial.shape == (3, 4)
+        assert sagittal[2, 3] == -4
+        assert coronal[2, 3] == 3
+
+    def test_png_is_written_and_cached(self, tmp_path):
+        zmap = np.full((6, 7, 5), np.nan)
+        zmap[2, 3, 1] = 4.5
+        zmap[4, 1, 2] = -3
+        output = tmp_path / 'Z_map.png'
+        assert not glass_brain.plot_glass_brain(zmap, str(output), cache_dir=tmp_path / 'cache')
+        image = read_png(str(output))
+        assert np.array_equal(image, glass_brain.render(zmap))
+        assert glass_brain.plot_glass_brain(zmap, str(tmp_path / 'again.png'), cache_dir=tmp_path / 'cache')
+        assert not glass_brain.plot_glass_brain(zmap, str(output), vmax=6, cache_dir=tmp_path / 'cache')
+        assert len(list((tmp_path / 'cache').glob('*.png'))) == 2
+
+    def test_cache_is_bounded_by_bytes(self, tmp_path, monkeypatch):
+        zmap = np.zeros((6, 7, 5))
+        cache_dir = tmp_path / 'cache'
+        for vmax, last_used in [(5, 2000), (6, 1000)]: # the image of vmax=6 is the least recently used
+            glass_brain.plot_glass_brain(zmap, str(tmp_path / 'a.png'), vmax=vmax, cache_dir=cache_dir)
+            cached = cache_dir / (glass_brain.cache_key(zmap, 1.96, vmax) + '.png')
+            os.utime(cached, (last_used, last_used))
+        monkeypatch.setattr(glass_brain, 'max_cache_bytes', 2 * cached.stat().st_size)
+        glass_brain.plot_glass_brain(zmap, str(tmp_path / 'a.png'), vmax=7, cache_dir=cache_dir)
+        assert len(list(cache_dir.glob('*.png'))) == 2
+        assert glass_brain.plot_glass_brain(zmap, str(tmp_path / 'a.png'), vmax=5, cache_dir=cache_dir)
+        assert not glass_brain.plot_glass_brain(zmap, str(tmp_path / 'a.png'), vmax=6, cache_dir=cache_dir)
@@ -0,0 +1,226 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Tests for the `GroupStatistics` module."""
+
+import pytest
+import numpy as np
+import nibabel as nib
+from Pyhack.PythonHackathon.GroupStatistics import GroupStatistics, RunningStats, VoxelHistograms, partial_stats
+
+
+def make_group(folder, n_subjects=6, shape=(4, 5, 3), seed=0):
+    rng = np.random.RandomState(seed)
+    maps = rng.normal(100, 15, size=(n_subjects,) + shape)
+    for i, data in enumerate(maps):
+        nib.save(nib.Nifti1Image(data, np.eye(4)), str(folder / f'subject_{i:02d}.nii.gz'))
+    return maps
+
+
+class TestGroupStatistics:
+
+    def test_streaming_matches_stacked(self, tmp_path, monkeypatch):
+        data_folder = tmp_path / 'controls'
+        data_folder.mkdir()
+        maps = make_group(data_folder)
+        monkeypatch.chdir(tmp_path)
+        gs = GroupStatistics(str(data_folder))
+        gs.run(streaming=True)
+        assert gs.group_data is None
+        assert np.allclose(gs.data_mean, maps.mean(axis=0))
+        assert np.allclose(gs.data_std, maps.std(axis=0))
+
+        stacked = GroupStatistics(str(data_folder))
+        stacked.run()
+        assert np.allclose(gs.data_mean, stacked.data_mean)
+        assert np.allclose(gs.data_std, stacked.data_std)
+
+    def test_outputs_go_to_output_dir(self, tmp_path, monkeypatch):
+        data_folder = tmp_path / 'controls'
+        data_folder.mkdir()
+        make_group(data_folder, n_subjects=3)
+        monkeypatch.chdir(tmp_path)
+        gs = GroupStatistics(str(data_folder), output_dir=tmp_path / 'reference')
+        gs.run(streaming=True, robust=True)
+        assert {x.name for x in (tmp_path / 'reference').iterdir()} == \
+            {'data_mean.nii.gz', 'data_std.nii.gz', 'data_median.nii.gz', 'data_mad.nii.gz', 'data_stats.npz'}
+        assert sorted(x.name for x in tmp_path.iterdir()) == ['controls', 'reference']
+
+    def test_streaming_rejects_4d_maps(self, tmp_path, monkeypatch):
+        nib.save(nib.Nifti1Image(np.ones((2, 2, 2, 2)), np.eye(4)), str(tmp_path / 'bad.nii.gz'))
+        monkeypatch.chdir(tmp_path)
+        with pytest.raises(RuntimeError):
+            GroupStatistics(str(tmp_path)).run(streaming=True)
+
+    def test_running_stats_shape_mismatch(self):
+        stats = RunningStats()
+        stats.update(np.zeros((2, 2, 2)))
+        with pytest.raises(RuntimeError):
+            stats.update(np.zeros((3, 2, 2)))
+
+    def test_update_adds_and_removes_subjects(self, tmp_path, monkeypatch):
+        data_folder = tmp_path / 'controls'
+        data_folder.mkdir()
+        maps = make_group(data_folder, n_subjects=5)
+        monkeypatch.chdir(tmp_path)
+        GroupStatistics(str(data_folder)).run(streaming=True)
+        assert (tmp_path / 'data_stats.npz').exists()
+
+        new_map = np.random.RandomState(1).normal(100, 15, size=maps.shape[1:])
+        nib.save(nib.Nifti1Image(new_map, np.eye(4)), str(data_folder / 'subject_new.nii.gz'))
+        gs = GroupStatistics(str(data_folder))
+        gs.update(removed=[data_folder / 'subject_00.nii.gz'])
+        expected = np.concatenate([maps[1:], new_map[np.newaxis]])
+        assert gs.running_stats.count == 5
+        assert 'subject_00.nii.gz' not in gs.running_stats.subjects
+        assert np.allclose(gs.data_mean, expected.mean(axis=0))
+        assert np.allclose(gs.data_std, expected.std(axis=0))
+
+    def test_update_warns_about_deleted_subjects(self, tmp_path, monkeypatch):
+        data_folder = tmp_path / 'controls'
+        data_folder.mkdir()
+        make_group(data_folder, n_subjects=3)
+        monkeypatch.chdir(tmp_path)
+        GroupStatistics(str(data_folder)).run(streaming=True)
+        saved = (tmp_path / 'data_stats.npz').read_bytes()
+        (data_folder / 'subject_01.nii.gz').unlink()
+        gs = GroupStatistics(str(data_folder))
+        assert gs.missing_subjects_of() == ['subject_01.nii.gz']
+        with pytest.warns(UserWarning, match='subject_01'):
+            gs.update()
+        assert gs.missing_subjects == ['subject_01.nii.gz'] and gs.running_stats.count == 3
+
+        def crash(*args, **kwargs):
+            raise KeyboardInterrupt
+
+        (tmp_path / 'data_stats.npz').write_bytes(saved)
+        monkeypatch.setattr(np, 'savez', crash)
+        with pytest.raises(KeyboardInterrupt): # a crash while saving keeps the previous statistics
+            gs.save_stats()
+        assert (tmp_path / 'data_stats.npz').read_bytes() == saved
+        assert [x.name for x in tmp_path.iterdir() if x.name.endswith('.tmp')] == []
+
+    def test_merge_partial_stats(self, tmp_path):
+        maps = np.random.RandomState(2).normal(0, 3, size=(9, 3, 3, 3))
+        first, second = RunningStats(), RunningStats()
+        for i, data in enumerate(maps):
+            (first if i < 4 else second).update(data, subject=str(i))
+        first.save(tmp_path / 'first.npz')
+        merged = RunningStats.load(tmp_path / 'first.npz').merge(second)
+        assert merged.count == 9
+        assert np.allclose(merged.mean, maps.mean(axis=0))
+        assert np.allclose(merged.std(), maps.std(axis=0))
+        with pytest.raises(RuntimeError):
+            merged.merge(second)
+
+    @pytest.mark.parametrize('use_processes', [False, True])
+    def test_parallel_loading_matches_serial(self, tmp_path, monkeypatch, use_processes):
+        data_folder = tmp_path / 'controls'
+        data_folder.mkdir()
+        maps = make_group(data_folder, n_subjects=7)
+        monkeypatch.chdir(tmp_path)
+        gs = GroupStatistics(str(data_folder), workers=3, max_in_flight=4, use_processes=use_processes)
+        gs.run()
+        assert np.array_equal(gs.group_data, maps)
+        assert gs.files_per_second > 0
+
+    def test_blockwise_matches_streaming(self, tmp_path, monkeypatch):
+        data_folder = tmp_path / 'controls'
+        data_folder.mkdir()
+        maps = make_group(data_folder, n_subjects=5, shape=(4, 5, 7))
+        monkeypatch.chdir(tmp_path)
+        gs = GroupStatistics(str(data_folder), workers=2)
+        gs.run(blockwise=True, work_dir=str(tmp_path / 'work'), chunk_size=3)
+        assert len(list((tmp_path / 'work').glob('*.npy'))) == 5
+        assert gs.running_stats.count == 5
+        assert np.allclose(gs.data_mean, maps.mean(axis=0))
+        assert np.allclose(gs.data_std, maps.std(axis=0))
+
+    def test_interrupted_conversion_is_not_reused(self, tmp_path, monkeypatch):
+        data_folder = tmp_path / 'controls'
+        data_folder.mkdir()
+        maps = make_group(data_folder, n_subjects=2)
+        monkeypatch.chdir(tmp_path)
+        open_memmap = np.lib.format.open_memmap
+
+        def interrupted(*args, **kwargs):
+            open_memmap(*args, **kwargs) # the copy's file is created, then the run stops
+            raise KeyboardInterrupt
+
+        monkeypatch.setattr(np.lib.format, 'open_memmap', interrupted)
+        with pytest.raises(KeyboardInterrupt):
+            GroupStatistics(str(data_folder)).convert_subjects(tmp_path / 'work')
+        assert list((tmp_path / 'work').iterdir()) == []
+        monkeypatch.setattr(np.lib.format, 'open_memmap', open_memmap)
+        converted = GroupStatistics(str(data_folder)).convert_subjects(tmp_path / 'work')
+        assert np.array_equal(np.load(str(converted[0][1])), maps[0])
+
+    def test_sharded_matches_single_process(self, tmp_path, monkeypatch):
+        data_folder = tmp_path / 'controls'
+        data_folder.mkdir()
+        maps = make_group(data_folder, n_subjects=7)
+        monkeypatch.chdir(tmp_path)
+        single = GroupStatistics(str(data_folder))
+        single.run(streaming=True)
+        sharded = GroupStatistics(str(data_folder), workers=2)
+        sharded.run(shards=3)
+        assert sharded.running_stats.count == 7
+        assert sorted(sharded.running_stats.subjects) == sorted(single.running_stats.subjects)
+        assert np.allclose(sharded.data_mean, single.data_mean)
+        assert np.allclose(sharded.data_std, single.data_std)
+        assert np.allclose(sharded.data_std, maps.std(axis=0))
+        assert [len(x) for x in GroupStatistics.shard_subjects(range(7), 3)] == [2, 3, 2]
+
+    def test_merge_node_partials(self, tmp_path, monkeypatch):
+        nodes = []
+        for i in range(2):
+            nodes.append(tmp_path / f'node{i}')
+            nodes[-1].mkdir()
+        maps = np.concatenate([make_group(nodes[0], n_subjects=2, seed=1), make_group(nodes[1], n_subjects=3, seed=2)])
+        # subject names must differ between the nodes
+        for filename in nodes[1].iterdir():
+            filename.rename(filename.with_name('node1_' + filename.name))
+        stats_files = [str(tmp_path / f'node{i}.npz') for i in range(2)]
+        for node, stats_file in zip(nodes, stats_files):
+            partial_stats(sorted(node.iterdir()), stats_file)
+        monkeypatch.chdir(tmp_path)
+        gs = GroupStatistics(str(tmp_path))
+        gs.merge(*stats_files)
+        assert gs.running_stats.count == 5
+        assert np.allclose(gs.data_mean, maps.mean(axis=0))
+        assert np.allclose(gs.data_std, maps.std(axis=0))
+
+    def test_histogram_quantiles_are_within_a_bin(self):
+        rng = np.random.RandomState(3)
+        maps = rng.normal(100, 15, size=(101, 4, 5, 3))
+        maps[:8] += 500 # outlier controls
+        maps[:, 0, 0, 0] = 0 # background
+        stats = RunningStats()
+        for data in maps:
+            stats.update(data)
+        histograms = VoxelHistograms(stats.mean, stats.std(), bins=64)
+        for data in maps:
+            histograms.update(data)
+        bin_width = 2 * 5 * stats.std() / 64
+        median = np.median(maps, axis=0)
+        assert np.all(np.abs(histograms.quantile(0.5) - median) <= bin_width)
+        assert np.all(np.abs(histograms.mad() - np.median(np.abs(maps - median), axis=0)) <= bin_width)
+        assert np.all(np.abs(histograms.quantile(0.25) - np.percentile(maps, 25, axis=0)) <= bin_width)
+        assert histograms.quantile(0.5)[0, 0, 0] == 0 and histograms.mad()[0, 0, 0] == 0
+
+    def test_robust_maps(self, tmp_path, monkeypatch):
+        data_folder = tmp_path / 'controls'
+        data_folder.mkdir()
+        maps = make_group(data_folder, n_subjects=9)
+        monkeypatch.chdir(tmp_path)
+        stacked = GroupStatistics(str(data_folder))
+        stacked.run(robust=True, percentiles=[10])
+        assert np.allclose(stacked.data_median, np.median(maps, axis=0))
+        assert np.allclose(stacked.data_percentiles[10], np.percentile(maps, 10, axis=0))
+        streaming = GroupStatistics(str(data_folder))
+        streaming.run(streaming=True, robust=True, percentiles=[10], bins=256)
+        bin_width = 10 * maps.std(axis=0) / 256
+        assert np.all(np.abs(streaming.data_median - stacked.data_median) <= bin_width)
+        assert np.all(np.abs(streaming.data_mad - stacked.data_mad) <= bin_width)
+        for name in ['data_median', 'data_mad', 'data_p10']:
+            assert (tmp_path / f'{name}.nii.gz').exists()
@@ -0,0 +1,79 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Tests for the `instrumentation` module."""
+
+import json
+import threading
+import pytest
+from Pyhack.PythonHackathon.instrumentation import Tracer, NULL_STAGE
+
+
+class TestTracer:
+
+    def test_nested_stages(self):
+        tracer = Tracer()
+        tracer.begin('subject')
+        with tracer.stage('analysis'):
+            with tracer.stage('save'):
+                open(__file__).read()
+        save, analysis = tracer.records
+        assert (save['stage'], save['parent'], analysis['parent']) == ('save', 'analysis', None)
+        assert save['run'] == 'subject'
+        assert analysis['wall_seconds'] >= save['wall_seconds'] >= 0
+        assert save['read_bytes'] is None or save['read_bytes'] > 0
+        assert [row[0] for row in tracer.breakdown()[1:]] == ['analysis', '  save']
+
+    def test_failed_stage_is_recorded(self):
+        tracer = Tracer()
+        with pytest.raises(ValueError):
+            with tracer.stage('load'):
+                raise ValueError()
+        assert tracer.records[0]['failed']
+
+    def test_begin_starts_a_new_run(self):
+        tracer = Tracer()
+        tracer.begin('first')
+        with tracer.stage('load'):
+            pass
+        tracer.begin('second')
+        assert tracer.records == []
+        assert [record['run'] for record in tracer.run_records(1)] == ['first']
+
+    def test_concurrent_runs_keep_their_records(self):
+        tracer = Tracer()
+        started = threading.Barrier(2)
+        run_ids = {}
+
+        def analyze(name):
+            run_ids[name] = tracer.begin(name)
+            started.wait() # both runs are begun before either records a stage
+            with tracer.stage(f'{name} load'):
+                pass
+
+        threads = [threading.Thread(target=analyze, args=(name,)) for name in ('a', 'b')]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        for name in ('a', 'b'):
+            assert [record['stage'] for record in tracer.run_records(run_ids[name])] == [f'{name} load']
+            assert [row[0] for row in tracer.breakdown(run_ids[name])[1:]] == [f'{name} load']
+
+    def test_json_lines_log(self, tmp_path):
+        log_file = tmp_path / 'trace.jsonl'
+        tracer = Tracer(log_file=str(log_file))
+        for run in ['a', 'b']:
+            tracer.begin(run)
+            with tracer.stage('load'):
+                pass
+        records = [json.loads(line) for line in log_file.read_text().splitlines()]
+        assert [record['run'] for record in records] == ['a', 'b']
+
+    def test_disabled_tracer_records_nothing(self, tmp_path):
+        tracer = Tracer(enabled=False, log_file=str(tmp_path / 'trace.jsonl'))
+        tracer.begin('subject')
+        assert tracer.stage('load') is NULL_STAGE
+        with tracer.stage('load'):
+            pass
+        assert tracer.records == [] and not (tmp_path / 'trace.jsonl').exists()
@@ -0,0 +1,75 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Tests for the `nifti_cache` module."""
+
+import os
+import numpy as np
+import nibabel as nib
+from Pyhack.PythonHackathon.nifti_cache import NiftiCache, create_nifti_memmap
+from Pyhack.PythonHackathon.GroupStatistics import GroupStatistics
+
+
+def save_volume(path, data):
+    affine = np.diag([2.0, 2.0, 2.0, 1.0])
+    nib.save(nib.Nifti1Image(data, affine), str(path))
+    return str(path)
+
+
+class TestNiftiCache:
+
+    def test_cached_copy_is_memory_mapped(self, tmp_path):
+        data = np.arange(60, dtype=np.int16).reshape(3, 4, 5)
+        path = save_volume(tmp_path / 'mean.nii.gz', data)
+        cache = NiftiCache(tmp_path / 'cache')
+        first = cache.load(path)
+        second = cache.load(path)
+        assert isinstance(second.dataobj, np.memmap)
+        assert not second.dataobj.flags.writeable
+        assert np.array_equal(np.asanyarray(second.dataobj), data)
+        assert np.array_equal(second.affine, first.affine)
+        assert second.affine[0, 0] == 2.0
+        assert len(list((tmp_path / 'cache').glob('*.npy'))) == 1
+
+    def test_changed_source_is_reconverted(self, tmp_path):
+        path = save_volume(tmp_path / 'mean.nii.gz', np.zeros((3, 3, 3)))
+        cache = NiftiCache(tmp_path / 'cache')
+        cache.load(path)
+        save_volume(path, np.ones((3, 3, 3)))
+        stat = os.stat(path)
+        os.utime(path, ns=(stat.st_atime_ns, stat.st_mtime_ns + 10 ** 9))
+        assert np.asanyarray(cache.load(path).dataobj).sum() == 27
+
+    def test_least_recently_used_copies_are_evicted(self, tmp_path):
+        paths = [save_volume(tmp_path / f'map{i}.nii.gz', np.full((8, 8, 8), i, dtype=np.float64))
+                 for i in range(3)]
+        cache = NiftiCache(tmp_path / 'cache', max_bytes=2 * 8 ** 3 * 8 + 256)
+        for path in paths:
+            cache.load(path)
+        assert len(list((tmp_path / 'cache').glob('*.npy'))) == 2
+        assert np.asanyarray(cache.load(paths[0]).dataobj)[0, 0, 0] == 0
+
+    def test_group_statistics_reads_through_cache(self, tmp_path, monkeypatch):
+        data_folder = tmp_path / 'controls'
+        data_folder.mkdir()
+        maps = np.random.RandomState(0).normal(size=(4, 3, 4, 5))
+        for i, data in enumerate(maps):
+            save_volume(data_folder / f'sub{i}.nii.gz', data)
+        monkeypatch.chdir(tmp_path)
+        for _ in range(2):
+            gs = GroupStatistics(str(data_folder), nifti_cache=NiftiCache(tmp_path / 'cache'))
+            gs.run(streaming=True)
+            assert np.allclose(gs.data_mean, maps.mean(axis=0))
+
+    def test_memmapped_output_is_a_readable_nifti(self, tmp_path):
+        affine = np.diag([2.0, 2.0, 2.0, 1.0])
+        data = create_nifti_memmap(str(tmp_path / 'FA.nii'), (3, 4, 5), affine)
+        assert not data.any()
+        data[:, :, 2:4] = 0.5
+        data.flush()
+        del data
+        img = nib.load(str(tmp_path / 'FA.nii'))
+        assert img.shape == (3, 4, 5)
+        assert np.array_equal(img.affine, affine)
+        assert np.allclose(img.get_fdata()[:, :, 2:4], 0.5)
+        assert not img.get_fdata()[:, :, :2].any()
@@ -0,0 +1,45 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Tests for the `preprocess_batch` module."""
+
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+import pytest
+from Pyhack.PythonHackathon import preprocess_batch
+
+
+def worker_threads():
+    import threadpoolctl
+    return os.environ['OMP_NUM_THREADS'], [pool['num_threads'] for pool in threadpoolctl.threadpool_info()]
+
+
+class TestManifest:
+
+    def test_paths_are_relative_to_the_manifest(self, tmp_path):
+        manifest = tmp_path / 'subjects.csv'
+        manifest.write_text('subject,dwi,bvals,bvecs\n'
+                            'sub01,sub01/DTI4D.nii.gz,sub01/bvals,sub01/bvecs\n'
+                            'sub02, /data/sub02/DTI4D.nii.gz,/data/sub02/bvals,/data/sub02/bvecs\n')
+        first, second = preprocess_batch.read_manifest(manifest)
+        assert first == {'subject': 'sub01', 'dwi': str(tmp_path / 'sub01' / 'DTI4D.nii.gz'),
+                         'bvals': str(tmp_path / 'sub01' / 'bvals'), 'bvecs': str(tmp_path / 'sub01' / 'bvecs')}
+        assert second['dwi'] == '/data/sub02/DTI4D.nii.gz'
+
+    def test_duplicate_subjects_are_rejected(self, tmp_path):
+        manifest = tmp_path / 'subjects.csv'
+        manifest.write_text('subject,dwi,bvals,bvecs\na,1.nii,b,v\na,2.nii,b,v\n')
+        with pytest.raises(ValueError):
+            preprocess_batch.read_manifest(manifest)
+
+
+class TestWorkers:
+
+    def test_worker_thread_pools_are_limited(self):
+        pytest.importorskip('threadpoolctl')
+        with ProcessPoolExecutor(max_workers=1, initializer=preprocess_batch._limit_threads,
+                                 initargs=(1,)) as pool:
+            variable, pools = pool.submit(worker_threads).result()
+        assert variable == '1'
+        assert all(threads == 1 for threads in pools)
@@ -0,0 +1,87 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Tests for the `Preprocessing` module."""
+
+from types import SimpleNamespace
+
+import numpy as np
+import nibabel as nib
+import pytest
+
+preprocessing_module = pytest.importorskip('Pyhack.PythonHackathon.Preprocessing')
+Preprocessing = preprocessing_module.Preprocessing
+
+
+def write_series(folder, filename='dwi.nii'):
+    series = np.zeros((12, 12, 10, 20), dtype=np.float32)
+    series[3:9, 3:9, 2:8] = np.linspace(100, 200, 20, dtype=np.float32)
+    nib.save(nib.Nifti1Image(series, np.diag([2.0, 2.0, 2.0, 1.0])), str(folder / filename))
+    for name in ('bvals', 'bvecs'):
+        (folder / name).write_text('0\n')
+    return series
+
+
+class TestPreprocessing:
+
+    @pytest.mark.parametrize('filename', ['dwi.nii', 'dwi.nii.gz'])
+    def test_series_is_read_lazily(self, tmp_path, filename):
+        series = write_series(tmp_path, filename)
+        preprocessing = Preprocessing(tmp_path / 'bvecs', tmp_path / 'bvals', tmp_path / filename, None,
+                                      work_dir=tmp_path / 'work')
+        assert preprocessing._data is None
+        assert np.array_equal(preprocessing.volumes(7), series[..., 7])
+        assert np.array_equal(preprocessing.volumes(slice(5, 15)), series[..., 5:15])
+        assert preprocessing._data is None
+
+    @pytest.mark.parametrize('filename', ['dwi.nii', 'dwi.nii.gz'])
+    def test_segmentation_streams_the_masked_series(self, tmp_path, filename):
+        series = write_series(tmp_path, filename)
+        preprocessing = Preprocessing(tmp_path / 'bvecs', tmp_path / 'bvals', tmp_path / filename, None,
+                                      work_dir=tmp_path / 'work')
+        preprocessing.brain_segmentation()
+        mask = nib.load(preprocessing.mask_file).get_fdata() > 0
+        assert mask.shape == series.shape[:3]
+        assert mask[6, 6, 5] and not mask[0, 0, 0]
+        masked = nib.load(preprocessing.b0_mask_file).get_fdata()
+        assert np.allclose(masked, series * mask[..., None])
+        assert preprocessing._data is None
+
+    def test_tensor_fit_uses_the_checkpointed_eddy_correction(self, tmp_path):
+        write_series(tmp_path)
+        args = (tmp_path / 'bvecs', tmp_path / 'bvals', tmp_path / 'dwi.nii', None)
+        preprocessing = Preprocessing(*args, work_dir=tmp_path / 'work')
+        preprocessing.brain_segmentation()
+        with pytest.raises(RuntimeError):
+            preprocessing.eddy_corrected_file()
+        corrected = tmp_path / 'work' / 'corrected.nii'
+        corrected.write_bytes(b'corrected')
+        preprocessing.run_stage('eddy', [preprocessing.dti4d_file, preprocessing.bvals_file,
+                                         preprocessing.mask_file], {}, lambda: {'corrected': str(corrected)})
+        resumed = Preprocessing(*args, work_dir=tmp_path / 'work')
+        assert resumed.eddy_corrected_file() == str(corrected)
+
+    def test_eddy_correction_output_is_read_from_the_exec_graph(self, tmp_path, monkeypatch):
+        write_series(tmp_path)
+        corrected = tmp_path / 'work' / 'merged.nii'
+
+        def node(fullname, out_file):
+            return SimpleNamespace(name=fullname.rpartition('.')[2], fullname=fullname,
+                                   result=SimpleNamespace(outputs=SimpleNamespace(out_file=out_file)))
+
+        class Workflow: # the flattened exec graph of ecc_pipeline has no inputnode or outputnode
+            name = 'eddy_correct'
+            inputs = SimpleNamespace(inputnode=SimpleNamespace())
+
+            def run(self, plugin, plugin_args):
+                corrected.write_bytes(b'corrected')
+                nodes = [node('eddy_correct.DWICoregistration.MergeDWIs', 'nested.nii'),
+                         node('eddy_correct.MergeDWIs', str(corrected))]
+                return SimpleNamespace(nodes=lambda: nodes)
+
+        monkeypatch.setattr(preprocessing_module, 'ecc_pipeline', Workflow)
+        preprocessing = Preprocessing(tmp_path / 'bvecs', tmp_path / 'bvals', tmp_path / 'dwi.nii', None,
+                                      work_dir=tmp_path / 'work')
+        preprocessing.brain_segmentation()
+        assert preprocessing.eddy_currnets_correction() == str(corrected)
+        assert preprocessing.eddy_corrected_file() == str(corrected)
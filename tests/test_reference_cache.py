@@ -0,0 +1,53 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Tests for the `reference_cache` module."""
+
+import os
+import numpy as np
+import nibabel as nib
+from Pyhack.PythonHackathon.reference_cache import ReferenceCache, load_reference_volume
+
+
+def save_volume(path, value, shape=(4, 4, 4)):
+    data = np.full(shape, value, dtype=np.float64)
+    data[0, 0, 0] = 0
+    nib.save(nib.Nifti1Image(data, np.eye(4)), str(path))
+    return str(path)
+
+
+class TestReferenceCache:
+
+    def test_hit_returns_shared_read_only_volume(self, tmp_path):
+        cache = ReferenceCache(max_bytes=2 ** 20)
+        path = save_volume(tmp_path / 'mean.nii.gz', 3.0)
+        _, first = cache.get(path, load_reference_volume)
+        _, second = cache.get(path, load_reference_volume)
+        assert first is second
+        assert not first.flags.writeable
+        assert np.isnan(first[0, 0, 0])
+        assert (cache.hits, cache.misses) == (1, 1)
+
+    def test_changed_file_is_reloaded(self, tmp_path):
+        cache = ReferenceCache(max_bytes=2 ** 20)
+        path = save_volume(tmp_path / 'mean.nii.gz', 3.0)
+        cache.get(path, load_reference_volume)
+        save_volume(path, 5.0)
+        stat = os.stat(path)
+        os.utime(path, ns=(stat.st_atime_ns, stat.st_mtime_ns + 10 ** 9))
+        _, data = cache.get(path, load_reference_volume)
+        assert data[1, 1, 1] == 5.0
+        assert len(cache) == 1
+
+    def test_least_recently_used_is_evicted(self, tmp_path):
+        volume_bytes = 4 * 4 * 4 * 4 # float32
+        cache = ReferenceCache(max_bytes=2 * volume_bytes)
+        paths = [save_volume(tmp_path / f'map{i}.nii.gz', i + 1.0) for i in range(3)]
+        cache.get(paths[0], load_reference_volume)
+        cache.get(paths[1], load_reference_volume)
+        cache.get(paths[0], load_reference_volume)
+        cache.get(paths[2], load_reference_volume)
+        assert len(cache) == 2
+        assert cache.nbytes == 2 * volume_bytes
+        cache.get(paths[1], load_reference_volume)
+        assert cache.misses == 4
@@ -0,0 +1,24 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Tests for the atlas area statistics of `zscores`."""
+
+import pytest
+import numpy as np
+from Pyhack.PythonHackathon import zscores
+
+
+class TestRegionStats:
+
+    def test_region_nanmeans_matches_loop(self):
+        rng = np.random.RandomState(0)
+        atlas = rng.randint(0, 12, size=(6, 7, 5))
+        atlas[atlas == 7] = 0 # area 7 is empty
+        values = rng.normal(size=atlas.shape)
+        values[rng.rand(*atlas.shape) < 0.2] = np.nan
+        n_regions = int(atlas.max())
+        result = zscores.region_nanmeans(atlas, values, n_regions)
+        with pytest.warns(RuntimeWarning):
+            expected = [np.nanmean(values[atlas == i]) for i in range(1, n_regions + 1)]
+        assert np.allclose(result, expected, equal_nan=True)
+        assert np.isnan(result[6])
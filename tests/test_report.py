@@ -0,0 +1,32 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Tests for the `report` module."""
+
+from Pyhack.PythonHackathon import report
+
+
+TABLE = [['Region', 'Value', 'Z-score'], [1, 5.6123, -0.36], [2, 7.25, 2.5]]
+
+
+class TestReport:
+
+    def test_report_html_contains_results(self):
+        source_html = report.report_html(TABLE, subject='<07>', date='2018-06-27', remarks='follow up')
+        assert '<td>5.6123</td>' in source_html
+        assert '&lt;07&gt;' in source_html
+        assert '2018-06-27' in source_html
+
+    def test_write_reports_in_parallel(self, tmp_path):
+        reports = [dict(pdf_filename=str(tmp_path / f'sub{i}.pdf'), table=TABLE, subject=f'sub{i}')
+                   for i in range(3)]
+        written = report.write_reports(reports, workers=2)
+        assert written == [r['pdf_filename'] for r in reports]
+        for filename in written:
+            with open(filename, 'rb') as f:
+                assert f.read(5) == b'%PDF-'
+
+    def test_report_filename_has_no_path(self):
+        assert report.report_filename('sub 07') == 'sub_07_report.pdf'
+        assert '/' not in report.report_filename('../../etc/x')
+        assert report.report_filename('a\\b:c') == 'a_b_c_report.pdf'
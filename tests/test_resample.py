@@ -0,0 +1,85 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Tests for the `resample` module."""
+
+import numpy as np
+import nibabel as nib
+from Pyhack.PythonHackathon.resample import ResamplingMap
+from Pyhack.PythonHackathon import zscores
+
+
+class TestResamplingMap:
+
+    def test_linear_function_is_reproduced(self):
+        # a 2 mm grid sampled at the centres of a shifted 3 mm grid
+        source_affine = np.diag([2.0, 2.0, 2.0, 1.0])
+        target_affine = np.diag([3.0, 3.0, 3.0, 1.0])
+        target_affine[:3, 3] = 1
+        i, j, k = np.indices((10, 12, 8))
+        source = 3 * i + 2 * j - k + 5.0
+        resampling_map = ResamplingMap.build(source_affine, source.shape, target_affine, (6, 8, 5))
+        resampled = resampling_map.apply(source, dtype=np.float64)
+        ti, tj, tk = np.indices((6, 8, 5))
+        x, y, z = 3 * ti + 1, 3 * tj + 1, 3 * tk + 1 # world coordinates
+        expected = 3 * x / 2 + 2 * y / 2 - z / 2 + 5
+        inside = (x <= 18) & (y <= 22) & (z <= 14)
+        assert np.allclose(resampled[inside], expected[inside])
+        assert np.all(resampled[~inside] == 0)
+
+    def test_same_grid_is_identity(self):
+        data = np.random.RandomState(0).normal(size=(4, 5, 3))
+        for order in (0, 1):
+            resampling_map = ResamplingMap.build(np.eye(4), data.shape, np.eye(4), data.shape, order=order)
+            assert np.allclose(resampling_map.apply(data, dtype=np.float64), data)
+
+    def test_background_is_not_blended_into_the_edge(self):
+        source = np.zeros((4, 4, 4))
+        source[:2] = 100 # brain on the first half of the first axis, background (0) on the other
+        target_affine = np.eye(4)
+        target_affine[0, 3] = 0.5 # target voxels halfway between the source voxels
+        resampling_map = ResamplingMap.build(np.eye(4), source.shape, target_affine, (3, 4, 4))
+        blended = resampling_map.apply(source, dtype=np.float64)
+        assert np.all(blended[1] == 50) # the edge voxel, half brain and half background
+        resampled = resampling_map.apply(source, dtype=np.float64, missing=0)
+        assert np.all(resampled[:2] == 100) and np.all(resampled[2] == 0)
+
+    def test_maps_are_cached(self):
+        first = ResamplingMap.get(np.eye(4), (4, 4, 4), np.diag([2.0, 2.0, 2.0, 1.0]), (2, 2, 2))
+        assert ResamplingMap.get(np.eye(4), (4, 4, 4), np.diag([2.0, 2.0, 2.0, 1.0]), (2, 2, 2)) is first
+
+    def test_cache_is_bounded_by_bytes(self, monkeypatch):
+        monkeypatch.setattr(ResamplingMap, '_memory_cache', type(ResamplingMap._memory_cache)())
+        monkeypatch.setattr(ResamplingMap, '_cached_bytes', 0)
+        one_map = ResamplingMap.build(np.eye(4), (6, 6, 6), np.eye(4), (5, 5, 5)).nbytes # 125 voxels
+        monkeypatch.setattr(ResamplingMap, 'max_bytes', 2 * one_map)
+        maps = [ResamplingMap.get(np.eye(4), (6, 6, 6 + i), np.eye(4), (5, 5, 5)) for i in range(3)]
+        assert len(ResamplingMap._memory_cache) == 2
+        assert ResamplingMap._cached_bytes == 2 * one_map
+        assert ResamplingMap.get(np.eye(4), (6, 6, 8), np.eye(4), (5, 5, 5)) is maps[2]
+        assert ResamplingMap.get(np.eye(4), (6, 6, 6), np.eye(4), (5, 5, 5)) is not maps[0] # evicted
+        ResamplingMap.get(np.eye(4), (6, 6, 6), np.eye(4), (10, 10, 10)) # larger than max_bytes, not cached
+        assert ResamplingMap._cached_bytes <= ResamplingMap.max_bytes
+
+    def test_subject_on_another_grid_is_resampled(self, tmp_path, monkeypatch):
+        monkeypatch.chdir(tmp_path)
+        rng = np.random.RandomState(0)
+        shape = (8, 8, 6)
+        paths = {}
+        for name, data in [('mean', rng.normal(100, 5, size=shape)), ('sd', rng.uniform(5, 10, size=shape)),
+                           ('atlas', rng.randint(1, 4, size=shape).astype(np.int16))]:
+            paths[name] = str(tmp_path / f'{name}.nii.gz')
+            nib.save(nib.Nifti1Image(data, np.diag([2.0, 2.0, 2.0, 1.0])), paths[name])
+        # the same constant subject at 1 mm: the resampled map is constant too
+        paths['subject'] = str(tmp_path / 'subject.nii.gz')
+        nib.save(nib.Nifti1Image(np.full((16, 16, 12), 120.0), np.eye(4)), paths['subject'])
+        rejected = zscores.SubjectAnalyzer(paths['subject'], paths['mean'], paths['sd'], paths['atlas'],
+                                           atlas_cache_dir=tmp_path / 'cache', image_cache_dir=tmp_path / 'images')
+        assert not rejected.is_data_proper
+        analyzer = zscores.SubjectAnalyzer(paths['subject'], paths['mean'], paths['sd'], paths['atlas'],
+                                           atlas_cache_dir=tmp_path / 'cache', image_cache_dir=tmp_path / 'images',
+                                           resample=True)
+        assert analyzer.is_data_proper and analyzer.is_resampled
+        assert analyzer.shape == shape
+        assert np.allclose(analyzer.subject_data, 120)
+        assert np.allclose(nib.load('zs.nii.gz').affine, np.diag([2.0, 2.0, 2.0, 1.0]))
@@ -0,0 +1,155 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Tests for `zscores.SubjectAnalyzer` on synthetic maps."""
+
+import pathlib
+import tracemalloc
+import pytest
+import numpy as np
+import nibabel as nib
+from Pyhack.PythonHackathon import zscores
+from Pyhack.PythonHackathon.reference_cache import ReferenceCache
+from Pyhack.PythonHackathon.instrumentation import Tracer
+
+
+@pytest.fixture
+def maps(tmp_path, monkeypatch):
+    rng = np.random.RandomState(0)
+    shape = (8, 9, 7)
+    data = {'subject': rng.normal(100, 15, size=shape).round(),
+            'mean': rng.normal(100, 5, size=shape).round(),
+            'sd': rng.uniform(5, 10, size=shape).round(),
+            'atlas': rng.randint(0, 9, size=shape).astype(np.int16)}
+    data['subject'][:2] = 0 # background
+    paths = {}
+    for name, values in data.items():
+        paths[name] = str(tmp_path / f'{name}.nii.gz')
+        nib.save(nib.Nifti1Image(values, np.eye(4)), paths[name])
+    monkeypatch.chdir(tmp_path)
+    return data, paths
+
+
+def analyze(paths, tmp_path, **kwargs):
+    return zscores.SubjectAnalyzer(paths['subject'], paths['mean'], paths['sd'], paths['atlas'],
+                                   atlas_cache_dir=tmp_path / 'atlas_cache', image_cache_dir=tmp_path / 'images',
+                                   **kwargs)
+
+
+class TestSubjectAnalyzer:
+
+    def test_float32_results_match_float64(self, maps, tmp_path):
+        data, paths = maps
+        single = analyze(paths, tmp_path)
+        assert nib.load('zs.nii.gz').get_data_dtype() == np.float32
+        double = analyze(paths, tmp_path, dtype=np.float64)
+        assert single.zscores.dtype == np.float32 and double.zscores.dtype == np.float64
+        subject = np.where(data['subject'] == 0, np.nan, data['subject'])
+        expected = np.nan_to_num((subject - data['mean']) / data['sd'])
+        assert np.allclose(double.zscores, expected)
+        assert np.allclose(single.zscores, expected, atol=1e-5)
+        assert np.allclose(single.area_data, double.area_data, atol=1e-4, equal_nan=True)
+        assert (tmp_path / 'Z_map.png').exists()
+
+    def test_outputs_go_to_the_analysis_folder(self, maps, tmp_path):
+        _, paths = maps
+        first = analyze(paths, tmp_path, output_dir=tmp_path / 'first')
+        second = analyze(paths, tmp_path, output_dir=tmp_path / 'second')
+        assert first.image_path == str(tmp_path / 'first' / 'Z_map.png')
+        for analyzer in (first, second):
+            assert nib.load(analyzer.zscores_path).shape == (8, 9, 7)
+            assert pathlib.Path(analyzer.image_path).exists()
+        assert not (tmp_path / 'zs.nii.gz').exists() and not (tmp_path / 'Z_map.png').exists()
+
+    def test_reference_cache_is_used(self, maps, tmp_path):
+        _, paths = maps
+        cache = ReferenceCache(2 ** 20)
+        first = analyze(paths, tmp_path, reference_cache=cache)
+        second = analyze(paths, tmp_path, reference_cache=cache)
+        assert second.mean_data is first.mean_data
+        assert cache.hits == 2
+        assert np.array_equal(first.zscores, second.zscores)
+
+    def test_memory_is_measured(self, maps, tmp_path):
+        _, paths = maps
+        sa = analyze(paths, tmp_path, measure_memory=True)
+        assert sa.peak_memory >= sa.zscores.nbytes
+        assert sa.array_memory >= 4 * sa.zscores.nbytes
+
+    def test_memory_measure_is_refused_while_tracing(self, maps, tmp_path):
+        _, paths = maps
+        tracemalloc.start()
+        try:
+            with pytest.raises(RuntimeError):
+                analyze(paths, tmp_path, measure_memory=True)
+        finally:
+            tracemalloc.stop()
+
+        def fail(stage):
+            raise ValueError(stage)
+
+        with pytest.raises(ValueError): # a failed analysis ends its measure
+            analyze(paths, tmp_path, measure_memory=True, progress=fail)
+        assert not tracemalloc.is_tracing()
+        assert analyze(paths, tmp_path, measure_memory=True).peak_memory > 0
+
+    def test_progress_stages(self, maps, tmp_path):
+        _, paths = maps
+        stages = []
+        analyze(paths, tmp_path, progress=stages.append)
+        assert stages == ['load', 'z-score', 'atlas', 'render']
+
+    def test_masked_mode_matches_dense(self, maps, tmp_path):
+        data, paths = maps
+        dense = analyze(paths, tmp_path)
+        dense_zs = nib.load('zs.nii.gz').get_fdata()
+        masked = analyze(paths, tmp_path, masked=True)
+        in_atlas = data['atlas'] > 0
+        assert masked.zscores.shape == (np.count_nonzero(in_atlas),)
+        assert np.array_equal(masked.zscores, dense.zscores[in_atlas])
+        assert np.allclose(masked.area_data, dense.area_data, equal_nan=True)
+        masked_zs = nib.load('zs.nii.gz').get_fdata()
+        assert np.array_equal(masked_zs[in_atlas], dense_zs[in_atlas], equal_nan=True)
+        assert np.isnan(masked_zs[~in_atlas]).all()
+
+    def test_masked_images_are_read_by_slabs(self, maps, tmp_path):
+        data, paths = maps
+        mask = zscores.BrainMask.from_data(data['atlas'])
+        img = nib.load(paths['subject'])
+        for slab_bytes in [1, 8 * 9 * 4 * 3, 2 ** 22]: # one slice, 3 slices, the whole volume per slab
+            values = mask.compress_image(img, dtype=np.float32, slab_bytes=slab_bytes)
+            assert values.dtype == np.float32
+            assert np.array_equal(values, mask.compress(data['subject']))
+
+    def test_masked_mode_with_mask_file(self, maps, tmp_path):
+        data, paths = maps
+        mask = np.zeros(data['atlas'].shape, dtype=np.uint8)
+        mask[:, :4] = 1
+        nib.save(nib.Nifti1Image(mask, np.eye(4)), str(tmp_path / 'mask.nii.gz'))
+        masked = analyze(paths, tmp_path, masked=True, brain_mask_path=str(tmp_path / 'mask.nii.gz'))
+        assert masked.brain_mask.n_voxels == mask.sum()
+        nib.save(nib.Nifti1Image(np.ones((2, 2, 2), dtype=np.uint8), np.eye(4)), str(tmp_path / 'small.nii.gz'))
+        wrong = analyze(paths, tmp_path, masked=True, brain_mask_path=str(tmp_path / 'small.nii.gz'))
+        assert not wrong.is_data_proper and not wrong.is_mask_proper
+
+    def test_nifti_cache_gives_same_results(self, maps, tmp_path):
+        _, paths = maps
+        from Pyhack.PythonHackathon.nifti_cache import NiftiCache
+        plain = analyze(paths, tmp_path)
+        cached = analyze(paths, tmp_path, nifti_cache=NiftiCache(tmp_path / 'nifti'))
+        assert isinstance(cached.mean_img.dataobj, np.memmap)
+        assert np.array_equal(plain.zscores, cached.zscores)
+
+    def test_stages_are_traced(self, maps, tmp_path):
+        _, paths = maps
+        tracer = Tracer()
+        analyze(paths, tmp_path, tracer=tracer)
+        assert [(record['stage'], record['parent']) for record in tracer.records] == \
+            [('load', None), ('save', 'z-score'), ('z-score', None), ('atlas', None), ('render', None)]
+        assert all(record['run'] == paths['subject'] for record in tracer.records)
+
+    def test_robust_zscores(self, maps, tmp_path):
+        data, paths = maps
+        robust = analyze(paths, tmp_path, robust=True, dtype=np.float64)
+        plain = analyze(paths, tmp_path, dtype=np.float64)
+        assert np.allclose(robust.zscores * zscores.MAD_TO_SD, plain.zscores)
@@ -0,0 +1,50 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Tests for the `tensor_fit` module."""
+
+import numpy as np
+import nibabel as nib
+import pytest
+
+pytest.importorskip('dipy')
+from Pyhack.PythonHackathon.tensor_fit import fit_tensors
+
+
+def write_series(folder):
+    # tensor with eigenvalues (1.5, 0.5, 0.5) x 1e-3 along x, in a 4 x 4 x 6 block of a 6 x 6 x 7 volume
+    bvals = np.array([0] + [1000] * 6, dtype=float)
+    bvecs = np.array([[0, 0, 0], [1, 0, 0], [0, 1, 0], [0, 0, 1],
+                      [0.7071, 0.7071, 0], [0.7071, 0, 0.7071], [0, 0.7071, 0.7071]])
+    tensor = np.diag([1.5e-3, 0.5e-3, 0.5e-3])
+    signal = 1000 * np.exp(-bvals * np.einsum('ij,jk,ik->i', bvecs, tensor, bvecs))
+    mask = np.zeros((6, 6, 7), dtype=np.uint8)
+    mask[1:5, 1:5, :6] = 1
+    series = mask[..., None] * signal.astype(np.float32)
+    affine = np.diag([2.0, 2.0, 2.0, 1.0])
+    nib.save(nib.Nifti1Image(series, affine), str(folder / 'dwi.nii.gz'))
+    nib.save(nib.Nifti1Image(mask, affine), str(folder / 'mask.nii.gz'))
+    np.savetxt(folder / 'bvals', bvals[None])
+    np.savetxt(folder / 'bvecs', bvecs.T)
+    return mask > 0
+
+
+class TestFitTensors:
+
+    def test_chunked_fit_writes_fsl_style_maps(self, tmp_path):
+        mask = write_series(tmp_path)
+        outputs = fit_tensors(tmp_path / 'dwi.nii.gz', tmp_path / 'bvals', tmp_path / 'bvecs',
+                              tmp_path / 'mask.nii.gz', tmp_path, workers=2, slices_per_chunk=2,
+                              cache_dir=tmp_path / 'cache')
+        assert sorted(outputs) == ['FA', 'L1', 'L2', 'L3', 'MD', 'V1']
+        assert outputs['FA'].endswith('TP_FA.nii')
+        l1 = nib.load(outputs['L1']).get_fdata()
+        assert np.allclose(l1[mask], 1.5e-3, rtol=1e-2)
+        assert not l1[~mask].any()
+        assert np.allclose(nib.load(outputs['MD']).get_fdata()[mask], 2.5e-3 / 3, rtol=1e-2)
+        evals = np.array([1.5, 0.5, 0.5])
+        fa = np.sqrt(1.5 * ((evals - evals.mean()) ** 2).sum() / (evals ** 2).sum())
+        assert np.allclose(nib.load(outputs['FA']).get_fdata()[mask], fa, rtol=1e-2)
+        v1 = nib.load(outputs['V1']).get_fdata()
+        assert v1.shape == (6, 6, 7, 3)
+        assert np.allclose(np.abs(v1[mask]), [1, 0, 0], atol=1e-2)
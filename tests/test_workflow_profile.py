@@ -0,0 +1,114 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Tests for the `workflow_profile` module."""
+
+import json
+import shutil
+from types import SimpleNamespace
+
+import pytest
+from Pyhack.PythonHackathon.workflow_profile import VIEWER, WorkflowProfiler, annotate_graph, critical_path, \
+    graph_node_key, graph_node_keys
+
+
+def graph(runtimes, imports):
+    return [{'name': name, 'imports': imports.get(name, []), 'runtime': runtime, 'group': 1, 'size': 1}
+            for name, runtime in runtimes.items()]
+
+
+class Node:
+
+    def __init__(self, name, itername):
+        self.name = name
+        self.itername = itername
+
+
+class TestCriticalPath:
+
+    def test_longest_weighted_path(self):
+        # 00 -> 02 -> 03 is longer than 01 -> 03, although 01 is the slowest node
+        nodes = graph({'00_A': 2, '01_B': 5, '02_C': 4, '03_D': 1},
+                      {'02_C': ['00_A'], '03_D': ['01_B', '02_C']})
+        assert critical_path(nodes) == (['00_A', '02_C', '03_D'], 7)
+
+    def test_nodes_without_runtime_weigh_nothing(self):
+        nodes = graph({'00_A': None, '01_B': 3}, {'01_B': ['00_A']})
+        assert critical_path(nodes) == (['00_A', '01_B'], 3)
+
+    def test_cycle_is_an_error(self):
+        nodes = graph({'00_A': 1, '01_B': 1}, {'00_A': ['01_B'], '01_B': ['00_A']})
+        with pytest.raises(ValueError):
+            critical_path(nodes)
+
+    def test_eddy_correct_graph(self):
+        with open(VIEWER.parent / 'graph.json') as f:
+            nodes = json.load(f)
+        for node in nodes:
+            node['runtime'] = 10 if node['name'] == '08_CoRegistration' else 1
+        path, total = critical_path(nodes)
+        assert '08_CoRegistration' in path
+        assert total == 10 + len(path) - 1
+        for before, after in zip(path, path[1:]):
+            assert before in next(node for node in nodes if node['name'] == after)['imports']
+
+
+class TestWorkflowProfiler:
+
+    def test_graph_is_annotated_with_the_node_runtimes(self, tmp_path):
+        shutil.copy(VIEWER.parent / 'graph.json', tmp_path / 'graph.json')
+        profiler = WorkflowProfiler()
+        for name in ('InitXforms', 'MskDilate', 'CoRegistration'):
+            runtime = SimpleNamespace(duration=30.0 if name == 'CoRegistration' else 1.0, cpu_percent=200.0,
+                                      mem_peak_gb=0.5)
+            node = SimpleNamespace(name=name, itername=f'eddy_correct.{name}',
+                                   result=SimpleNamespace(runtime=runtime))
+            profiler(node, 'start')
+            profiler(node, 'end')
+        failed = SimpleNamespace(name='ExtractDWI', itername='eddy_correct.ExtractDWI')
+        profiler(failed, 'start')
+        profiler(failed, 'exception')
+
+        path, total = profiler.annotate(tmp_path / 'graph.json')
+        assert path[-2:] == ['01_MskDilate', '08_CoRegistration'] and total == 31
+        with open(tmp_path / 'graph.json') as f:
+            nodes = {node['name']: node for node in json.load(f)}
+        coregistration = nodes['08_CoRegistration']
+        assert coregistration['runtime'] == 30 and coregistration['cpu_peak_percent'] == 200
+        assert coregistration['critical'] and coregistration['critical_import'] == '01_MskDilate'
+        assert nodes['02_ExtractDWI']['failed'] and not nodes['02_ExtractDWI']['critical']
+        assert 'runtime' not in nodes['05_b0_avg']
+        assert (tmp_path / 'index.html').exists()
+
+    def test_nodes_of_the_same_name_keep_their_own_records(self, tmp_path):
+        shutil.copy(VIEWER.parent / 'graph.json', tmp_path / 'graph.json')
+        profiler = WorkflowProfiler()
+        for itername, duration in [('eddy_correct.DWICoregistration.MergeDWIs', 5.0),
+                                   ('eddy_correct.MergeDWIs', 7.0)]:
+            node = SimpleNamespace(name='MergeDWIs', itername=itername,
+                                   result=SimpleNamespace(runtime=SimpleNamespace(duration=duration)))
+            profiler(node, 'start')
+            profiler(node, 'end')
+        keys = {'12_MergeDWIs': 'eddy_correct.DWICoregistration.MergeDWIs', '16_MergeDWIs': 'eddy_correct.MergeDWIs'}
+        profiler.annotate(tmp_path / 'graph.json', viewer=False)
+        with open(tmp_path / 'graph.json') as f:
+            nodes = {node['name']: node for node in json.load(f)}
+        assert 'runtime' not in nodes['12_MergeDWIs'] and 'runtime' not in nodes['16_MergeDWIs'] # ambiguous
+        annotate_graph(tmp_path / 'graph.json', profiler.records, viewer=False, keys=keys)
+        with open(tmp_path / 'graph.json') as f:
+            nodes = {node['name']: node for node in json.load(f)}
+        assert nodes['12_MergeDWIs']['runtime'] == 5 and nodes['16_MergeDWIs']['runtime'] == 7
+
+    def test_graph_node_keys_follow_the_report_order(self):
+        nx = pytest.importorskip('networkx')
+        pytest.importorskip('nipype')
+        graph = nx.DiGraph()
+        nodes = [Node(name, f'wf.{hierarchy}{name}') for hierarchy, name in [('', 'Split'), ('inner.', 'Merge'),
+                                                                            ('', 'Merge')]]
+        graph.add_edges_from([(nodes[0], nodes[1]), (nodes[1], nodes[2])])
+        assert graph_node_keys(graph) == {'0_Split': 'wf.Split', '1_Merge': 'wf.inner.Merge', '2_Merge': 'wf.Merge'}
+
+    def test_graph_node_key(self):
+        assert graph_node_key('06_Bias') == 'Bias'
+        assert graph_node_key('05_b0_avg') == 'b0_avg'
+        assert graph_node_key('outputnode') == 'outputnode'